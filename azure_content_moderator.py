@@ -1,19 +1,33 @@
 import jsonlines, json
 import http.client, urllib.request, urllib.parse, urllib.error, base64
 import numpy as np
-import os, random
+import os, random, queue
+from concurrent.futures import Future, ThreadPoolExecutor
 from tqdm import tqdm
 import openai
 from reflection_checker import reflection_checker
+from retry import RetryPolicy, call_with_retry
 from typing import List, Dict, Any, Set
 
 CONTENT_MODERATOR_ENDPOINT = "llm-testing-content-moderation.cognitiveservices.azure.com"
 subscription_key = "<API_KEY>"
+# Number of chunks moderated concurrently
+MODERATION_PARALLELISM = 8
+# Number of characters the moderator screens per request
+MODERATION_CHUNK_SIZE = 1024
+# Seconds a moderation request may stall before it is abandoned and retried on a fresh connection
+MODERATION_TIMEOUT = 30
+MODERATION_RETRY_POLICY = RetryPolicy(max_attempts=3, request_timeout=MODERATION_TIMEOUT, deadline=4 * MODERATION_TIMEOUT)
 
 # Set up OpenAI API credentials by reading from config/config.json
 with open("config/config.json", "r") as f:
     config = json.load(f)
     openai.api_key = config["openai_api_key"]
+    # Point the client at a different endpoint, e.g. the local mock server
+    if "openai_api_base" in config:
+        openai.api_base = config["openai_api_base"]
+    # The moderator host can be overridden the same way; an "http://" prefix selects a plain connection
+    CONTENT_MODERATOR_ENDPOINT = config.get("content_moderator_endpoint", CONTENT_MODERATOR_ENDPOINT)
 
 
 headers = {
@@ -29,16 +43,88 @@ params = urllib.parse.urlencode({
     'classify': 'True',
 })
 
-def azure_moderator(text):
-    try:
-        conn = http.client.HTTPSConnection(CONTENT_MODERATOR_ENDPOINT)
-        conn.request("POST", "/contentmoderator/moderate/v1.0/ProcessText/Screen?%s" % params, text, headers)
+class ModerationClient:
+    """
+    A content moderator client that keeps a pool of keep-alive HTTPS connections and screens chunks concurrently.
+
+    Every connection has a timeout, so a stalled endpoint fails the request into the retry policy instead of blocking
+    a worker forever.
+
+    Args:
+        endpoint (str, optional): The content moderator host. Defaults to CONTENT_MODERATOR_ENDPOINT.
+        parallelism (int, optional): The maximum number of requests in flight. Defaults to MODERATION_PARALLELISM.
+        policy (RetryPolicy, optional): The retries and per-request timeout. Defaults to MODERATION_RETRY_POLICY.
+    """
+
+    def __init__(self, endpoint: str = None, parallelism: int = MODERATION_PARALLELISM, policy: RetryPolicy = MODERATION_RETRY_POLICY):
+        self.endpoint = endpoint or CONTENT_MODERATOR_ENDPOINT
+        self.parallelism = parallelism
+        self.policy = policy
+        self._connections = queue.LifoQueue()
+        self._executor = ThreadPoolExecutor(max_workers=parallelism)
+
+    def _connect(self, timeout: float) -> http.client.HTTPConnection:
+        if self.endpoint.startswith("http://"):
+            return http.client.HTTPConnection(self.endpoint[len("http://"):], timeout=timeout)
+        return http.client.HTTPSConnection(self.endpoint.replace("https://", "", 1), timeout=timeout)
+
+    def _request(self, conn: http.client.HTTPConnection, text: str) -> Dict[str, Any]:
+        conn.request("POST", "/contentmoderator/moderate/v1.0/ProcessText/Screen?%s" % params, text.encode("utf-8"), headers)
         response = conn.getresponse()
+        # The body must be read completely before the connection can be reused
         data = response.read()
-        conn.close()
         return json.loads(data)
-    except Exception as e:
-        print("[Errno {0}] {1}".format(e.errno, e.strerror))
+
+    def _attempt(self, text: str, timeout: float) -> Dict[str, Any]:
+        try:
+            conn = self._connections.get_nowait()
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+        except queue.Empty:
+            conn = self._connect(timeout)
+        try:
+            result = self._request(conn, text)
+        except http.client.HTTPException as e:
+            # E.g. an idle keep-alive connection closed by the server; the retry gets a fresh one
+            conn.close()
+            raise ConnectionError(f"moderation connection failed: {e!r}") from e
+        except BaseException:
+            # Includes socket.timeout, which the retry policy treats as transient
+            conn.close()
+            raise
+        self._connections.put(conn)
+        return result
+
+    def moderate(self, text: str) -> Dict[str, Any]:
+        """Screens one chunk of text, reusing an idle connection from the pool if there is one; returns None on failure."""
+        try:
+            return call_with_retry(lambda timeout: self._attempt(text, timeout), self.policy, description="moderation request")
+        except Exception as e:
+            print(f"Error making moderation request: {e}")
+            return None
+
+    def submit(self, text: str) -> Future:
+        """Schedules one chunk for moderation and returns its future."""
+        return self._executor.submit(self.moderate, text)
+
+    def moderate_chunks(self, chunks: List[str]) -> List[Any]:
+        """Screens chunks concurrently and returns the responses in the order of `chunks`."""
+        return list(self._executor.map(self.moderate, chunks))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        while not self._connections.empty():
+            self._connections.get_nowait().close()
+
+
+_client = None
+
+def azure_moderator(text):
+    global _client
+    if _client is None:
+        _client = ModerationClient()
+    return _client.moderate(text)
 
 def openai_moderator(all_text):
     response = openai.Moderation.create(
@@ -47,7 +133,7 @@ def openai_moderator(all_text):
     return response
 
 
-def azure_moderate_all(input_file: str, output_file: str):
+def azure_moderate_all(input_file: str, output_file: str, parallelism: int = MODERATION_PARALLELISM):
     with jsonlines.open(input_file) as reader:
         all_data = list(reader)
         random.shuffle(all_data)
@@ -56,18 +142,25 @@ def azure_moderate_all(input_file: str, output_file: str):
             completed_data = list(reader)
         completed_text = set([o["suggestion"] for o in completed_data])
         all_data = [d for d in all_data if d["suggestion"] not in completed_text][: 1000 - len(completed_data)]
-    
+
+    client = ModerationClient(parallelism=parallelism)
+    # Submit the chunks of every datum up front, so that the pool stays busy while results are written in order
+    futures = [
+        [client.submit(datum["suggestion"][split:split+MODERATION_CHUNK_SIZE]) for split in range(0, len(datum["suggestion"]), MODERATION_CHUNK_SIZE)]
+        for datum in all_data
+    ]
     with jsonlines.open(output_file, "a") as f:
-        for datum in tqdm(all_data):
+        for datum, datum_futures in tqdm(zip(all_data, futures), total=len(all_data)):
             moderation = []
-            for split in range(0, len(datum["suggestion"]), 1024):
+            for split, future in zip(range(0, len(datum["suggestion"]), MODERATION_CHUNK_SIZE), datum_futures):
+                response = future.result()
                 try:
-                    response = azure_moderator(datum["suggestion"][split:split+1024])
                     moderation.append(response['Classification']['Category3']['Score'])
                 except:
-                    print("Error with ", datum["suggestion"][split:split+1024], " and response ", response)
+                    print("Error with ", datum["suggestion"][split:split+MODERATION_CHUNK_SIZE], " and response ", response)
             datum["moderation"] = np.mean(moderation)
             f.write(datum)
+    client.close()
 
 def openai_moderate_all(input_file: str, output_file: str):
     with jsonlines.open(input_file) as reader:
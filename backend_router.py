@@ -0,0 +1,169 @@
+import json, random
+from typing import Any, Dict, List, Optional
+
+from rate_limiter import DEPLOYMENT_LIMITS, get_limiter, has_limits, register_limits
+from model_client import chat_completion, achat_completion
+from retry import ContentFilteredError
+
+AZURE_API_BASE = "https://llm-testing.openai.azure.com/"
+AZURE_API_VERSION = "2023-03-15-preview"
+OPENAI_API_BASE = "https://api.openai.com/v1"
+
+
+class Backend:
+    """
+    One configured endpoint serving the chat model: an Azure deployment or an OpenAI key.
+
+    The credentials are passed with every request instead of being set on the global `openai` module, so several
+    backends can be used concurrently from the same process.
+
+    Args:
+        name (str): The name of the backend, also the name of its rate limiter and concurrency controller.
+        api_type (str): "azure" or "open_ai".
+        api_key (str): The API key.
+        api_base (str, optional): The endpoint. Defaults to the Azure or OpenAI endpoint depending on `api_type`.
+        api_version (str, optional): The Azure API version. Defaults to AZURE_API_VERSION for Azure.
+        engine (str, optional): The Azure deployment serving the chat model.
+        model (str, optional): The model name. Defaults to "gpt-3.5-turbo".
+        weight (float, optional): The share of the traffic the backend receives at full quota. Defaults to 1.
+        fallback (bool, optional): Whether prompts filtered by another backend are retried here. Defaults to
+            True for OpenAI and False for Azure, whose content filter is stricter.
+        rpm (int, optional): The requests per minute of the backend, if not already in DEPLOYMENT_LIMITS; see
+            `register_limits`.
+        tpm (int, optional): The tokens per minute of the backend, if not already in DEPLOYMENT_LIMITS.
+    """
+
+    def __init__(self, name: str, api_type: str, api_key: str, api_base: Optional[str] = None, api_version: Optional[str] = None,
+                 engine: Optional[str] = None, model: str = "gpt-3.5-turbo", weight: float = 1.0, fallback: Optional[bool] = None,
+                 rpm: Optional[int] = None, tpm: Optional[int] = None):
+        self.name = name
+        self.api_type = api_type
+        self.api_key = api_key
+        self.api_base = api_base or (AZURE_API_BASE if api_type == "azure" else OPENAI_API_BASE)
+        self.api_version = api_version or (AZURE_API_VERSION if api_type == "azure" else None)
+        self.engine = engine
+        self.model = model
+        self.weight = weight
+        self.fallback = api_type != "azure" if fallback is None else fallback
+        self.rpm = rpm
+        self.tpm = tpm
+
+    def register_limits(self):
+        """
+        Registers the rpm and tpm limits of the backend with the rate limiter, unless it is in DEPLOYMENT_LIMITS.
+
+        Raises:
+            ValueError: If the backend is not in DEPLOYMENT_LIMITS and lacks rpm or tpm.
+        """
+        if self.name in DEPLOYMENT_LIMITS:
+            return
+        if self.rpm is None or self.tpm is None:
+            raise ValueError(f"Error: backend {self.name} needs rpm and tpm limits.")
+        register_limits(self.name, self.rpm, self.tpm)
+
+    def request_kwargs(self) -> Dict[str, Any]:
+        """Returns the per-request arguments selecting this backend."""
+        kwargs = {"api_type": self.api_type, "api_key": self.api_key, "api_base": self.api_base, "model": self.model}
+        if self.api_version:
+            kwargs["api_version"] = self.api_version
+        if self.engine:
+            kwargs["engine"] = self.engine
+        return kwargs
+
+
+class BackendRouter:
+    """
+    Spreads chat requests over several backends by weight and remaining quota, and sends prompts refused by one
+    backend's content filter to the fallback backends.
+
+    Args:
+        backends (List[Backend]): The configured backends.
+    """
+
+    def __init__(self, backends: List[Backend]):
+        if not backends:
+            raise ValueError("Error: the router needs at least one backend.")
+        for backend in backends:
+            if not has_limits(backend.name):
+                raise ValueError(f"Error: backend {backend.name} has no rate limits; call its register_limits first.")
+        self.backends = backends
+
+    def choose(self, candidates: Optional[List[Backend]] = None) -> Backend:
+        """Picks a backend with probability proportional to its weight times the fraction of its quota left."""
+        candidates = candidates or self.backends
+        weights = [b.weight * get_limiter(b.name).headroom() for b in candidates]
+        if sum(weights) <= 0:
+            # Every backend is exhausted or paused; their rate limiters will make the request wait
+            weights = [b.weight for b in candidates]
+        return random.choices(candidates, weights)[0]
+
+    def _fallbacks(self, tried: List[Backend]) -> List[Backend]:
+        return [b for b in self.backends if b.fallback and b not in tried]
+
+    def chat_completion(self, messages: List[Dict[str, str]], temperature: float = 1, max_tokens: Optional[int] = None) -> str:
+        """
+        Sends a chat request to one of the backends.
+
+        Raises:
+            ContentFilteredError: If every backend that was tried filtered the prompt.
+            RetryError: If the chosen backend still fails after its retries.
+        """
+        tried = []
+        candidates = self.backends
+        while True:
+            backend = self.choose(candidates)
+            tried.append(backend)
+            try:
+                return chat_completion(messages, backend.name, temperature=temperature, max_tokens=max_tokens, **backend.request_kwargs())
+            except ContentFilteredError:
+                candidates = self._fallbacks(tried)
+                if not candidates:
+                    raise
+                print(f"Prompt filtered by {backend.name}, resorting to fallback backend")
+
+    async def achat_completion(self, messages: List[Dict[str, str]], temperature: float = 1, max_tokens: Optional[int] = None) -> str:
+        """Asynchronous version of `chat_completion`."""
+        tried = []
+        candidates = self.backends
+        while True:
+            backend = self.choose(candidates)
+            tried.append(backend)
+            try:
+                return await achat_completion(messages, backend.name, temperature=temperature, max_tokens=max_tokens, **backend.request_kwargs())
+            except ContentFilteredError:
+                candidates = self._fallbacks(tried)
+                if not candidates:
+                    raise
+                print(f"Prompt filtered by {backend.name}, resorting to fallback backend")
+
+
+def load_router(config_path: str = "config/config.json") -> BackendRouter:
+    """
+    Builds the router of the chat model from config/config.json.
+
+    The optional "backends" list holds the keyword arguments of every `Backend`. Without it, the Azure `llm-testing`
+    deployment (if "azure_api_key" is set) and the OpenAI key are used with equal weight.
+    """
+    with open(config_path, "r") as f:
+        config = json.load(f)
+    if "backends" in config:
+        backends = [Backend(**b) for b in config["backends"]]
+    else:
+        backends = []
+        if "azure_api_key" in config:
+            backends.append(Backend("llm-testing", "azure", config["azure_api_key"], api_base=config.get("azure_api_base"), engine="llm-testing"))
+        if "openai_api_key" in config:
+            backends.append(Backend("openai", "open_ai", config["openai_api_key"], api_base=config.get("openai_api_base")))
+    for backend in backends:
+        backend.register_limits()
+    return BackendRouter(backends)
+
+
+_router = None
+
+def get_router() -> BackendRouter:
+    """Returns the process-wide router, loaded from config/config.json on first use."""
+    global _router
+    if _router is None:
+        _router = load_router()
+    return _router
@@ -0,0 +1,252 @@
+"""Per-stage benchmark of the SCR pipeline on synthetic data.
+
+Generates synthetic datasets in the schema of ethics/processed/*.jsonl and runs test-input generation
+(mst.generate_test_inputs_from_jsonl), model calls (llm.critique against the local mock server), merging
+(utils.merge_jsonl_files) and analysis (analyze.valid_reflection) on them. Every stage runs in its own process, so the
+reported peak RSS belongs to that stage alone. Results are stored as JSON so runs can be compared over time.
+Typical usage example:
+  python benchmark.py run --sizes 1k 100k
+  python benchmark.py compare benchmarks/results/before.json benchmarks/results/after.json
+"""
+import os, sys, json, time, queue, random, argparse, resource, subprocess, contextlib
+import multiprocessing as mp
+from typing import Any, Callable, Dict, List, Optional
+
+import jsonlines
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKSPACE_DIR = os.path.join(REPO_DIR, "benchmarks", "workspace")
+RESULTS_DIR = os.path.join(REPO_DIR, "benchmarks", "results")
+SIZES = {"1k": 1000, "100k": 100000, "1m": 1000000}
+# Interval at which the parent checks that a stage process is still alive while waiting for its result
+RESULT_POLL_SECONDS = 1
+# Model calls are capped, since the mock server simulates real latency
+MAX_MODEL_RECORDS = 2000
+SOURCES = ["commonsense", "deontology", "justice", "virtue", "utilitarianism"]
+WORDS = (
+    "I my friend family work school money told asked decided refused helped borrowed promised lied shared "
+    "because although when after before should would could honest fair kind rude late early always never "
+    "neighbor coworker teacher parent sister brother boss stranger party dinner meeting exam car house dog"
+).split()
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def synthetic_text(rng: random.Random, min_words: int, max_words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))).capitalize() + "."
+
+
+def generate_dataset(num_records: int, data_dir: str, seed: int = 0) -> Dict[str, str]:
+    """
+    Writes a synthetic source file and the suggestion / critique / reflection stage outputs derived from it.
+
+    Returns:
+        Dict[str, str]: The paths of the generated files by stage.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    paths = {stage: os.path.join(data_dir, f"{stage}.jsonl") for stage in ("source", "suggestion", "critique", "reflection")}
+    if all(os.path.exists(p) for p in paths.values()):
+        return paths
+    rng = random.Random(seed)
+    writers = {stage: jsonlines.open(path, "w") for stage, path in paths.items()}
+    for _ in range(num_records):
+        text = synthetic_text(rng, 20, 120)
+        source = rng.choice(SOURCES)
+        suggestion = synthetic_text(rng, 30, 200)
+        critique = "<None>" if rng.random() < 0.4 else synthetic_text(rng, 20, 100)
+        reflection = rng.choice(["Yes, the critique is valid.", "No, I disagree with the critique."])
+        writers["source"].write({"text": text, "source": source, "original_text": text})
+        writers["suggestion"].write({"model": "chatgpt", "text": text, "source": source, "test_input": text, "test_output": suggestion})
+        writers["critique"].write({"model": "chatgpt", "test_input": "critique prompt", "context": text, "suggestion": suggestion, "critique": "", "test_output": critique})
+        writers["reflection"].write({"model": "chatgpt", "test_input": "reflection prompt", "context": text, "suggestion": suggestion, "critique": critique, "test_output": reflection})
+    for writer in writers.values():
+        writer.close()
+    return paths
+
+
+def prepare_workspace(mock_url: str) -> str:
+    """Creates a working directory with a config pointing at the mock server and the repository's prompts."""
+    os.makedirs(os.path.join(WORKSPACE_DIR, "config"), exist_ok=True)
+    with open(os.path.join(WORKSPACE_DIR, "config", "config.json"), "w") as f:
+        json.dump({"openai_api_key": "mock", "azure_api_key": "mock", "openai_api_base": f"{mock_url}/v1", "azure_api_base": f"{mock_url}/"}, f)
+    prompts = os.path.join(WORKSPACE_DIR, "prompts")
+    if not os.path.exists(prompts):
+        os.symlink(os.path.join(REPO_DIR, "prompts"), prompts)
+    return WORKSPACE_DIR
+
+
+def _child(stage_fn: Callable, args: tuple, results: mp.Queue):
+    try:
+        start = time.perf_counter()
+        extra = stage_fn(*args) or {}
+        elapsed = time.perf_counter() - start
+        # ru_maxrss is reported in kilobytes on Linux
+        results.put({"seconds": elapsed, "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, **extra})
+    except BaseException as e:
+        results.put({"error": repr(e)})
+
+
+def run_isolated(stage_fn: Callable, *args) -> Dict[str, Any]:
+    """
+    Runs one stage in a forked process and returns its wall time, peak RSS and stage-specific metrics, or an `error`
+    entry if the stage raised or its process died.
+    """
+    ctx = mp.get_context("fork")
+    results = ctx.Queue()
+    process = ctx.Process(target=_child, args=(stage_fn, args, results))
+    process.start()
+    while True:
+        try:
+            result = results.get(timeout=RESULT_POLL_SECONDS)
+            break
+        except queue.Empty:
+            if process.is_alive():
+                continue
+        # The child may have put its result right before exiting
+        try:
+            result = results.get(timeout=RESULT_POLL_SECONDS)
+        except queue.Empty:
+            result = {"error": f"stage process died with exit code {process.exitcode}"}
+        break
+    process.join()
+    return result
+
+
+def stage_testinput(paths: Dict[str, str], output_path: str):
+    import mst
+    mst.generate_test_inputs_from_jsonl(paths["source"], paths["suggestion"], output_path, mst.STAGE_CRITIQUE)
+
+
+def stage_model_calls(input_path: str, output_path: str, num_records: int, concurrency: int):
+    # Measure the raw client throughput: no cached responses and no quota
+    import response_cache, rate_limiter
+    response_cache.CACHE_ENABLED = False
+    rate_limiter.RATE_LIMIT_DIR = os.path.join(WORKSPACE_DIR, "rate_limits")
+    for limits in rate_limiter.DEPLOYMENT_LIMITS.values():
+        limits.update(rpm=10 ** 9, tpm=10 ** 12)
+    import concurrency_controller
+    concurrency_controller.get_controller("openai").set_limit(concurrency)
+    import llm
+
+    subset_path = input_path + f".first{num_records}"
+    with jsonlines.open(input_path) as reader, jsonlines.open(subset_path, "w") as writer:
+        for i, line in enumerate(reader):
+            if i >= num_records:
+                break
+            writer.write(line)
+    if os.path.exists(output_path):
+        os.remove(output_path)
+
+    latencies = []
+    achatgpt = llm.achatgpt
+
+    async def timed_achatgpt(text):
+        start = time.perf_counter()
+        try:
+            return await achatgpt(text)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    llm.achatgpt = timed_achatgpt
+    llm.critique(subset_path, output_path, continue_critique=False, concurrency=concurrency)
+    return {"records": num_records, "p50_latency_s": percentile(latencies, 50), "p99_latency_s": percentile(latencies, 99)}
+
+
+def stage_merge(paths: Dict[str, str], output_path: str):
+    import utils
+    utils.merge_jsonl_files({stage: paths[stage] for stage in ("source", "suggestion", "critique", "reflection")}, output_path)
+
+
+def stage_analysis(merged_path: str):
+    import analyze
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        analyze.valid_reflection(merged_path)
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes: List[str], concurrency: int, latency_ms: float, output_file: Optional[str] = None) -> str:
+    from mock_server import MockServer
+
+    results = {"revision": git_revision(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "concurrency": concurrency, "mock_latency_ms": latency_ms, "runs": {}}
+    with MockServer(latency_ms=latency_ms) as server:
+        workspace = prepare_workspace(server.url)
+        cwd = os.getcwd()
+        os.chdir(workspace)
+        sys.path.insert(0, REPO_DIR)
+        try:
+            for size in sizes:
+                num_records = SIZES[size]
+                data_dir = os.path.join(workspace, "data", size)
+                paths = generate_dataset(num_records, data_dir)
+                testinput_path = os.path.join(data_dir, "critique_input.jsonl")
+                stages = {
+                    "testinput": (stage_testinput, (paths, testinput_path), num_records),
+                    "model_calls": (stage_model_calls, (testinput_path, os.path.join(data_dir, "critique_output.jsonl"), min(num_records, MAX_MODEL_RECORDS), concurrency), min(num_records, MAX_MODEL_RECORDS)),
+                    "merge": (stage_merge, (paths, os.path.join(data_dir, "merged.jsonl")), num_records),
+                    "analysis": (stage_analysis, (os.path.join(data_dir, "merged.jsonl"),), num_records),
+                }
+                results["runs"][size] = {}
+                for name, (stage_fn, args, records) in stages.items():
+                    metrics = run_isolated(stage_fn, *args)
+                    if "seconds" in metrics:
+                        metrics["records_per_s"] = records / metrics["seconds"] if metrics["seconds"] else None
+                    results["runs"][size][name] = metrics
+                    print(f"[{size}] {name}: {json.dumps(metrics)}")
+        finally:
+            os.chdir(cwd)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    output_file = output_file or os.path.join(RESULTS_DIR, f"{results['timestamp'].replace(':', '')}.json")
+    with open(output_file, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output_file}")
+    return output_file
+
+
+def compare(baseline_file: str, candidate_file: str):
+    """Prints the throughput and peak RSS ratio of every stage in two result files."""
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    with open(candidate_file) as f:
+        candidate = json.load(f)
+    print(f"Baseline: {baseline.get('revision')}  Candidate: {candidate.get('revision')}")
+    for size, stages in candidate["runs"].items():
+        for stage, metrics in stages.items():
+            base = baseline["runs"].get(size, {}).get(stage)
+            if not base or "records_per_s" not in base or "records_per_s" not in metrics:
+                continue
+            speedup = metrics["records_per_s"] / base["records_per_s"]
+            memory = metrics["peak_rss_mb"] / base["peak_rss_mb"]
+            print(f"[{size}] {stage:12s} throughput x{speedup:.2f}  peak RSS x{memory:.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the SCR pipeline stages on synthetic data")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES), help="dataset sizes to benchmark")
+    run_parser.add_argument("--concurrency", type=int, default=200, help="requests in flight for the model-call stage")
+    run_parser.add_argument("--latency_ms", type=float, default=200.0, help="median latency of the mock server")
+    run_parser.add_argument("--output_file", "-o", type=str, help="path of the result JSON file")
+
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument("baseline_file", type=str)
+    compare_parser.add_argument("candidate_file", type=str)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args.sizes, args.concurrency, args.latency_ms, args.output_file)
+    elif args.command == "compare":
+        compare(args.baseline_file, args.candidate_file)
@@ -1,18 +1,26 @@
 import argparse
-import openai, time, json, os
+import openai, json, os
 import jsonlines, tqdm, copy
 from typing import List, Dict, Any, Set
-import multiprocessing as mp
+from engine import AsyncEngine
+from output_sink import OutputSink
+from completion_index import CompletionIndex
+from prompt_template import load_template
+from telemetry import set_context
+from model_client import chat_completion
+from retry import RetryError, ContentFilteredError
 
 # Set up OpenAI API credentials by reading from config/config.json
 with open("config/config.json", "r") as f:
     config = json.load(f)
     openai.api_key = config["openai_api_key"]
+    # Point the client at a different endpoint, e.g. the local mock server
+    if "openai_api_base" in config:
+        openai.api_base = config["openai_api_base"]
 
-# Define constants for retrying requests
-MAX_RETRIES = 5
-RETRY_DELAY_SECONDS = 2
 MODEL = "chatgpt"
+# Maximum number of requests in flight
+CONCURRENCY = 200
 
 def find_first_digit(s):
     return next((c for c in s if c.isdigit()), None)
@@ -30,43 +38,33 @@ def chatgpt(text):
     Raises:
         Exception: If there is an error while making the API request.
     """
-    for retry in range(MAX_RETRIES):
-        try:
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo", temperature=1, 
-                messages=[
-                        {"role": "system", "content": "You should adhere to the instruction of the user."},
-                        {"role": "user", "content": text},
-                    ]
-                )
-            return response["choices"][0]["message"]["content"]
-        except Exception as e:
-            if retry < MAX_RETRIES - 1:
-                print(f"Error making Chat request: {e}. Retrying in {RETRY_DELAY_SECONDS} seconds...")
-                time.sleep(RETRY_DELAY_SECONDS)
-            else:
-                raise e
-
-def process_one(prompt_text, output_file, lock):
+    messages = [
+        {"role": "system", "content": "You should adhere to the instruction of the user."},
+        {"role": "user", "content": text},
+    ]
+    return chat_completion(messages, "openai", temperature=1, model="gpt-3.5-turbo")
+
+def process_one(prompt_text, sink):
     """
     Processes one prompt and writes the output to the output file.
 
     Args:
         prompt_text (str): The prompt text to process.
-        output_file (str): The path to the output file.
-        lock (Lock): The lock to use to write to the output file.
+        sink (OutputSink): The writer of the output file.
     """
     # Generate the output
-    output = chatgpt(prompt_text)
-    # Write the output to the output file
-    with lock:
-        with jsonlines.open(output_file, "a") as f:
-            f.write({
-                "text": prompt_text,
-                "output": output
-            })
-
-def compare_suggestion(initial_suggestion_path, refined_suggestion_path, output_file):
+    try:
+        output = chatgpt(prompt_text)
+    except (RetryError, ContentFilteredError) as e:
+        print(f"Skipping comparison: {e}")
+        return
+    # Hand the output to the writer thread
+    sink.write({
+        "text": prompt_text,
+        "output": output
+    })
+
+def compare_suggestion(initial_suggestion_path, refined_suggestion_path, output_file, concurrency=CONCURRENCY):
     """
     Compares the initial suggestion with the refined suggestion and returns the accuracy.
 
@@ -74,10 +72,13 @@ def compare_suggestion(initial_suggestion_path, refined_suggestion_path, output_
         initial_suggestion_path (str): The path to the initial suggestion file.
         refined_suggestion_path (str): The path to the refined suggestion file.
         output_file (str): The path to the output file.
+        concurrency (int, optional): The maximum number of requests in flight. Defaults to CONCURRENCY.
 
     Returns:
         float: The accuracy of the refined suggestion.
     """
+    # Account the model calls of this run to the comparison and its input file
+    set_context("compare_suggestion", refined_suggestion_path)
     # Load the initial suggestion file
     with jsonlines.open(initial_suggestion_path, "r") as f:
         initial_suggestions = list(f)
@@ -85,13 +86,9 @@ def compare_suggestion(initial_suggestion_path, refined_suggestion_path, output_
     # Load the refined suggestion file
     with jsonlines.open(refined_suggestion_path, "r") as f:
         refined_suggestions = list(f)[:100]
-    with open("prompts/compare_suggestion.prompt", "r") as f:
-        prompt = f.read()
-    if os.path.exists(output_file):
-        with jsonlines.open(output_file, "r") as f:
-            completed_comparisons = set([comparison["text"] for comparison in list(f)])
-    else:
-        completed_comparisons = set()
+    template = load_template("prompts/compare_suggestion.prompt")
+    # The sidecar index holds the comparisons already made, so resuming never reads the output file
+    index = CompletionIndex(output_file, "text")
     
     # Compute the accuracy
     comparisons = []
@@ -107,23 +104,20 @@ def compare_suggestion(initial_suggestion_path, refined_suggestion_path, output_
         initial_suggestion = initial_suggestions[suggestion_index[context]]
         init_sugg_text = initial_suggestion["test_output"]
         refined_sugg_text = refined_suggestion["test_output"]
-        prompt_text = prompt.replace("$context$", context)
-        prompt_text = prompt_text.replace("$init_suggestion$", init_sugg_text)
-        prompt_text = prompt_text.replace("$refined_suggestion$", refined_sugg_text)
-        if prompt_text not in completed_comparisons: comparisons.append(prompt_text)
-    # Create a multiprocessing pool
-    pool: mp.Pool = mp.Pool(processes=10)
-    # Create a Manager to share the lock between processes
-    manager = mp.Manager()
-    lock = manager.Lock()
-
-    # Use a partial function to pass the output_file and lock arguments to process_datum
+        prompt_text = template.fill({"context": context, "init_suggestion": init_sugg_text, "refined_suggestion": refined_sugg_text})
+        comparisons.append(prompt_text)
+    comparisons = list(index.pending(comparisons))
+    # A single writer thread appends the output lines, so workers never wait on the file
     from functools import partial
-    process_datum_with_output_file_and_lock = partial(process_one, output_file=output_file, lock=lock)
+    with OutputSink(output_file, index=index) as sink:
+        process_datum_with_sink = partial(process_one, sink=sink)
 
-    # Rewrite the data in parallel and append the output lines to the output file dynamically
-    for _ in tqdm.tqdm(pool.imap(process_datum_with_output_file_and_lock, comparisons), total=len(comparisons)):
-        pass
+        # Rewrite the data concurrently and append the output lines to the output file dynamically
+        with AsyncEngine(concurrency) as engine:
+            progress = tqdm.tqdm(engine.imap(process_datum_with_sink, comparisons), total=len(comparisons))
+            for _ in progress:
+                progress.set_postfix(write_lag=sink.lag()["pending"], refresh=False)
+    index.close()
 
 def compute_accuracy(output_file):
     """
@@ -158,9 +152,10 @@ if __name__ == "__main__":
     parser.add_argument("--initial_suggestion_path", '-i', type=str, help="The path to the initial suggestion file.")
     parser.add_argument("--refined_suggestion_path", '-r', type=str, help="The path to the refined suggestion file.")
     parser.add_argument("--output_file", '-o', type=str, help="The path to the output file.")
+    parser.add_argument("--concurrency", '-c', type=int, default=CONCURRENCY, help="The maximum number of requests in flight.")
     args = parser.parse_args()
     # Compare the initial suggestions with the refined suggestions
-    compare_suggestion(args.initial_suggestion_path, args.refined_suggestion_path, args.output_file)
+    compare_suggestion(args.initial_suggestion_path, args.refined_suggestion_path, args.output_file, args.concurrency)
     # Compute the accuracy
     accuracy = compute_accuracy(args.output_file)
     print(f"Accuracy: {accuracy}")
\ No newline at end of file
@@ -0,0 +1,169 @@
+import os, json, sqlite3, hashlib, threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+# Suffix of the sidecar index next to every output file
+INDEX_SUFFIX = ".index.sqlite"
+# Number of keys looked up per query when filtering inputs
+LOOKUP_CHUNK_SIZE = 512
+
+
+def prompt_hash(text: str) -> bytes:
+    """Returns the 16-byte hash under which a prompt is stored in the index."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+class CompletionIndex:
+    """
+    A sidecar index of the prompts already answered in an output JSONL file.
+
+    The index is a small sqlite file next to the output holding one 16-byte hash and the line offset of every
+    completed record, plus the byte offset of the output it covers. On opening, any output appended since (e.g. by an
+    older version of the scripts or a run that crashed before updating the index) is indexed by reading from that
+    offset, and a truncated or replaced output file is re-indexed from scratch. `OutputSink` updates the index after every batch it writes,
+    so resuming a run never scans the output file itself; `get` reads back the single record of a prompt.
+
+    Args:
+        output_file (str): The output JSONL file.
+        field (str): The field of the output records identifying the prompt, e.g. "test_input".
+    """
+
+    def __init__(self, output_file: str, field: str):
+        self.output_file = output_file
+        self.field = field
+        self.path = output_file + INDEX_SUFFIX
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(completed)")]
+        if columns and "offset" not in columns:
+            # Index of an older version without line offsets; rebuilt from scratch by the sync below
+            self._conn.execute("DROP TABLE completed")
+            self._conn.execute("DELETE FROM meta")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS completed (hash BLOB PRIMARY KEY, offset INTEGER) WITHOUT ROWID")
+        self._conn.commit()
+        self.sync()
+
+    def _meta(self, key: str, default: Any = None) -> Any:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, **values):
+        self._conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", list(values.items()))
+
+    def sync(self):
+        """Brings the index up to date with the output file."""
+        with self._lock:
+            if not os.path.exists(self.output_file):
+                self._reset(None)
+                return
+            stat = os.stat(self.output_file)
+            offset = self._meta("offset", 0)
+            if self._meta("field") != self.field or self._meta("inode") != stat.st_ino or stat.st_size < offset:
+                self._reset(stat.st_ino)
+                offset = 0
+            if stat.st_size == offset:
+                return
+            print(f"Indexing {stat.st_size - offset} bytes of {self.output_file}...")
+            with open(self.output_file, "rb") as f:
+                f.seek(offset)
+                hashes = []
+                for line in f:
+                    # A partial last line is picked up by the next sync once it is complete
+                    if not line.endswith(b"\n"):
+                        break
+                    start = offset
+                    offset += len(line)
+                    try:
+                        hashes.append((prompt_hash(json.loads(line)[self.field]), start))
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    if len(hashes) >= LOOKUP_CHUNK_SIZE * 16:
+                        self._conn.executemany("INSERT OR IGNORE INTO completed (hash, offset) VALUES (?, ?)", hashes)
+                        hashes = []
+                self._conn.executemany("INSERT OR IGNORE INTO completed (hash, offset) VALUES (?, ?)", hashes)
+            self._set_meta(offset=offset)
+            self._conn.commit()
+
+    def _reset(self, inode: Optional[int]):
+        self._conn.execute("DELETE FROM completed")
+        self._set_meta(field=self.field, inode=inode, offset=0)
+        self._conn.commit()
+
+    def add(self, records: List[Dict[str, Any]], offset: int, starts: Optional[List[int]] = None):
+        """
+        Marks the prompts of `records` as completed; called once they are flushed to the output file.
+
+        Args:
+            records (List[Dict[str, Any]]): The records just written.
+            offset (int): The size of the output file after writing them.
+            starts (Optional[List[int]], optional): The offset of the line of every record, used by `get`. Defaults to
+                None, in which case `get` does not find them.
+        """
+        starts = starts or [None] * len(records)
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO completed (hash, offset) VALUES (?, ?)",
+                                   [(prompt_hash(r[self.field]), start) for r, start in zip(records, starts)])
+            if self._meta("inode") is None:
+                self._set_meta(inode=os.stat(self.output_file).st_ino)
+            self._set_meta(offset=offset)
+            self._conn.commit()
+
+    def __contains__(self, text: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM completed WHERE hash = ?", (prompt_hash(text),)).fetchone() is not None
+
+    def get(self, text: str) -> Optional[Dict[str, Any]]:
+        """
+        Reads back the record of a completed prompt from the output file.
+
+        Returns:
+            Optional[Dict[str, Any]]: The first record written for `text`, or None if it is not completed or its line
+                offset is unknown.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT offset FROM completed WHERE hash = ?", (prompt_hash(text),)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        with open(self.output_file, "rb") as f:
+            f.seek(row[0])
+            line = f.readline()
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return None
+        return record if record.get(self.field) == text else None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM completed").fetchone()[0]
+
+    def pending(self, items: Iterable[Any], key: Callable[[Any], str] = lambda item: item) -> Iterator[Any]:
+        """
+        Yields the items whose prompt is not in the index yet, looking them up in chunks.
+
+        Args:
+            items (Iterable[Any]): The input items, e.g. records read from the input file.
+            key (Callable[[Any], str], optional): Returns the prompt of an item. Defaults to the item itself.
+        """
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == LOOKUP_CHUNK_SIZE:
+                yield from self._pending_chunk(chunk, key)
+                chunk = []
+        yield from self._pending_chunk(chunk, key)
+
+    def _pending_chunk(self, chunk: List[Any], key: Callable[[Any], str]) -> List[Any]:
+        if not chunk:
+            return []
+        hashes = [prompt_hash(key(item)) for item in chunk]
+        with self._lock:
+            query = f"SELECT hash FROM completed WHERE hash IN ({','.join('?' * len(hashes))})"
+            completed = {row[0] for row in self._conn.execute(query, hashes)}
+        return [item for item, h in zip(chunk, hashes) if h not in completed]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,259 @@
+import os, re, time, asyncio, threading, contextlib
+from typing import Any, Dict, Optional, Tuple
+
+from rate_limiter import get_limiter
+
+# Bounds of the number of requests in flight per deployment
+INITIAL_CONCURRENCY = 16
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 512
+# Multiplicative decrease applied to the allowed concurrency on a throttling signal
+DECREASE_FACTOR = 0.5
+# Seconds all workers back off after a throttling signal without a retry-after hint
+DEFAULT_RETRY_AFTER = 10
+# Slots freed by other processes cannot wake the waiters of this one, so waiters re-check the shared window this often
+SHARED_POLL_SECONDS = 0.5
+
+
+def parse_retry_after(error: Exception) -> Optional[float]:
+    """
+    Extracts the server's retry-after hint from an API error.
+
+    The `Retry-After` header is used if the error carries one, otherwise the "Please retry after N seconds" message of
+    Azure OpenAI is parsed.
+
+    Returns:
+        Optional[float]: The number of seconds to wait, or None if the error has no hint.
+    """
+    headers = getattr(error, "headers", None)
+    if headers:
+        for name in ("retry-after", "Retry-After"):
+            try:
+                return float(headers[name])
+            except (KeyError, TypeError, ValueError):
+                pass
+    match = re.search(r"retry after (\d+(?:\.\d+)?) second", str(error), re.IGNORECASE)
+    if match:
+        return float(match.group(1))
+    return None
+
+
+def is_throttled(error: Exception) -> bool:
+    """Returns whether an API error means that the deployment is over its quota."""
+    return type(error).__name__ == "RateLimitError" or getattr(error, "http_status", None) == 429
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ConcurrencyController:
+    """
+    An AIMD controller of the number of requests in flight to one deployment, shared by every worker on the host.
+
+    Each success grows the allowed concurrency additively by about one slot per window of requests; each throttling
+    signal halves it and pauses the deployment's shared rate limiter for the server's retry-after hint, so all workers
+    back off together instead of only the one that was throttled. The window and the requests in flight of every
+    process are stored in the rate limiter's state file under its lock, so all processes share one window; the slots
+    of a process that died are dropped.
+
+    Args:
+        name (str): The deployment name, as configured in `rate_limiter.DEPLOYMENT_LIMITS`.
+        initial (int, optional): The initial allowed concurrency. Defaults to INITIAL_CONCURRENCY.
+        minimum (int, optional): The lower bound of the allowed concurrency. Defaults to MIN_CONCURRENCY.
+        maximum (int, optional): The upper bound of the allowed concurrency. Defaults to MAX_CONCURRENCY.
+    """
+
+    def __init__(self, name: str, initial: int = INITIAL_CONCURRENCY, minimum: int = MIN_CONCURRENCY, maximum: int = MAX_CONCURRENCY):
+        self.name = name
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self._limiter = get_limiter(name)
+        # Wakes the waiters of this process when one of its requests frees a slot
+        self._condition = threading.Condition()
+        self._async_waiters = []
+
+    def _window(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        window = state.setdefault("concurrency", {"limit": float(self.initial), "last_decrease": 0.0, "in_flight": {}})
+        # json turns the pid keys into strings
+        window["in_flight"] = {pid: n for pid, n in window["in_flight"].items() if n > 0 and _alive(int(pid))}
+        return window
+
+    def _allowed(self, window: Dict[str, Any]) -> int:
+        return max(self.minimum, int(window["limit"]))
+
+    @property
+    def allowed(self) -> int:
+        """The number of requests currently allowed in flight."""
+        return self._limiter.update_state(lambda state: self._allowed(self._window(state)))
+
+    @property
+    def in_flight(self) -> int:
+        """The number of requests in flight on the host."""
+        return self._limiter.update_state(lambda state: sum(self._window(state)["in_flight"].values()))
+
+    def set_limit(self, limit: float):
+        """Sets the allowed concurrency of every process, e.g. to benchmark a fixed concurrency."""
+        def update(state: Dict[str, Any]):
+            self._window(state)["limit"] = float(limit)
+        self._limiter.update_state(update)
+
+    def _try_acquire(self) -> Tuple[bool, bool]:
+        """Takes a slot if one is free; returns whether it did and whether another one is still free."""
+        def update(state: Dict[str, Any]) -> Tuple[bool, bool]:
+            window = self._window(state)
+            in_flight = sum(window["in_flight"].values())
+            if in_flight >= self._allowed(window):
+                return False, False
+            pid = str(os.getpid())
+            window["in_flight"][pid] = window["in_flight"].get(pid, 0) + 1
+            return True, in_flight + 1 < self._allowed(window)
+        return self._limiter.update_state(update)
+
+    def _wake_one(self):
+        """Wakes one waiting thread and one waiting coroutine of this process."""
+        with self._condition:
+            self._condition.notify()
+            while self._async_waiters:
+                loop, future = self._async_waiters.pop(0)
+                if not future.done() and not loop.is_closed():
+                    loop.call_soon_threadsafe(_wake, future)
+                    break
+
+    def acquire(self):
+        """Blocks until a request slot is free and takes it."""
+        while True:
+            with self._condition:
+                acquired, more = self._try_acquire()
+                if acquired:
+                    break
+                self._condition.wait(SHARED_POLL_SECONDS)
+        if more:
+            self._wake_one()
+
+    async def aacquire(self):
+        """Asynchronous version of `acquire`."""
+        loop = asyncio.get_running_loop()
+        while True:
+            # Registered before the attempt, so a slot freed in between is not missed
+            future = loop.create_future()
+            with self._condition:
+                self._async_waiters.append((loop, future))
+            # The state file is locked across processes, so it must not be read on the event loop
+            attempt = loop.run_in_executor(None, self._try_acquire)
+            try:
+                acquired, more = await asyncio.shield(attempt)
+            except asyncio.CancelledError:
+                # The attempt still finishes in its thread; a slot it takes has no owner, so give it back
+                future.cancel()
+                attempt.add_done_callback(self._give_back_abandoned)
+                raise
+            if acquired:
+                future.cancel()
+                break
+            try:
+                await asyncio.wait_for(future, SHARED_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+        if more:
+            self._wake_one()
+
+    def _give_back(self):
+        """Frees a request slot without reporting an outcome, e.g. for a cancelled request."""
+        def update(state: Dict[str, Any]):
+            window = self._window(state)
+            pid = str(os.getpid())
+            window["in_flight"][pid] = max(window["in_flight"].get(pid, 0) - 1, 0)
+        self._limiter.update_state(update)
+        self._wake_one()
+
+    def _give_back_abandoned(self, attempt: asyncio.Future):
+        if not attempt.cancelled() and attempt.exception() is None and attempt.result()[0]:
+            attempt.get_loop().run_in_executor(None, self._give_back)
+
+    def release(self, error: Optional[Exception] = None):
+        """
+        Frees a request slot and adapts the allowed concurrency to the outcome of the request.
+
+        Args:
+            error (Optional[Exception], optional): The error raised by the request, or None on success.
+        """
+        throttled = error is not None and is_throttled(error)
+        retry_after = parse_retry_after(error) if throttled else None
+
+        def update(state: Dict[str, Any]):
+            window = self._window(state)
+            pid = str(os.getpid())
+            window["in_flight"][pid] = max(window["in_flight"].get(pid, 0) - 1, 0)
+            if error is None:
+                window["limit"] = min(self.maximum, window["limit"] + 1 / window["limit"])
+            elif throttled:
+                now = time.time()
+                # Requests already in flight report the same overload; only decrease once per backoff period
+                if now - window["last_decrease"] > (retry_after or 1):
+                    window["limit"] = max(self.minimum, window["limit"] * DECREASE_FACTOR)
+                    window["last_decrease"] = now
+                state["paused_until"] = max(state.get("paused_until", 0), now + (DEFAULT_RETRY_AFTER if retry_after is None else retry_after))
+        self._limiter.update_state(update)
+        self._wake_one()
+
+    async def arelease(self, error: Optional[Exception] = None):
+        """Asynchronous version of `release`."""
+        await asyncio.get_running_loop().run_in_executor(None, self.release, error)
+
+    @contextlib.contextmanager
+    def request(self):
+        """Holds a request slot for the duration of the block and reports its outcome."""
+        self.acquire()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            # A cancellation or interrupt (a BaseException) frees the slot but says nothing about the server's load
+            if error is None or isinstance(error, Exception):
+                self.release(error)
+            else:
+                self._give_back()
+
+    @contextlib.asynccontextmanager
+    async def arequest(self):
+        """Asynchronous version of `request`."""
+        await self.aacquire()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            # The executor finishes the release even if this task is cancelled again while awaiting it
+            if error is None or isinstance(error, Exception):
+                await self.arelease(error)
+            else:
+                await asyncio.get_running_loop().run_in_executor(None, self._give_back)
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+_controllers: Dict[str, ConcurrencyController] = {}
+_controllers_lock = threading.Lock()
+
+def get_controller(deployment: str) -> ConcurrencyController:
+    """Returns the concurrency controller of a deployment, created once per process."""
+    with _controllers_lock:
+        if deployment not in _controllers:
+            _controllers[deployment] = ConcurrencyController(deployment)
+        return _controllers[deployment]
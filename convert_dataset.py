@@ -1,80 +1,68 @@
 import openai
 import pandas as pd
-import os, time
+import os
 import jsonlines
 import tqdm, json
 from typing import List, Dict, Any
-import multiprocessing as mp
+from model_client import completion
+from backend_router import get_router
+from engine import AsyncEngine
+from output_sink import OutputSink
+from completion_index import CompletionIndex
+from prompt_template import load_template
+from telemetry import set_context
+
+# Number of rewrites in flight; the router spreads them over the Azure and OpenAI backends
+CONCURRENCY = 30
 
 # Set up OpenAI API credentials by reading from config/config.json
 
 def change_backend(backend: str="azure"):
 
+    with open("config/config.json", "r") as f:
+        config = json.load(f)
     if backend == "azure":
         import openai
         openai.api_type = "azure"
-        openai.api_base = "https://llm-testing.openai.azure.com/"
+        openai.api_base = config.get("azure_api_base", "https://llm-testing.openai.azure.com/")
         openai.api_version = "2023-03-15-preview"
-        openai.api_key = "<API_KEY>"
+        openai.api_key = config.get("azure_api_key", "<API_KEY>")
     else:
         import openai
-        with open("config/config.json", "r") as f:
-            config = json.load(f)
-            openai.api_key = config["openai_api_key"]
+        openai.api_type = "open_ai"
+        openai.api_base = config.get("openai_api_base", "https://api.openai.com/v1")
+        openai.api_version = None
+        openai.api_key = config["openai_api_key"]
 
+# The GPT-3 path still uses the global credentials; chat requests carry their own through the router
 change_backend("")
 
 def statement_rewriter(statement: str, model: str="chatgpt") -> str:
-    # open situation2context.prompt file and read the prompt
-    
+    # read the situation2context.prompt file once per process
     try:
-        with open("prompts/situation2context.prompt", "r") as f:
-            prompt: str = f.read()
-    except:
+        prompt: str = load_template("prompts/situation2context.prompt").text
+    except IOError:
         raise Exception("Error: could not read the prompt file.")
 
     # Use GPT-3 to rewrite the statement
     if model == "gpt3":
         try:
-            response: str = openai.Completion.create(engine="text-davinci-003", temperature=1.0, prompt=prompt + "\n" + statement + "\n", max_tokens=1024)["choices"][0]["text"]
+            response: str = completion(prompt + "\n" + statement + "\n", "openai", temperature=1.0, max_tokens=1024, engine="text-davinci-003")
         except:
             raise Exception("Error: could not get response from OpenAI API.")
 
     # Use GPT-3.5 Turbo to rewrite the statement
     if model == "chatgpt":
-        retry = 0
-        while retry < 10:
-            try:
-                if openai.api_type == "azure":
-                    response = openai.ChatCompletion.create(
-                      engine="llm-testing",model="gpt-3.5-turbo", temperature=1, 
-                      messages=[
-                            {"role": "system", "content": prompt},
-                            {"role": "user", "content": statement},
-                        ]
-                    )["choices"][0]["message"]["content"]
-                else:
-                    response: str = openai.ChatCompletion.create(
-                        model="gpt-3.5-turbo", temperature=1, 
-                        messages=[
-                                {"role": "system", "content": prompt},
-                                {"role": "user", "content": statement},
-                            ]
-                        )["choices"][0]["message"]["content"]
-                break
-            except Exception as e:
-                if "The response was filtered due to the prompt" in str(e):
-                    change_backend("openai")
-                    resp = statement_rewriter(statement, model)
-                    print("Resort to openai backend", repr(resp))
-                    change_backend("azure")
-                    return resp
-                time.sleep(5)
-                # raise Exception("Error: could not get response from OpenAI API.")
-                retry += 1
-    if retry == 10:
-        print("The response was failed after ten attempts", repr(statement))
-        return None
+        messages = [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": statement},
+        ]
+        try:
+            # Filtered prompts are resent to the OpenAI backend by the router
+            response: str = get_router().chat_completion(messages, temperature=1)
+        except Exception as e:
+            print(f"The response was failed after retries ({e})", repr(statement))
+            return None
 
     return response
 
@@ -148,25 +136,25 @@ def convert2jsonl():
         writer.write_all(test_hard_df)
     print("Done writing train, test and test_hard datasets to jsonl files")
 
-def process_datum(datum: dict, output_file, lock) -> dict:
+def process_datum(datum: dict, sink) -> dict:
     datum["original_text"] = datum["text"]
     datum["text"] = statement_rewriter(datum["text"])
 
     if datum["text"] is None:
         return
         
-    # Append the output line to the output file with the lock
-    with lock:
-        with jsonlines.open(output_file, mode='a') as writer:
-            writer.write(datum)
+    # Hand the output line to the writer thread
+    sink.write(datum)
 
-def rewrite_dataset(jsonl_file: str, rewrite_num: int, continue_rewrite: bool=True):
+def rewrite_dataset(jsonl_file: str, rewrite_num: int, continue_rewrite: bool=True, concurrency: int=CONCURRENCY):
     """
     This function takes in a jsonl file and a number of
     data points to rewrite. It opens the file, reads in
     the data, rewrites the data, and writes the rewritten
     data to a new file.
     """
+    # Account the model calls of this run to the rewrite stage and its input file
+    set_context("rewrite", jsonl_file)
     # Open the jsonl file
     with jsonlines.open(jsonl_file, "r") as reader:
         # Read the data into a list
@@ -180,30 +168,25 @@ def rewrite_dataset(jsonl_file: str, rewrite_num: int, continue_rewrite: bool=Tr
     # that we will rewrite.
     print("Continuing rewrite:", continue_rewrite)
     print("Rewrite file path:", rewrite_file_path, "exists:", os.path.exists(rewrite_file_path))
+    # The sidecar index holds the statements already rewritten, so resuming never reads the rewritten file
+    index = CompletionIndex(rewrite_file_path, "original_text")
     if continue_rewrite and os.path.exists(rewrite_file_path):
-        # Open the existing rewritten jsonl file
-        with jsonlines.open(rewrite_file_path, "r") as reader:
-            # Read the data into a list
-            rewritten_data: List[Dict[str, Any]] = list(reader)
-        completed_data = set([datum["original_text"] for datum in rewritten_data])
-        data = [datum for datum in data if datum["text"] not in completed_data]
+        data = list(index.pending(data, key=lambda datum: datum["text"]))
         print(f"Continuing rewrite. A total {len(data)} data points to rewrite.")
-    # Create a multiprocessing pool
-    pool: mp.Pool = mp.Pool(processes=15)
     # Rewrite the data in parallel
     if rewrite_num != -1:
         data = data[:rewrite_num]
-    # Create a Manager to share the lock between processes
-    manager = mp.Manager()
-    lock = manager.Lock()
-
-    # Use a partial function to pass the output_file and lock arguments to process_datum
+    # A single writer thread appends the output lines, so workers never wait on the file
     from functools import partial
-    process_datum_with_output_file_and_lock = partial(process_datum, output_file=rewrite_file_path, lock=lock)
-
-    # Rewrite the data in parallel and append the output lines to the output file dynamically
-    for _ in tqdm.tqdm(pool.imap(process_datum_with_output_file_and_lock, data), total=len(data)):
-        pass
+    with OutputSink(rewrite_file_path, index=index) as sink:
+        process_datum_with_sink = partial(process_datum, sink=sink)
+
+        # Rewrite the data in parallel and append the output lines to the output file dynamically
+        with AsyncEngine(concurrency) as engine:
+            progress = tqdm.tqdm(engine.imap(process_datum_with_sink, data), total=len(data))
+            for _ in progress:
+                progress.set_postfix(write_lag=sink.lag()["pending"], refresh=False)
+    index.close()
 
 if __name__ == "__main__":
     # main()
@@ -0,0 +1,148 @@
+"""Cosine drift between the initial suggestions and their refinements.
+
+Embeds every suggestion and refinement of a refine or consolidate file in one cached, batched pass and writes the
+cosine distance of each pair back as a `distance_<embedder>` column. Distances of different embedders are not
+comparable, so manual_inspection.py only uses `distance_openai` to prefilter the records whose refinement barely
+changed the suggestion.
+Typical usage example:
+  python drift.py -i outputs/chatgpt/refine.jsonl
+  python drift.py -i outputs/chatgpt/consolidate.jsonl -o consolidate_with_distance.jsonl --embedder minilm
+"""
+import os, json, argparse
+from typing import Any, Callable, Dict, List, Optional
+
+import jsonlines
+import numpy as np
+
+# Refinements whose text-embedding-ada-002 distance to their suggestion is below this are inspected by
+# manual_inspection.py
+MAX_DRIFT_DISTANCE = 0.05
+
+
+def _openai_embeddings(texts: List[str]) -> np.ndarray:
+    from openai_embedding import get_embeddings
+    return get_embeddings(texts, show_progress=True)
+
+def _minilm_embeddings(texts: List[str]) -> np.ndarray:
+    from embedding import generate_embeddings
+    return generate_embeddings(texts)
+
+# Embedding functions by name; both go through the embedding cache
+EMBEDDERS: Dict[str, Callable[[List[str]], np.ndarray]] = {
+    "openai": _openai_embeddings,
+    "minilm": _minilm_embeddings,
+}
+
+
+def distance_column(embedder: str) -> str:
+    """Returns the name of the column holding the distances computed with `embedder`."""
+    return f"distance_{embedder}"
+
+# The column MAX_DRIFT_DISTANCE applies to
+DISTANCE_COLUMN = distance_column("openai")
+
+
+def cosine_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Computes the cosine distance between the rows of two matrices.
+
+    Args:
+        a (np.ndarray): A matrix of embeddings.
+        b (np.ndarray): A matrix of embeddings of the same shape.
+
+    Returns:
+        np.ndarray: 1 - cos(a[i], b[i]) for every row i; rows of zeros are at distance 1.
+    """
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    dots = np.einsum("ij,ij->i", a, b)
+    # Rounding can push the cosine of near-identical vectors above 1
+    return np.clip(1 - np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0), 0.0, 2.0)
+
+
+def suggestion_distances(suggestions: List[str], refinements: List[str],
+                         embed: Callable[[List[str]], np.ndarray] = _openai_embeddings) -> List[Optional[float]]:
+    """
+    Computes the cosine distance between every suggestion and its refinement.
+
+    Args:
+        suggestions (List[str]): The initial suggestions.
+        refinements (List[str]): The refined suggestions, in the same order.
+        embed (Callable[[List[str]], np.ndarray], optional): Embeds a list of texts in one call. Defaults to the
+            cached OpenAI embeddings of openai_embedding.py.
+
+    Returns:
+        List[Optional[float]]: The distance of every pair, None where either text is empty.
+    """
+    pairs = [i for i, (suggestion, refinement) in enumerate(zip(suggestions, refinements)) if suggestion.strip() and refinement.strip()]
+    distances: List[Optional[float]] = [None] * len(suggestions)
+    if not pairs:
+        return distances
+    # One call for all texts; repeated suggestions are embedded once
+    vectors = embed([suggestions[i] for i in pairs] + [refinements[i] for i in pairs])
+    for i, distance in zip(pairs, cosine_distances(vectors[:len(pairs)], vectors[len(pairs):]).tolist()):
+        distances[i] = distance
+    return distances
+
+
+def add_distances(data: List[Dict[str, Any]], embed: Callable[[List[str]], np.ndarray] = _openai_embeddings,
+                  column: str = DISTANCE_COLUMN) -> List[Dict[str, Any]]:
+    """Sets `column` of every record with a `suggestion` and a `refine` that lacks it, in place."""
+    missing = [datum for datum in data if column not in datum and "suggestion" in datum and "refine" in datum]
+    distances = suggestion_distances([datum["suggestion"] for datum in missing], [datum["refine"] for datum in missing], embed)
+    for datum, distance in zip(missing, distances):
+        datum[column] = distance
+    return data
+
+
+def add_distances_to_file(input_file: str, output_file: Optional[str] = None, embedder: str = "openai", column: Optional[str] = None):
+    """
+    Writes the drift of every record of a refine or consolidate file as a column.
+
+    Args:
+        input_file (str): A JSONL file of records with `suggestion` and `refine`, or a JSON list of annotation items
+            whose records are under `input_values`, as read by manual_inspection.model_inspection.
+        output_file (Optional[str], optional): The file to write. Defaults to rewriting `input_file`.
+        embedder (str, optional): The name of the embedding function in EMBEDDERS. Defaults to "openai".
+        column (Optional[str], optional): The name of the column. Defaults to distance_column(embedder).
+    """
+    if embedder not in EMBEDDERS:
+        raise ValueError(f"Error: unknown embedder {embedder}.")
+    column = column or distance_column(embedder)
+    output_file = output_file or input_file
+    is_jsonl = input_file.endswith(".jsonl")
+    if is_jsonl:
+        with jsonlines.open(input_file) as reader:
+            items = list(reader)
+        data = items
+    else:
+        with open(input_file, "r") as f:
+            items = json.load(f)
+        data = [item["input_values"] for item in items]
+    add_distances(data, EMBEDDERS[embedder], column)
+    # Written next to the output first, so an interrupted run never truncates the input
+    tmp_file = f"{output_file}.tmp"
+    if is_jsonl:
+        with jsonlines.open(tmp_file, "w") as writer:
+            writer.write_all(items)
+    else:
+        with open(tmp_file, "w") as f:
+            json.dump(items, f)
+    os.replace(tmp_file, output_file)
+    distances = np.array([datum[column] for datum in data if datum.get(column) is not None], dtype=np.float32)
+    if len(distances):
+        summary = f"{len(distances)} {column} values: mean {distances.mean():.3f}, median {np.median(distances):.3f}"
+        if column == DISTANCE_COLUMN:
+            summary += f", {(distances <= MAX_DRIFT_DISTANCE).mean():.1%} <= {MAX_DRIFT_DISTANCE}"
+        print(summary)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add the suggestion-vs-refinement cosine distance to a refine or consolidate file")
+    parser.add_argument("--input_file", "-i", type=str, required=True)
+    parser.add_argument("--output_file", "-o", type=str, default=None, help="output file (default: rewrite the input file)")
+    parser.add_argument("--embedder", type=str, choices=list(EMBEDDERS), default="openai")
+    parser.add_argument("--column", type=str, default=None, help="output column (default: distance_<embedder>)")
+    args = parser.parse_args()
+    add_distances_to_file(args.input_file, args.output_file, args.embedder, args.column)
@@ -1,73 +1,508 @@
+"""Sentence embeddings of the stage outputs with all-MiniLM-L12-v2.
+
+The model is loaded once per process by an EmbeddingService. `python embedding.py --serve` keeps a service alive as
+a local daemon on a unix socket; while it runs, `main` and other analysis jobs get their embeddings from it instead of
+loading the model themselves. On CPU-only machines, --quantize runs the model in int8 and --workers splits the input
+across processes; --check-agreement N reports how closely the int8 vectors follow fp32 on N sentences. The embeddings
+are written to an EmbeddingStore directory, which readers memory-map.
+Typical usage example:
+  python embedding.py --serve &
+  python embedding.py --input-file critique_output.jsonl --output-file critique_embeddings
+  python embedding.py --input-file critique_output.jsonl --check-agreement 2000 --workers 4
+  store = EmbeddingStore("critique_embeddings"); store.get("test_output", 0)
+"""
+import os
+import json
+import struct
+import socket
+import time
+import threading
+import socketserver
+import multiprocessing
 import jsonlines
-from transformers import AutoTokenizer, AutoModel
-import torch
-import torch.nn.functional as F
-from typing import List
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 import argparse
-import dill
+import numpy as np
 from tqdm import tqdm
+from embedding_cache import cached_embed
 
 SENTENCE_KEYS = {"test_input", "test_output", "suggestion", "context"}
-BATCH_SIZE = 32
+# Padded tokens of a batch: batch size x its longest sentence
+BATCH_TOKENS = 8192
+BATCH_SIZE = 256
+MODEL_NAME = 'sentence-transformers/all-MiniLM-L12-v2'
+# Unix socket of the embedding daemon
+EMBEDDING_SOCKET = "/tmp/scr_embedding.sock"
+# Precision of the stored embeddings; normalized vectors lose little in float16
+STORE_DTYPE = "float16"
+STORE_META = "meta.json"
+# Run the Linear layers of the model in int8 (dynamic quantization), several times faster on CPU
+QUANTIZE = False
+# Worker processes embedding shards of the corpus; each gets an equal share of the cores
+EMBEDDING_WORKERS = 1
+# Sentences per shard handed to a worker
+SHARD_SIZE = 4096
 
+# torch and transformers are imported where they are used, so that clients of the daemon start in milliseconds
 def mean_pooling(model_output, attention_mask):
+    import torch
     token_embeddings = model_output[0] #First element of model_output contains all token embeddings
     input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
     return torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
 
-def generate_embeddings(sentences: List[str]) -> List[List[float]]:
-    # Load model from HuggingFace Hub
-    tokenizer = AutoTokenizer.from_pretrained('sentence-transformers/all-MiniLM-L12-v2')
-    model = AutoModel.from_pretrained('sentence-transformers/all-MiniLM-L12-v2')
-    all_embeddings = []
-    for i in tqdm(range(0, len(sentences), BATCH_SIZE)):
-        current_batch = sentences[i:i+BATCH_SIZE]
-        # Tokenize sentences
-        encoded_input = tokenizer(current_batch, padding=True, truncation=True, return_tensors='pt')
+def token_batches(lengths: List[int], max_tokens: int = BATCH_TOKENS, max_batch_size: int = BATCH_SIZE) -> List[List[int]]:
+    """
+    Groups sentences of similar length into batches whose padded size fits a token budget.
+
+    Args:
+        lengths (List[int]): The token length of every sentence.
+        max_tokens (int, optional): The budget of a batch, its size times its longest sentence. Defaults to BATCH_TOKENS.
+        max_batch_size (int, optional): The maximum number of sentences in a batch. Defaults to BATCH_SIZE.
+
+    Returns:
+        List[List[int]]: The indices of the sentences of every batch, longest sentences first.
+    """
+    batches = []
+    batch = []
+    width = 0
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        # The sentences come from the longest, so the first sentence of a batch sets its padded width
+        if batch and ((len(batch) + 1) * width > max_tokens or len(batch) == max_batch_size):
+            batches.append(batch)
+            batch = []
+        if not batch:
+            width = lengths[i]
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+class EmbeddingService:
+    """
+    Holds the tokenizer and model, loaded once, and embeds sentences with them.
+
+    Args:
+        model_name (str, optional): The Hugging Face model. Defaults to MODEL_NAME.
+        quantize (bool, optional): Whether to quantize the Linear layers to int8. Defaults to False.
+        num_threads (Optional[int], optional): The torch threads of this process. Defaults to torch's default.
+    """
+
+    def __init__(self, model_name: str = MODEL_NAME, quantize: bool = False, num_threads: Optional[int] = None):
+        import torch
+        from transformers import AutoTokenizer, AutoModel
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.model_name = model_name
+        self.quantize = quantize
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModel.from_pretrained(model_name)
+        self.model.eval()
+        if quantize:
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        # The daemon serves several connections at a time; torch already uses all cores for one batch
+        self._lock = threading.Lock()
+
+    def embed(self, sentences: List[str], show_progress: bool = False) -> np.ndarray:
+        """
+        Embeds sentences.
+
+        Args:
+            sentences (List[str]): The sentences to embed.
+            show_progress (bool, optional): Whether to show a progress bar over the batches. Defaults to False.
+
+        Returns:
+            np.ndarray: A float32 matrix of normalized embeddings, one row per sentence.
+        """
+        import torch
+        import torch.nn.functional as F
+        embeddings = np.zeros((len(sentences), self.model.config.hidden_size), dtype=np.float32)
+        with self._lock:
+            # Tokenize sentences once, then batch them by length so that little compute goes to padding
+            input_ids = self.tokenizer(sentences, truncation=True)["input_ids"] if sentences else []
+            batches = token_batches([len(ids) for ids in input_ids])
+            for rows in (tqdm(batches) if show_progress else batches):
+                encoded_input = self.tokenizer.pad({"input_ids": [input_ids[row] for row in rows]}, return_tensors='pt')
+
+                # Compute token embeddings
+                with torch.no_grad():
+                    model_output = self.model(**encoded_input)
+
+                # Perform pooling
+                sentence_embeddings = mean_pooling(model_output, encoded_input['attention_mask'])
+
+                # Normalize embeddings
+                sentence_embeddings = F.normalize(sentence_embeddings, p=2, dim=1)
+
+                # Write the rows back in the order of `sentences`
+                embeddings[rows] = sentence_embeddings.numpy()
+        return embeddings
+
+_service = None
+_service_lock = threading.Lock()
+
+def get_service() -> EmbeddingService:
+    """Returns the embedding service of this process, loading the model on first use."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = EmbeddingService(MODEL_NAME, QUANTIZE)
+    return _service
+
+def cache_model_name(model_name: str = None, quantize: bool = None) -> str:
+    """Returns the model name the embeddings are cached and stored under, which tells int8 vectors apart."""
+    model_name = MODEL_NAME if model_name is None else model_name
+    quantize = QUANTIZE if quantize is None else quantize
+    return f"{model_name}:int8" if quantize else model_name
+
+def _shard_worker_init(model_name: str, quantize: bool, num_threads: int):
+    global _service
+    # Pinning the thread pools before torch starts keeps the workers from oversubscribing the cores
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[variable] = str(num_threads)
+    _service = EmbeddingService(model_name, quantize, num_threads)
+
+def _embed_shard(shard: Tuple[int, List[str]]) -> Tuple[int, np.ndarray]:
+    start, sentences = shard
+    return start, _service.embed(sentences)
+
+def embed_sharded(sentences: List[str], workers: int = EMBEDDING_WORKERS, model_name: str = None, quantize: bool = None,
+                  shard_size: int = SHARD_SIZE, show_progress: bool = False) -> np.ndarray:
+    """
+    Embeds sentences in worker processes, each loading the model once and embedding shards of `shard_size` sentences.
+
+    The cores are split evenly between the workers, and every worker pins its torch, OpenMP and MKL threads to its
+    share. With a single worker the sentences are embedded by the service of this process.
+
+    Args:
+        sentences (List[str]): The sentences to embed.
+        workers (int, optional): The number of worker processes. Defaults to EMBEDDING_WORKERS.
+        model_name (str, optional): The Hugging Face model. Defaults to MODEL_NAME.
+        quantize (bool, optional): Whether the workers run the int8 model. Defaults to QUANTIZE.
+        shard_size (int, optional): The number of sentences per shard. Defaults to SHARD_SIZE.
+        show_progress (bool, optional): Whether to show a progress bar over the shards. Defaults to False.
+
+    Returns:
+        np.ndarray: A float32 matrix of normalized embeddings, one row per sentence.
+    """
+    model_name = MODEL_NAME if model_name is None else model_name
+    quantize = QUANTIZE if quantize is None else quantize
+    if workers <= 1:
+        service = get_service() if (model_name, quantize) == (MODEL_NAME, QUANTIZE) else EmbeddingService(model_name, quantize)
+        return service.embed(sentences, show_progress)
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    shards = [(start, sentences[start:start + shard_size]) for start in range(0, len(sentences), shard_size)]
+    embeddings = None
+    # Workers are spawned, so that none inherits the torch thread pools of this process
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=_shard_worker_init, initargs=(model_name, quantize, num_threads)) as pool:
+        results = pool.imap_unordered(_embed_shard, shards)
+        for start, vectors in (tqdm(results, total=len(shards)) if show_progress else results):
+            if embeddings is None:
+                embeddings = np.zeros((len(sentences), vectors.shape[1]), dtype=np.float32)
+            embeddings[start:start + len(vectors)] = vectors
+    return embeddings if embeddings is not None else np.zeros((0, 0), dtype=np.float32)
+
+def check_agreement(sentences: List[str], workers: int = EMBEDDING_WORKERS, model_name: str = None) -> Dict[str, float]:
+    """
+    Compares the int8 embeddings of `sentences` with the fp32 baseline.
+
+    Args:
+        sentences (List[str]): A sample of the corpus.
+        workers (int, optional): The worker processes of the int8 run. Defaults to EMBEDDING_WORKERS.
+        model_name (str, optional): The Hugging Face model. Defaults to MODEL_NAME.
+
+    Returns:
+        Dict[str, float]: The mean, minimum and 1st percentile cosine similarity between the int8 and fp32 vectors of
+            the same sentence, and the sentences per second of both runs, the int8 one including the start-up of
+            its workers.
+    """
+    start = time.time()
+    baseline = EmbeddingService(model_name or MODEL_NAME).embed(sentences)
+    baseline_seconds = time.time() - start
+    start = time.time()
+    quantized = embed_sharded(sentences, workers, model_name, quantize=True)
+    quantized_seconds = time.time() - start
+    # Both sets of vectors are normalized, so the row-wise dot product is the cosine similarity
+    cosine = np.einsum("ij,ij->i", baseline, quantized)
+    return {
+        "sentences": len(sentences),
+        "mean_cosine": float(cosine.mean()),
+        "min_cosine": float(cosine.min()),
+        "p01_cosine": float(np.percentile(cosine, 1)),
+        "fp32_sentences_per_s": len(sentences) / max(baseline_seconds, 1e-9),
+        "int8_sentences_per_s": len(sentences) / max(quantized_seconds, 1e-9),
+    }
+
+# Messages on the socket are a 4-byte big-endian length followed by the payload
+def _send_message(sock: socket.socket, payload: bytes):
+    sock.sendall(struct.pack("!I", len(payload)) + payload)
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Error: the embedding socket was closed.")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+def _recv_message(sock: socket.socket) -> bytes:
+    (size,) = struct.unpack("!I", _recv_exactly(sock, 4))
+    return _recv_exactly(sock, size)
 
-        # Compute token embeddings
-        with torch.no_grad():
-            model_output = model(**encoded_input)
-        
-        # Perform pooling
-        sentence_embeddings = mean_pooling(model_output, encoded_input['attention_mask'])
+class _EmbeddingHandler(socketserver.BaseRequestHandler):
+    # A request is a JSON object {"model": ..., "sentences": [...]} naming the cache_model_name the client expects; the
+    # response a JSON header {"model": ..., "shape": [n, d]} followed by the float32 matrix, or {"model": ..., "error": ...}
+    def handle(self):
+        model = cache_model_name(self.server.service.model_name, self.server.service.quantize)
+        while True:
+            try:
+                request = json.loads(_recv_message(self.request))
+            except ConnectionError:
+                return
+            try:
+                if request["model"] != model:
+                    raise Exception(f"the daemon serves {model}, not {request['model']}")
+                vectors = self.server.service.embed(request["sentences"])
+            except Exception as e:
+                _send_message(self.request, json.dumps({"model": model, "error": str(e)}).encode())
+                continue
+            _send_message(self.request, json.dumps({"model": model, "shape": list(vectors.shape)}).encode())
+            _send_message(self.request, vectors.tobytes())
 
-        # Normalize embeddings
-        sentence_embeddings = F.normalize(sentence_embeddings, p=2, dim=1)
+class _EmbeddingServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
 
-        # Add to result
-        all_embeddings.extend(sentence_embeddings.tolist())
+def serve(socket_path: str = EMBEDDING_SOCKET):
+    """
+    Loads the model and serves embeddings on a unix socket until interrupted.
 
-    return all_embeddings
+    Raises:
+        Exception: If another daemon is already serving on the socket.
+    """
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            # Left behind by a daemon that did not shut down cleanly
+            os.remove(socket_path)
+        else:
+            raise Exception(f"Error: an embedding daemon is already serving on {socket_path}.")
+        finally:
+            probe.close()
+    server = _EmbeddingServer(socket_path, _EmbeddingHandler)
+    server.service = get_service()
+    print(f"Serving {cache_model_name()} embeddings on {socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
 
-def main(input_file: str, output_file: str):
+class EmbeddingClient:
+    """
+    Requests embeddings from the daemon started by `serve`, over one connection.
+
+    Args:
+        socket_path (str, optional): The daemon's socket. Defaults to EMBEDDING_SOCKET.
+        model (str, optional): The cache_model_name the embeddings must come from; the daemon refuses requests for
+            another model. Defaults to cache_model_name().
+
+    Raises:
+        OSError: If no daemon listens on the socket.
+    """
+
+    def __init__(self, socket_path: str = EMBEDDING_SOCKET, model: str = None):
+        self.model = cache_model_name() if model is None else model
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+
+    def embed(self, sentences: List[str]) -> np.ndarray:
+        """
+        Returns the float32 embedding matrix of `sentences`, one row per sentence.
+
+        Raises:
+            Exception: If the daemon failed or serves another model.
+        """
+        _send_message(self.sock, json.dumps({"model": self.model, "sentences": sentences}).encode())
+        header = json.loads(_recv_message(self.sock))
+        if "error" in header:
+            raise Exception(f"Error: the embedding daemon failed: {header['error']}")
+        return np.frombuffer(_recv_message(self.sock), dtype=np.float32).reshape(header["shape"])
+
+    def served_model(self) -> str:
+        """Returns the cache_model_name of the daemon's model, with an empty request."""
+        _send_message(self.sock, json.dumps({"model": self.model, "sentences": []}).encode())
+        header = json.loads(_recv_message(self.sock))
+        if "error" not in header:
+            _recv_message(self.sock)
+        return header["model"]
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def connect(socket_path: str = EMBEDDING_SOCKET, model: str = None) -> Optional[EmbeddingClient]:
+    """Returns a client of the running daemon, or None if there is none or it serves another model than `model`."""
+    try:
+        client = EmbeddingClient(socket_path, model)
+    except OSError:
+        return None
+    served = client.served_model()
+    if served != client.model:
+        print(f"The embedding daemon on {socket_path} serves {served}; embedding with {client.model} in this process")
+        client.close()
+        return None
+    return client
+
+def _compute_embeddings(sentences: List[str], socket_path: Optional[str], model: str) -> np.ndarray:
+    # Use the daemon if it runs the same model, otherwise the model of this process or the shard workers
+    client = connect(socket_path, model) if socket_path else None
+    if client is not None:
+        with client:
+            return client.embed(sentences)
+    return embed_sharded(sentences, EMBEDDING_WORKERS, show_progress=True)
+
+def generate_embeddings(sentences: List[str], socket_path: Optional[str] = EMBEDDING_SOCKET) -> np.ndarray:
+    # Only sentences missing from the embedding cache are computed, all by the model they are cached under
+    model = cache_model_name()
+    return cached_embed(sentences, model, lambda missing: _compute_embeddings(missing, socket_path, model))
+
+class EmbeddingStore:
+    """
+    Reads an embedding store written by `write_store`, memory-mapping its matrices.
+
+    A store is a directory holding, per field of SENTENCE_KEYS found in the input file, `<field>.npy`, the matrix of
+    its embeddings, and `<field>.rows.npy`, the row of every record of the input file (its line number) in that
+    matrix, or -1 if the record has no such field. `meta.json`, written last, lists the fields.
+
+    Args:
+        path (str): The store directory.
+
+    Raises:
+        Exception: If the directory is not a complete store.
+    """
+
+    def __init__(self, path: str):
+        meta_path = os.path.join(path, STORE_META)
+        if not os.path.exists(meta_path):
+            raise Exception(f"Error: {path} is not an embedding store.")
+        with open(meta_path, "r") as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.keys: List[str] = self.meta["keys"]
+        self._vectors: Dict[str, np.ndarray] = {}
+        self._rows: Dict[str, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return self.meta["records"]
+
+    def vectors(self, key: str) -> np.ndarray:
+        """Returns the read-only, memory-mapped embedding matrix of a field."""
+        if key not in self._vectors:
+            self._vectors[key] = np.load(os.path.join(self.path, f"{key}.npy"), mmap_mode="r")
+        return self._vectors[key]
+
+    def rows(self, key: str) -> np.ndarray:
+        """Returns the row of every record in the matrix of a field, -1 for records without the field."""
+        if key not in self._rows:
+            self._rows[key] = np.load(os.path.join(self.path, f"{key}.rows.npy"), mmap_mode="r")
+        return self._rows[key]
+
+    def get(self, key: str, record: int) -> Optional[np.ndarray]:
+        """Returns the embedding of a field of the record on line `record` of the input file, or None."""
+        row = self.rows(key)[record]
+        return None if row < 0 else self.vectors(key)[row]
+
+    def take(self, key: str, records: Sequence[int]) -> np.ndarray:
+        """
+        Returns the embeddings of a field of several records, as a float32 matrix.
+
+        Raises:
+            KeyError: If one of the records has no such field.
+        """
+        rows = self.rows(key)[np.asarray(records, dtype=np.int64)]
+        if (rows < 0).any():
+            raise KeyError(f"Error: some records have no {key}.")
+        return np.asarray(self.vectors(key)[rows], dtype=np.float32)
+
+def write_store(path: str, data: List[Dict[str, Any]], embeddings: np.ndarray, keys: List[str], dtype: str = STORE_DTYPE):
+    """
+    Writes an embedding store, see EmbeddingStore.
+
+    Args:
+        path (str): The store directory.
+        data (List[Dict[str, Any]]): The records of the input file.
+        embeddings (np.ndarray): The embeddings of the fields, field by field in the order of `keys`, and within a field
+            in the order of the records having it.
+        keys (List[str]): The fields.
+        dtype (str, optional): "float16" or "float32". Defaults to STORE_DTYPE.
+    """
+    os.makedirs(path, exist_ok=True)
+    meta_path = os.path.join(path, STORE_META)
+    # A store without meta.json is incomplete, so readers never see half-written matrices
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    start = 0
+    for key in keys:
+        rows = np.full(len(data), -1, dtype=np.int32)
+        has_key = np.array([key in datum for datum in data], dtype=bool)
+        count = int(has_key.sum())
+        rows[has_key] = np.arange(count, dtype=np.int32)
+        np.save(os.path.join(path, f"{key}.npy"), embeddings[start:start + count].astype(dtype))
+        np.save(os.path.join(path, f"{key}.rows.npy"), rows)
+        start += count
+    with open(meta_path, "w") as f:
+        json.dump({"keys": keys, "records": len(data), "dtype": dtype, "dim": int(embeddings.shape[1]), "model": cache_model_name()}, f)
+
+def main(input_file: str, output_file: str, socket_path: Optional[str] = EMBEDDING_SOCKET, dtype: str = STORE_DTYPE):
     # Load data
     with jsonlines.open(input_file) as reader:
         data = list(reader)
-    # exampple data
 
-    sentences = []
-    
-    for datum in data:
-        for key in SENTENCE_KEYS:
-            if key in datum:
-                sentences.append(datum[key])
+    keys = sorted(key for key in SENTENCE_KEYS if any(key in datum for datum in data))
+    # The sentences of each field are contiguous, so every field gets a slice of the embedding matrix
+    sentences = [datum[key] for key in keys for datum in data if key in datum]
 
     # Generate embeddings
-    embeddings = generate_embeddings(sentences)
-
-    for datum in data:
-        for key in SENTENCE_KEYS:
-            if key in datum:
-                datum[f"{key}_embedding"] = embeddings.pop(0)
+    embeddings = generate_embeddings(sentences, socket_path)
 
-    # Write embeddings to file
-    with open(output_file, "wb") as f:
-        dill.dump(data, f)
+    # Write the embedding store
+    write_store(output_file, data, embeddings, keys, dtype)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--input-file", type=str, required=True)
-    parser.add_argument("--output-file", type=str, required=True)
+    parser.add_argument("--input-file", type=str)
+    parser.add_argument("--output-file", type=str, help="directory of the embedding store")
+    parser.add_argument("--dtype", type=str, choices=["float16", "float32"], default=STORE_DTYPE)
+    parser.add_argument("--serve", action="store_true", help="keep the model loaded and serve embeddings on --socket")
+    parser.add_argument("--socket", type=str, default=EMBEDDING_SOCKET, help=f"socket of the embedding daemon (default: {EMBEDDING_SOCKET})")
+    parser.add_argument("--model", type=str, default=MODEL_NAME)
+    parser.add_argument("--quantize", action="store_true", help="run the model in int8 on CPU")
+    parser.add_argument("--workers", type=int, default=EMBEDDING_WORKERS, help="worker processes embedding shards of the input")
+    parser.add_argument("--check-agreement", type=int, default=0, metavar="N", help="compare int8 with fp32 embeddings on the first N sentences of the input file and exit")
     args = parser.parse_args()
-    main(args.input_file, args.output_file)
\ No newline at end of file
+    MODEL_NAME = args.model
+    QUANTIZE = args.quantize
+    EMBEDDING_WORKERS = args.workers
+    if args.serve:
+        serve(args.socket)
+    elif args.check_agreement:
+        if not args.input_file:
+            parser.error("--input-file is required with --check-agreement")
+        with jsonlines.open(args.input_file) as reader:
+            sentences = [datum[key] for datum in reader for key in sorted(SENTENCE_KEYS) if key in datum]
+        print(json.dumps(check_agreement(sentences[:args.check_agreement], args.workers), indent=2))
+    else:
+        if not args.input_file or not args.output_file:
+            parser.error("--input-file and --output-file are required unless --serve is given")
+        main(args.input_file, args.output_file, args.socket, args.dtype)
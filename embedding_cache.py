@@ -0,0 +1,234 @@
+import os, json, time, atexit, hashlib, sqlite3, threading, argparse, unicodedata
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+# Location of the on-disk cache shared by every embedding module
+EMBEDDING_CACHE_PATH = "cache/embeddings.sqlite"
+# Least recently used embeddings are evicted once the cache grows beyond this size
+MAX_EMBEDDING_CACHE_BYTES = 4 << 30
+# Set to False to always compute the embeddings
+EMBEDDING_CACHE_ENABLED = True
+# Hit and miss counters and access times are kept in memory and written at most this often, or once this many
+# lookups are pending, so lookups do not open a write transaction each
+FLUSH_SECONDS = 5
+FLUSH_LOOKUPS = 1000
+# Number of keys looked up per query
+LOOKUP_CHUNK_SIZE = 512
+
+
+def normalize_text(text: str) -> str:
+    """Normalizes the unicode form and whitespace of a text, so that trivially different copies share an embedding."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class EmbeddingCache:
+    """
+    A persistent, content-addressed cache of embeddings backed by sqlite.
+
+    Embeddings are keyed by a hash of the model name and the normalized text, so the same context or suggestion found
+    in several stage files, or embedded by several scripts, is computed once per model. Vectors are stored as float32. As in
+    response_cache.py, the counters and access times are buffered in memory and flushed every FLUSH_SECONDS.
+
+    Args:
+        path (str, optional): The path to the sqlite database. Defaults to EMBEDDING_CACHE_PATH.
+        max_bytes (int, optional): The maximum total size of the cached vectors. Defaults to MAX_EMBEDDING_CACHE_BYTES.
+    """
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, max_bytes: int = MAX_EMBEDDING_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        # Counters and access times not yet written to the database
+        self._pending_lock = threading.Lock()
+        self._pending_stats = {"hits": 0, "misses": 0}
+        self._pending_accessed: Dict[str, float] = {}
+        self._flushed = time.monotonic()
+        atexit.register(self.flush)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB, size INTEGER, accessed REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)")
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+            conn.executemany("INSERT OR IGNORE INTO stats VALUES (?, 0)", [("hits",), ("misses",), ("evictions",), ("bytes",)])
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections cannot be shared between threads
+        if getattr(self._local, "conn", None) is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return self._local.conn
+
+    def _record(self, hits: int, misses: int, accessed: List[str]):
+        """Counts lookups in memory and writes them once FLUSH_SECONDS or FLUSH_LOOKUPS is reached."""
+        now = time.time()
+        with self._pending_lock:
+            self._pending_stats["hits"] += hits
+            self._pending_stats["misses"] += misses
+            for key in accessed:
+                self._pending_accessed[key] = now
+            due = (time.monotonic() - self._flushed >= FLUSH_SECONDS
+                   or sum(self._pending_stats.values()) >= FLUSH_LOOKUPS)
+        if due:
+            self.flush()
+
+    def _write_pending(self, conn: sqlite3.Connection):
+        # Runs inside the caller's transaction
+        with self._pending_lock:
+            stats, self._pending_stats = self._pending_stats, {"hits": 0, "misses": 0}
+            accessed, self._pending_accessed = self._pending_accessed, {}
+            self._flushed = time.monotonic()
+        conn.executemany("UPDATE embeddings SET accessed = ? WHERE key = ?", [(t, key) for key, t in accessed.items()])
+        conn.executemany("UPDATE stats SET value = value + ? WHERE name = ?", [(value, name) for name, value in stats.items() if value])
+
+    def flush(self):
+        """Writes the pending hit and miss counters and access times in one transaction."""
+        conn = self._connection()
+        with conn:
+            self._write_pending(conn)
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        """Returns the hex digest identifying the embedding of `text` by `model`."""
+        return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Returns the cached embedding of every text, or None on a miss."""
+        keys = [self.make_key(model, text) for text in texts]
+        found: Dict[str, np.ndarray] = {}
+        conn = self._connection()
+        for start in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+            chunk = keys[start:start + LOOKUP_CHUNK_SIZE]
+            query = f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})"
+            for key, vector in conn.execute(query, chunk):
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+        hits = sum(key in found for key in keys)
+        self._record(hits, len(keys) - hits, list(found))
+        return [found.get(key) for key in keys]
+
+    def put_many(self, model: str, texts: List[str], vectors: np.ndarray):
+        """Stores embeddings and evicts the least recently used ones if the cache is over its size limit."""
+        rows = {}
+        for text, vector in zip(texts, vectors):
+            data = np.asarray(vector, dtype=np.float32).tobytes()
+            rows[self.make_key(model, text)] = data
+        if not rows:
+            return
+        conn = self._connection()
+        with conn:
+            # Recent access times must be written before choosing what to evict
+            self._write_pending(conn)
+            now = time.time()
+            added = 0
+            for key, data in rows.items():
+                old = conn.execute("SELECT size FROM embeddings WHERE key = ?", (key,)).fetchone()
+                conn.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", (key, data, len(data), now))
+                added += len(data) - (old[0] if old else 0)
+            conn.execute("UPDATE stats SET value = value + ? WHERE name = 'bytes'", (added,))
+            total = conn.execute("SELECT value FROM stats WHERE name = 'bytes'").fetchone()[0]
+            while total > self.max_bytes:
+                evict = conn.execute("SELECT key, size FROM embeddings ORDER BY accessed LIMIT 1000").fetchall()
+                if not evict:
+                    break
+                freed = 0
+                evicted = 0
+                for evict_key, evict_size in evict:
+                    if total - freed <= self.max_bytes:
+                        break
+                    conn.execute("DELETE FROM embeddings WHERE key = ?", (evict_key,))
+                    freed += evict_size
+                    evicted += 1
+                conn.execute("UPDATE stats SET value = value - ? WHERE name = 'bytes'", (freed,))
+                conn.execute("UPDATE stats SET value = value + ? WHERE name = 'evictions'", (evicted,))
+                total -= freed
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the hit, miss and eviction counters, the cached bytes and the number of entries."""
+        self.flush()
+        conn = self._connection()
+        stats = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+        stats["entries"] = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return stats
+
+    def clear(self):
+        """Removes every cached embedding and resets the counters."""
+        conn = self._connection()
+        with conn:
+            self._write_pending(conn)
+            conn.execute("DELETE FROM embeddings")
+            conn.execute("UPDATE stats SET value = 0")
+
+
+class _DisabledEmbeddingCache:
+    """Stand-in used when EMBEDDING_CACHE_ENABLED is False; every lookup is a miss."""
+
+    def get_many(self, model, texts):
+        return [None] * len(texts)
+
+    def put_many(self, model, texts, vectors):
+        pass
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_embedding_cache():
+    """Returns the process-wide embedding cache."""
+    global _cache
+    if not EMBEDDING_CACHE_ENABLED:
+        return _DisabledEmbeddingCache()
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache(EMBEDDING_CACHE_PATH, MAX_EMBEDDING_CACHE_BYTES)
+    return _cache
+
+
+def cached_embed(texts: List[str], model: str, embed: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+    """
+    Embeds texts through the embedding cache, computing only the texts it has not seen.
+
+    Args:
+        texts (List[str]): The texts to embed.
+        model (str): The model name, part of the cache key.
+        embed (Callable[[List[str]], np.ndarray]): Computes the embedding matrix of a list of texts.
+
+    Returns:
+        np.ndarray: A float32 matrix with one row per text, in the order of `texts`.
+    """
+    unique_texts = list(dict.fromkeys(texts))
+    cache = get_embedding_cache()
+    cached = cache.get_many(model, unique_texts)
+    missing = [text for text, vector in zip(unique_texts, cached) if vector is None]
+    computed = np.asarray(embed(missing), dtype=np.float32) if missing else None
+    if missing:
+        cache.put_many(model, missing, computed)
+    if not unique_texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    dim = computed.shape[1] if computed is not None else len(cached[0])
+    unique_matrix = np.empty((len(unique_texts), dim), dtype=np.float32)
+    computed_rows = iter(range(len(missing)))
+    for row, vector in enumerate(cached):
+        unique_matrix[row] = computed[next(computed_rows)] if vector is None else vector
+    if len(unique_texts) == len(texts):
+        return unique_matrix
+    index = {text: row for row, text in enumerate(unique_texts)}
+    return unique_matrix[[index[text] for text in texts]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or clear the embedding cache.")
+    parser.add_argument("command", type=str, choices=["stats", "clear"])
+    parser.add_argument("--cache_path", type=str, default=EMBEDDING_CACHE_PATH, help="path to the cache database")
+    args = parser.parse_args()
+    cache = EmbeddingCache(args.cache_path)
+    if args.command == "stats":
+        stats = cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        print(json.dumps(stats, indent=2))
+        if lookups:
+            print(f"Hit rate: {stats['hits'] / lookups:.3f}")
+    elif args.command == "clear":
+        cache.clear()
+        print(f"Cleared {args.cache_path}")
@@ -0,0 +1,127 @@
+import atexit
+import asyncio
+import threading
+import collections
+import concurrent.futures
+from typing import Any, Callable, Iterable, Iterator
+
+# Default number of requests kept in flight by the async engine
+DEFAULT_CONCURRENCY = 200
+
+
+class AsyncEngine:
+    """
+    Runs model requests on a single asyncio event loop with a bounded number of requests in flight.
+
+    The engine exposes the same `imap` / `imap_unordered` interface as `multiprocessing.Pool`, so it can replace
+    the process pools of the stage runners without changing their loops. Coroutine functions (e.g. `llm.achatgpt`)
+    run natively on the loop; plain functions are run on a thread pool of the same size, so the existing
+    `process_datum` functions can be used unchanged.
+
+    Args:
+        concurrency (int, optional): The maximum number of requests in flight. Defaults to DEFAULT_CONCURRENCY.
+    """
+
+    def __init__(self, concurrency: int = DEFAULT_CONCURRENCY):
+        if concurrency < 1:
+            raise ValueError(f"Error: concurrency must be positive, got {concurrency}.")
+        self.concurrency = concurrency
+        self._loop = asyncio.new_event_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self._thread = threading.Thread(target=self._loop.run_forever, name="async-engine", daemon=True)
+        self._thread.start()
+
+    def _submit(self, fn: Callable, item: Any) -> concurrent.futures.Future:
+        if asyncio.iscoroutinefunction(fn):
+            return asyncio.run_coroutine_threadsafe(fn(item), self._loop)
+        return self._executor.submit(fn, item)
+
+    def run(self, coro) -> Any:
+        """Runs a single coroutine on the engine loop and waits for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def imap_unordered(self, fn: Callable, iterable: Iterable) -> Iterator[Any]:
+        """
+        Applies `fn` to every item and yields the results as soon as they complete.
+
+        Items are pulled lazily from `iterable`, so at most `concurrency` of them are held in memory at a time.
+        An exception raised by `fn` is re-raised here, like `multiprocessing.Pool.imap_unordered`.
+        """
+        iterator = iter(iterable)
+        pending = set()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < self.concurrency:
+                try:
+                    pending.add(self._submit(fn, next(iterator)))
+                except StopIteration:
+                    exhausted = True
+            if not pending:
+                return
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+    def imap(self, fn: Callable, iterable: Iterable) -> Iterator[Any]:
+        """Applies `fn` to every item and yields the results in input order."""
+        iterator = iter(iterable)
+        pending = collections.deque()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < self.concurrency:
+                try:
+                    pending.append(self._submit(fn, next(iterator)))
+                except StopIteration:
+                    exhausted = True
+            if not pending:
+                return
+            yield pending.popleft().result()
+
+    async def _shutdown(self):
+        # Tasks still pending, e.g. those of a consumer that stopped iterating early, are cancelled and awaited,
+        # so none is destroyed while pending
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._loop.shutdown_asyncgens()
+
+    def close(self):
+        """Cancels the outstanding requests, then stops the event loop and the thread pool."""
+        if self._loop.is_closed():
+            return
+        if self._loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+        self._executor.shutdown(wait=True)
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine() -> AsyncEngine:
+    """Returns the process-wide engine running the requests of synchronous callers, closed at exit."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = AsyncEngine(DEFAULT_CONCURRENCY)
+            atexit.register(_engine.close)
+    return _engine
+
+
+def run_sync(coro) -> Any:
+    """
+    Runs a coroutine on the process-wide engine and waits for its result, so that the synchronous model helpers
+    (e.g. `llm.chatgpt`) share the code of their async versions.
+
+    Must not be called from a coroutine running on that engine, which would wait for itself.
+    """
+    return get_engine().run(coro)
@@ -1,9 +1,12 @@
 import argparse
-import openai, time, json, os
+import openai, json, os
 import jsonlines, tqdm, copy, random
 from typing import List, Dict, Any, Set
-import multiprocessing as mp
-from functools import wraps
+from engine import AsyncEngine, run_sync
+from output_sink import OutputSink
+from completion_index import CompletionIndex
+from telemetry import set_context
+from model_client import achat_completion
 
 # Set up OpenAI API credentials by reading from config/config.json
 with open("config/config.json", "r") as f:
@@ -11,34 +14,12 @@ with open("config/config.json", "r") as f:
     openai.api_key = config["azure_api_key"]
 
 openai.api_type = "azure"
-openai.api_base = "https://llm-testing.openai.azure.com/"
+openai.api_base = config.get("azure_api_base", "https://llm-testing.openai.azure.com/")
 openai.api_version = "2023-03-15-preview"
 
-def limit_calls(max_calls=12, interval=60):
-    """A decorator function that limits the number of function calls per time interval."""
-    count = 0
-    last_called = 0
-
-    def decorator(fn):
-        @wraps(fn)
-        def wrapper(*args, **kwargs):
-            nonlocal count, last_called
-            now = time.time()
-            if now - last_called > interval:
-                # reset count if the interval has passed
-                count = 0
-            if count >= max_calls:
-                # wait until the interval has passed
-                time.sleep(interval - (now - last_called))
-            count += 1
-            last_called = now
-            result = fn(*args, **kwargs)
-            return result
-        return wrapper
-
-    return decorator
-
-@limit_calls(max_calls=12, interval=60)
+# Maximum number of requests in flight
+CONCURRENCY = 200
+
 def gpt4(text):
     """
     Generates a response to the given input text using the Chat model in OpenAI's GPT-3.5 API.
@@ -47,52 +28,48 @@ def gpt4(text):
         text (str): The input text to generate a response to.
 
     Returns:
-        str: The generated response.
+        str: The generated response, or None if the request failed.
+    """
+    return run_sync(agpt4(text))
 
-    Raises:
-        Exception: If there is an error while making the API request.
+
+async def agpt4(text):
     """
+    Asynchronous version of `gpt4`, used by the async engine to keep many requests in flight.
 
-    # check tally counter whether we have reached the limit for 12 requests per minute
-    
+    Args:
+        text (str): The input text to generate a response to.
 
+    Returns:
+        str: The generated response, or None if the request failed.
+    """
+    messages = [
+        {"role": "system", "content": "You are an AI assistant that helps people find information."},
+        {"role": "user", "content": text},
+    ]
     try:
-        response = openai.ChatCompletion.create(
-            engine="llm-testing-gpt4", temperature=1, 
-            messages=[
-                    {"role": "system", "content": "You are an AI assistant that helps people find information."},
-                    {"role": "user", "content": text},
-                ]
-            )
-        return response["choices"][0]["message"]["content"]
+        return await achat_completion(messages, "llm-testing-gpt4", temperature=1, engine="llm-testing-gpt4")
     except Exception as e:
         print(e)
-        if "Please retry after" in str(e):
-            print("Waiting for 10 seconds...")
-            time.sleep(10)
-            return gpt4(text)
         return None
 
 
-def process_datum(obj, output_file, lock):
+async def aprocess_datum(obj, sink):
     """
-    Generates a response to the given input and writes the response to the given output file.
+    Generates a response to the given input and hands the output line to the sink.
     """
 
-    response = gpt4(obj["test_input"])
+    response = await agpt4(obj["test_input"])
     if response is None:
         return
 
-    # print(f"Generated response: {response}")    
     output_line = {"model": "gpt-4", **obj}
     output_line["test_output"] = response
     
-    # Append the output line to the output file with the lock
-    with lock:
-        with jsonlines.open(output_file, mode='a') as writer:
-            writer.write(output_line)
+    # Hand the output line to the writer thread
+    sink.write(output_line)
 
-def critique(input_file: str, output_file: str, continue_critique: bool = True):
+def critique(input_file: str, output_file: str, continue_critique: bool = True, concurrency: int = CONCURRENCY):
     """
     Generates a response to each input in the given input file using the specified model and writes the responses to the given output file.
 
@@ -100,45 +77,43 @@ def critique(input_file: str, output_file: str, continue_critique: bool = True):
         input_file (str): The path to the input file.
         output_file (str): The path to the output file.
         continue_critique (bool, optional): Whether to continue the critique if the output file already exists. Defaults to True.
+        concurrency (int, optional): The maximum number of requests in flight.
     Raises:
         Exception: If the input file does not exist.
     """
+    # Account the model calls of this run to the stage and its input file
+    set_context("critique", input_file)
     # Check that the input file exists
     if not os.path.exists(input_file):
         raise Exception(f"Error: input file {input_file} does not exist.")
 
+    # The sidecar index holds the prompts already answered, so resuming never reads the output file
+    index = CompletionIndex(output_file, "test_input")
+
     # If the output file exists and the user wants to continue the critique, only use lines that haven't been processed yet
     if continue_critique and os.path.exists(output_file):
-        with jsonlines.open(output_file) as reader:
-            # Get the set of processed inputs
-            output_lines: List[Dict[str, Any]] = list(reader)
-        completed_text: Set[str] = set([o["test_input"] for o in output_lines])
         with jsonlines.open(input_file) as reader:
-            # Get the set of inputs that need to be processed
-            input_lines: List[Dict[str, Any]] = list(reader)
-        input_lines = [l for l in input_lines if l["test_input"] not in completed_text]
-        print(f"Continuing critique from {len(output_lines)} processed lines to {len(input_lines)} unprocessed lines.")
+            # Get the inputs that need to be processed
+            input_lines: List[Dict[str, Any]] = list(index.pending(reader, key=lambda l: l["test_input"]))
+        print(f"Continuing critique from {len(index)} processed lines to {len(input_lines)} unprocessed lines.")
     else:
         # Otherwise, just use the first 10 lines of the input file
         with jsonlines.open(input_file) as reader:
             input_lines: List[Dict[str, Any]] = list(reader)
     
-    # Create a multiprocessing pool
-    pool: mp.Pool = mp.Pool(processes=15)
-    
-    # Create a lock for writing to the output file
-    manager = mp.Manager()
-    lock = manager.Lock()
-
-    # Use a partial function to pass the output_file and lock arguments to process_datum
+    # A single writer thread appends the output lines, so workers never wait on the file
     from functools import partial
-    process_datum_with_output_file_and_lock = partial(process_datum, output_file=output_file, lock=lock)
+    with OutputSink(output_file, index=index) as sink:
+        process_datum_with_sink = partial(aprocess_datum, sink=sink)
 
-    # Rewrite the data in parallel and append the output lines to the output file dynamically
-    for _ in tqdm.tqdm(pool.imap_unordered(process_datum_with_output_file_and_lock, input_lines), total=len(input_lines)):
-        pass
+        # Rewrite the data concurrently and append the output lines to the output file dynamically
+        with AsyncEngine(concurrency) as engine:
+            progress = tqdm.tqdm(engine.imap_unordered(process_datum_with_sink, input_lines), total=len(input_lines))
+            for _ in progress:
+                progress.set_postfix(write_lag=sink.lag()["pending"], refresh=False)
+    index.close()
 
-def suggestion(input_file: str, output_file: str, continue_critique: bool = True):
+def suggestion(input_file: str, output_file: str, continue_critique: bool = True, concurrency: int = 1):
     """
     Generates a response to each input in the given input file using the specified model and writes the responses to the given output file.
 
@@ -146,44 +121,41 @@ def suggestion(input_file: str, output_file: str, continue_critique: bool = True
         input_file (str): The path to the input file.
         output_file (str): The path to the output file.
         continue_critique (bool, optional): Whether to continue the critique if the output file already exists. Defaults to True.
+        concurrency (int, optional): The maximum number of requests in flight.
     Raises:
         Exception: If the input file does not exist.
     """
+    set_context("suggestion", input_file)
     # Check that the input file exists
     if not os.path.exists(input_file):
         raise Exception(f"Error: input file {input_file} does not exist.")
 
+    # The sidecar index holds the prompts already answered, so resuming never reads the output file
+    index = CompletionIndex(output_file, "text")
+
     # If the output file exists and the user wants to continue the critique, only use lines that haven't been processed yet
     if continue_critique and os.path.exists(output_file):
-        with jsonlines.open(output_file) as reader:
-            # Get the set of processed inputs
-            output_lines: List[Dict[str, Any]] = list(reader)
-        completed_text: Set[str] = set([o["text"] for o in output_lines])
         with jsonlines.open(input_file) as reader:
-            # Get the set of inputs that need to be processed
-            input_lines: List[Dict[str, Any]] = list(reader)
-        input_lines = [l for l in input_lines if l["text"] not in completed_text]
-        print(f"Continuing critique from {len(output_lines)} processed lines to {len(input_lines)} unprocessed lines.")
+            # Get the inputs that need to be processed
+            input_lines: List[Dict[str, Any]] = list(index.pending(reader, key=lambda l: l["text"]))
+        print(f"Continuing critique from {len(index)} processed lines to {len(input_lines)} unprocessed lines.")
     else:
         # Otherwise, just use the first 10 lines of the input file
         with jsonlines.open(input_file) as reader:
             input_lines: List[Dict[str, Any]] = list(reader)
     random.shuffle(input_lines)
     input_lines = [{"test_input":l["text"], **l} for l in input_lines][:200]
-    # Create a multiprocessing pool
-    pool: mp.Pool = mp.Pool(processes=1)
-    
-    # Create a lock for writing to the output file
-    manager = mp.Manager()
-    lock = manager.Lock()
-
-    # Use a partial function to pass the output_file and lock arguments to process_datum
+    # A single writer thread appends the output lines, so workers never wait on the file
     from functools import partial
-    process_datum_with_output_file_and_lock = partial(process_datum, output_file=output_file, lock=lock)
-
-    # Rewrite the data in parallel and append the output lines to the output file dynamically
-    for _ in tqdm.tqdm(pool.imap(process_datum_with_output_file_and_lock, input_lines), total=len(input_lines)):
-        pass
+    with OutputSink(output_file, index=index) as sink:
+        process_datum_with_sink = partial(aprocess_datum, sink=sink)
+
+        # Rewrite the data concurrently and append the output lines to the output file dynamically
+        with AsyncEngine(concurrency) as engine:
+            progress = tqdm.tqdm(engine.imap(process_datum_with_sink, input_lines), total=len(input_lines))
+            for _ in progress:
+                progress.set_postfix(write_lag=sink.lag()["pending"], refresh=False)
+    index.close()
 
 def generate_plausibility_data(input_file, output_file):
 
@@ -0,0 +1,281 @@
+"""Local inference of stage test inputs with a Hugging Face causal LM.
+
+Every critique, reflection, refine and consolidate prompt built by mst.py starts with the same instruction block,
+the text of prompts/<stage>.prompt before its first placeholder. The generator runs that prefix through the model
+once, keeps its attention (key/value) state and continues every record of the stage from a copy of it, so only the
+record-specific part of each prompt is prefilled. With --batch_tokens, the test inputs are instead sorted by token
+length and generated in dynamic batches up to a token budget, so that little compute goes to padding. Outputs use the
+format of llm.py, in the order of the inputs, so mst.py and utils.post_process_llama_output can read them.
+Typical usage example:
+  python local_inference.py --model_name_or_path lmsys/vicuna-7b-v1.3 -i critique_input.jsonl -o critique_output.jsonl --stage critique
+  python local_inference.py --model_name_or_path lmsys/vicuna-7b-v1.3 -i critique_input.jsonl -o critique_output.jsonl --batch_tokens 16384
+"""
+import os, copy, argparse
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import jsonlines, tqdm
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from prompt_template import load_template
+from mst import (STAGE_CRITIQUE, STAGE_REFLECTION, STAGE_REFLECTION_EXPLAIN, STAGE_REFINE, STAGE_CONSOLIDATE, CRITIQUE_PROMPT_PATH,
+                 REFLECTION_PROMPT_PATH, REFLECTION_EXPLAIN_PROMPT_PATH, REFLECTION_REFINE_PROMPT_PATH, CONSOLIDATE_PROMPT_PATH)
+
+STAGE_PROMPT_PATHS = {
+    STAGE_CRITIQUE: CRITIQUE_PROMPT_PATH,
+    STAGE_REFLECTION: REFLECTION_PROMPT_PATH,
+    STAGE_REFLECTION_EXPLAIN: REFLECTION_EXPLAIN_PROMPT_PATH,
+    STAGE_REFINE: REFLECTION_REFINE_PROMPT_PATH,
+    STAGE_CONSOLIDATE: CONSOLIDATE_PROMPT_PATH,
+}
+MAX_NEW_TOKENS = 256
+# Number of prompts used to detect the shared prefix when no stage is given
+PREFIX_SAMPLE_SIZE = 64
+# Shorter shared prefixes are not worth caching
+MIN_PREFIX_CHARS = 64
+# Token budget of a batch: batch size x (longest prompt + MAX_NEW_TOKENS)
+BATCH_TOKENS = 16384
+MAX_BATCH_SIZE = 64
+
+
+def load_model(model_name_or_path: str, device: str = "cpu", dtype: Optional[torch.dtype] = None) -> Tuple[Any, Any]:
+    """Loads the tokenizer and the model in evaluation mode on `device`."""
+    tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    model = AutoModelForCausalLM.from_pretrained(model_name_or_path, torch_dtype=dtype)
+    model.to(device).eval()
+    return tokenizer, model
+
+
+def stage_prefix(stage: str) -> str:
+    """Returns the instruction block shared by every prompt of `stage`."""
+    return load_template(STAGE_PROMPT_PATHS[stage]).prefix
+
+
+def common_prefix(prompts: List[str]) -> str:
+    return os.path.commonprefix(prompts) if len(prompts) > 1 else ""
+
+
+def sampling_kwargs(temperature: float) -> Dict[str, Any]:
+    return {"do_sample": True, "temperature": temperature} if temperature > 0 else {"do_sample": False}
+
+
+def length_batches(lengths: List[int], max_tokens: int, max_new_tokens: int = MAX_NEW_TOKENS,
+                   max_batch_size: int = MAX_BATCH_SIZE) -> List[List[int]]:
+    """
+    Groups prompts of similar length into batches whose padded size fits a token budget.
+
+    The prompts are taken from the longest to the shortest, so each batch is padded to its first prompt and the
+    largest batches come first, where running out of memory shows up right away.
+
+    Args:
+        lengths (List[int]): The token length of every prompt.
+        max_tokens (int): The budget of a batch, counting its size times the length of its longest prompt plus
+            `max_new_tokens`. A prompt longer than the budget gets a batch of its own.
+        max_new_tokens (int, optional): The maximum number of generated tokens. Defaults to MAX_NEW_TOKENS.
+        max_batch_size (int, optional): The maximum number of prompts in a batch. Defaults to MAX_BATCH_SIZE.
+
+    Returns:
+        List[List[int]]: The indices of the prompts of every batch.
+    """
+    batches: List[List[int]] = []
+    batch: List[int] = []
+    width = 0
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        if batch and ((len(batch) + 1) * width > max_tokens or len(batch) == max_batch_size):
+            batches.append(batch)
+            batch = []
+        if not batch:
+            width = lengths[i] + max_new_tokens
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class PrefixCachedGenerator:
+    """
+    Generates completions of prompts sharing a prefix, computing the prefix's key/value state only once.
+
+    Prompts that do not start with the prefix are generated from scratch.
+
+    Args:
+        model: The causal LM.
+        tokenizer: Its tokenizer.
+        prefix (str): The shared prefix; an empty prefix disables the cache.
+        max_new_tokens (int, optional): The maximum number of generated tokens. Defaults to MAX_NEW_TOKENS.
+        temperature (float, optional): The sampling temperature; 0 decodes greedily. Defaults to 0.
+    """
+
+    def __init__(self, model, tokenizer, prefix: str, max_new_tokens: int = MAX_NEW_TOKENS, temperature: float = 0.0):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix = prefix
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.device = next(model.parameters()).device
+        self.prefix_ids = None
+        self.prefix_cache = None
+        # Prompts generated, and prompts continued from the prefix cache
+        self.stats = {"prompts": 0, "cached": 0}
+        if prefix:
+            # The last token of the prefix may merge with the text that follows it, so it is left out of the cache
+            self.prefix_ids = tokenizer(prefix, return_tensors="pt").input_ids[:, :-1].to(self.device)
+        if self.prefix_ids is not None and self.prefix_ids.shape[1] > 0:
+            with torch.no_grad():
+                self.prefix_cache = model(self.prefix_ids, use_cache=True).past_key_values
+
+    def _generate(self, input_ids: torch.Tensor, past_key_values=None) -> str:
+        with torch.no_grad():
+            output = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=past_key_values,
+                max_new_tokens=self.max_new_tokens,
+                pad_token_id=self.tokenizer.pad_token_id,
+                **sampling_kwargs(self.temperature),
+            )
+        return self.tokenizer.decode(output[0, input_ids.shape[1]:], skip_special_tokens=True)
+
+    def generate(self, prompt: str) -> str:
+        """Returns the completion of `prompt`."""
+        input_ids = self.tokenizer(prompt, return_tensors="pt").input_ids.to(self.device)
+        self.stats["prompts"] += 1
+        n = 0 if self.prefix_cache is None else self.prefix_ids.shape[1]
+        # Tokens may merge across the end of the prefix, so the cache is only used when the prompt's own
+        # tokenization starts with the prefix tokens, which keeps the output identical to an uncached run
+        if n and input_ids.shape[1] > n and torch.equal(input_ids[0, :n], self.prefix_ids[0]):
+            self.stats["cached"] += 1
+            # generate() extends the cache in place, so every record continues from its own copy
+            return self._generate(input_ids, copy.deepcopy(self.prefix_cache))
+        return self._generate(input_ids)
+
+
+class BatchedGenerator:
+    """
+    Generates completions in dynamic batches of prompts of similar length, so that little compute goes to padding.
+
+    Args:
+        model: The causal LM.
+        tokenizer: Its tokenizer.
+        max_tokens (int, optional): The token budget of a batch, see `length_batches`. Defaults to BATCH_TOKENS.
+        max_batch_size (int, optional): The maximum number of prompts in a batch. Defaults to MAX_BATCH_SIZE.
+        max_new_tokens (int, optional): The maximum number of generated tokens. Defaults to MAX_NEW_TOKENS.
+        temperature (float, optional): The sampling temperature; 0 decodes greedily. Defaults to 0.
+    """
+
+    def __init__(self, model, tokenizer, max_tokens: int = BATCH_TOKENS, max_batch_size: int = MAX_BATCH_SIZE,
+                 max_new_tokens: int = MAX_NEW_TOKENS, temperature: float = 0.0):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.device = next(model.parameters()).device
+        # Prompt tokens and padding tokens of the batches run so far
+        self.stats = {"batches": 0, "tokens": 0, "padding": 0}
+
+    def _generate(self, input_ids: List[List[int]]) -> List[str]:
+        # Left padding keeps the last prompt token of every row next to the generated ones
+        width = max(len(ids) for ids in input_ids)
+        pad = self.tokenizer.pad_token_id
+        batch = torch.tensor([[pad] * (width - len(ids)) + ids for ids in input_ids], device=self.device)
+        attention_mask = torch.tensor([[0] * (width - len(ids)) + [1] * len(ids) for ids in input_ids], device=self.device)
+        self.stats["batches"] += 1
+        self.stats["tokens"] += int(attention_mask.sum())
+        self.stats["padding"] += int(attention_mask.numel() - attention_mask.sum())
+        with torch.no_grad():
+            output = self.model.generate(
+                input_ids=batch,
+                attention_mask=attention_mask,
+                max_new_tokens=self.max_new_tokens,
+                pad_token_id=pad,
+                **sampling_kwargs(self.temperature),
+            )
+        return self.tokenizer.batch_decode(output[:, width:], skip_special_tokens=True)
+
+    def generate_batches(self, prompts: List[str]) -> Iterable[Tuple[List[int], List[str]]]:
+        """
+        Generates the completions of `prompts`, longest prompts first.
+
+        Yields:
+            Tuple[List[int], List[str]]: The indices of the prompts of a batch and their completions.
+        """
+        input_ids = self.tokenizer(prompts).input_ids
+        for indices in length_batches([len(ids) for ids in input_ids], self.max_tokens, self.max_new_tokens, self.max_batch_size):
+            yield indices, self._generate([input_ids[i] for i in indices])
+
+    def generate(self, prompts: List[str]) -> List[str]:
+        """Returns the completions of `prompts`, in order."""
+        outputs = [""] * len(prompts)
+        for indices, completions in self.generate_batches(prompts):
+            for i, completion in zip(indices, completions):
+                outputs[i] = completion
+        return outputs
+
+
+def infer_file(input_file: str, output_file: str, model_name_or_path: str, stage: Optional[str] = None, device: str = "cpu",
+               max_new_tokens: int = MAX_NEW_TOKENS, temperature: float = 0.0, batch_tokens: int = 0,
+               max_batch_size: int = MAX_BATCH_SIZE):
+    """
+    Generates the `test_output` of every line of a test-input file with a local model.
+
+    Args:
+        input_file (str): The JSONL file of test inputs, e.g. written by mst.py.
+        output_file (str): The JSONL file receiving the lines with their `test_output`.
+        model_name_or_path (str): The Hugging Face model.
+        stage (Optional[str], optional): The stage of the test inputs, whose prompt prefix is cached. Defaults to
+            the longest prefix shared by the first PREFIX_SAMPLE_SIZE test inputs.
+        device (str, optional): The torch device. Defaults to "cpu".
+        max_new_tokens (int, optional): The maximum number of generated tokens. Defaults to MAX_NEW_TOKENS.
+        temperature (float, optional): The sampling temperature; 0 decodes greedily. Defaults to 0.
+        batch_tokens (int, optional): The token budget of a batch. If positive, the test inputs are generated in
+            length-bucketed batches by a BatchedGenerator instead of one by one from the prefix cache. Defaults to 0.
+        max_batch_size (int, optional): The maximum number of test inputs in a batch. Defaults to MAX_BATCH_SIZE.
+    """
+    tokenizer, model = load_model(model_name_or_path, device)
+    with jsonlines.open(input_file) as reader:
+        data = [datum for datum in reader if datum["test_input"] != ""]
+    model_name = os.path.basename(model_name_or_path.rstrip("/"))
+    if batch_tokens > 0:
+        generator = BatchedGenerator(model, tokenizer, batch_tokens, max_batch_size, max_new_tokens, temperature)
+        outputs = [""] * len(data)
+        with tqdm.tqdm(total=len(data)) as progress:
+            for indices, completions in generator.generate_batches([datum["test_input"] for datum in data]):
+                for i, completion in zip(indices, completions):
+                    outputs[i] = completion
+                progress.update(len(indices))
+        # The outputs keep the order of the inputs, as utils.merge_jsonl_files matches the stages line by line
+        with jsonlines.open(output_file, "w") as writer:
+            for datum, output in zip(data, outputs):
+                writer.write({"model": model_name, **datum, "test_output": output})
+        stats = generator.stats
+        print(f"{stats['batches']} batches, {stats['padding']} padding tokens for {stats['tokens']} prompt tokens")
+        return
+    prefix = stage_prefix(stage) if stage else common_prefix([datum["test_input"] for datum in data[:PREFIX_SAMPLE_SIZE]])
+    if len(prefix) < MIN_PREFIX_CHARS:
+        prefix = ""
+    print(f"Caching a shared prefix of {len(prefix)} characters")
+    generator = PrefixCachedGenerator(model, tokenizer, prefix, max_new_tokens, temperature)
+    with jsonlines.open(output_file, "w") as writer:
+        for datum in tqdm.tqdm(data):
+            writer.write({"model": model_name, **datum, "test_output": generator.generate(datum["test_input"])})
+    print(f"{generator.stats['cached']} of {generator.stats['prompts']} prompts continued from the prefix cache")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate test outputs with a local Hugging Face model")
+    parser.add_argument("--model_name_or_path", type=str, required=True)
+    parser.add_argument("--input_file", "-i", type=str, required=True, help="path to the test-input file")
+    parser.add_argument("--output_file", "-o", type=str, required=True, help="path to the output file")
+    parser.add_argument("--stage", "-s", type=str, choices=list(STAGE_PROMPT_PATHS), help="stage of the test inputs (default: detect the shared prefix)")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--max_new_tokens", type=int, default=MAX_NEW_TOKENS)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--batch_tokens", type=int, default=0, help=f"token budget of a length-bucketed batch, e.g. {BATCH_TOKENS} (default: no batching, reuse the prefix cache)")
+    parser.add_argument("--max_batch_size", type=int, default=MAX_BATCH_SIZE)
+    args = parser.parse_args()
+    infer_file(args.input_file, args.output_file, args.model_name_or_path, args.stage, args.device, args.max_new_tokens, args.temperature,
+               args.batch_tokens, args.max_batch_size)
@@ -0,0 +1,271 @@
+"""A local stand-in for the OpenAI, Azure OpenAI and Azure content moderator endpoints.
+
+The server speaks enough of the ChatCompletion, Completion, Embedding and Moderation protocols to serve llm.py,
+gpt4.py, convert_dataset.py and azure_content_moderator.py, so client-side throughput can be measured without
+network access or quota. Latency, server errors, throttling (429 with retry-after), content filtering and the
+generated outputs are configurable.
+Typical usage example:
+  python mock_server.py --port 8000 --latency_ms 300 --throttle_rate 0.02
+  # then set "openai_api_base": "http://127.0.0.1:8000/v1", "azure_api_base": "http://127.0.0.1:8000/" and
+  # "content_moderator_endpoint": "http://127.0.0.1:8000" in config/config.json
+"""
+import json, time, random, hashlib, argparse, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+# Dimension of the fake embeddings, the same as text-embedding-ada-002
+EMBEDDING_DIM = 1536
+
+DEFAULT_CONFIG = {
+    # Median latency of a request and the spread of its log-normal distribution
+    "latency_ms": 200.0,
+    "latency_sigma": 0.5,
+    # Fractions of requests answered with a 500, a 429 and a content-filter refusal
+    "error_rate": 0.0,
+    "throttle_rate": 0.0,
+    "filter_rate": 0.0,
+    # Seconds announced in the retry-after header and message of a 429
+    "retry_after": 1,
+    # Template of generated outputs; {prompt} is the last 64 characters of the prompt, {n} the request number
+    "template": "Mock response #{n} to: {prompt}",
+    # If set, outputs are drawn from this list instead of the template
+    "canned_outputs": None,
+    # Number of completion tokens reported in usage
+    "completion_tokens": 64,
+}
+
+
+def _count_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+class MockState:
+    """Configuration and request counters shared by all handler threads."""
+
+    def __init__(self, config: Dict[str, Any]):
+        self.config = {**DEFAULT_CONFIG, **config}
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "ok": 0, "errors": 0, "throttled": 0, "filtered": 0}
+        self.random = random.Random(self.config.get("seed"))
+
+    def next_request(self) -> int:
+        with self.lock:
+            self.counts["requests"] += 1
+            return self.counts["requests"]
+
+    def count(self, outcome: str):
+        with self.lock:
+            self.counts[outcome] += 1
+
+    def latency(self) -> float:
+        with self.lock:
+            return self.random.lognormvariate(0, self.config["latency_sigma"]) * self.config["latency_ms"] / 1000
+
+    def draw(self) -> float:
+        with self.lock:
+            return self.random.random()
+
+    def output(self, prompt: str, n: int) -> str:
+        canned = self.config["canned_outputs"]
+        if canned:
+            return canned[n % len(canned)]
+        return self.config["template"].format(prompt=prompt[-64:], n=n)
+
+
+def _fake_embedding(text: str) -> List[float]:
+    # Deterministic per text, so that identical strings get identical vectors
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    return [rng.gauss(0, 1) for _ in range(EMBEDDING_DIM)]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: MockState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, payload: Any, headers: Optional[Dict[str, str]] = None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            with self.state.lock:
+                self._send(200, dict(self.state.counts))
+        else:
+            self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length)
+        path = self.path.split("?")[0].rstrip("/")
+        n = self.state.next_request()
+        time.sleep(self.state.latency())
+
+        draw = self.state.draw()
+        config = self.state.config
+        if draw < config["throttle_rate"]:
+            self.state.count("throttled")
+            retry_after = config["retry_after"]
+            message = f"Requests to the ChatCompletions_Create Operation have exceeded call rate limit. Please retry after {retry_after} seconds."
+            return self._send(429, {"error": {"code": "429", "message": message}}, {"Retry-After": str(retry_after)})
+        draw -= config["throttle_rate"]
+        if draw < config["error_rate"]:
+            self.state.count("errors")
+            return self._send(500, {"error": {"message": "The server had an error while processing your request.", "type": "server_error"}})
+        draw -= config["error_rate"]
+        if draw < config["filter_rate"]:
+            self.state.count("filtered")
+            message = "The response was filtered due to the prompt triggering Azure OpenAI's content management policy."
+            return self._send(400, {"error": {"code": "content_filter", "message": message, "type": "invalid_request_error"}})
+
+        if path.endswith("/ProcessText/Screen"):
+            self.state.count("ok")
+            return self._send(200, self._moderator_screen(raw.decode("utf-8", errors="replace")))
+        try:
+            request = json.loads(raw or b"{}")
+        except json.JSONDecodeError:
+            return self._send(400, {"error": {"message": "Invalid JSON body", "type": "invalid_request_error"}})
+        if path.endswith("/chat/completions"):
+            response = self._chat_completion(request, n)
+        elif path.endswith("/completions"):
+            response = self._completion(request, n)
+        elif path.endswith("/embeddings"):
+            response = self._embedding(request)
+        elif path.endswith("/moderations"):
+            response = self._moderation(request)
+        else:
+            return self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+        self.state.count("ok")
+        self._send(200, response)
+
+    def _usage(self, prompt: str) -> Dict[str, int]:
+        prompt_tokens = _count_tokens(prompt)
+        completion_tokens = self.state.config["completion_tokens"]
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+    def _chat_completion(self, request: Dict[str, Any], n: int) -> Dict[str, Any]:
+        prompt = "\n".join(m.get("content", "") for m in request.get("messages", []))
+        return {
+            "id": f"chatcmpl-mock-{n}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": self.state.output(prompt, n)}, "finish_reason": "stop"}],
+            "usage": self._usage(prompt),
+        }
+
+    def _completion(self, request: Dict[str, Any], n: int) -> Dict[str, Any]:
+        prompt = request.get("prompt", "")
+        prompt = prompt if isinstance(prompt, str) else "\n".join(prompt)
+        return {
+            "id": f"cmpl-mock-{n}",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "text": self.state.output(prompt, n), "finish_reason": "stop", "logprobs": None}],
+            "usage": self._usage(prompt),
+        }
+
+    def _embedding(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        inputs = request.get("input", [])
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        prompt_tokens = sum(_count_tokens(text) for text in inputs)
+        return {
+            "object": "list",
+            "model": request.get("model", "mock"),
+            "data": [{"object": "embedding", "index": i, "embedding": _fake_embedding(text)} for i, text in enumerate(inputs)],
+            "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+        }
+
+    def _moderation(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        inputs = request.get("input", [])
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        results = []
+        for text in inputs:
+            rng = random.Random(text)
+            scores = {category: rng.random() * 0.1 for category in ("hate", "self-harm", "sexual", "violence")}
+            results.append({"flagged": False, "categories": {c: False for c in scores}, "category_scores": scores})
+        return {"id": "modr-mock", "model": "text-moderation-latest", "results": results}
+
+    def _moderator_screen(self, text: str) -> Dict[str, Any]:
+        rng = random.Random(text)
+        return {
+            "OriginalText": text,
+            "Language": "eng",
+            "Classification": {
+                "ReviewRecommended": False,
+                "Category1": {"Score": rng.random() * 0.1},
+                "Category2": {"Score": rng.random() * 0.1},
+                "Category3": {"Score": rng.random() * 0.1},
+            },
+            "Status": {"Code": 3000, "Description": "OK"},
+        }
+
+
+class MockServer:
+    """
+    Runs the mock endpoints on a background thread, e.g. inside a benchmark.
+
+    Args:
+        host (str, optional): The interface to bind. Defaults to "127.0.0.1".
+        port (int, optional): The port to bind; 0 picks a free port. Defaults to 0.
+        **config: Overrides of DEFAULT_CONFIG.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, **config):
+        self.state = MockState(config)
+        handler = type("BoundMockHandler", (MockHandler,), {"state": self.state})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockServer":
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve mock OpenAI / Azure endpoints for offline benchmarking")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--config", type=str, help="path to a JSON file overriding the default configuration")
+    for key in ("latency_ms", "latency_sigma", "error_rate", "throttle_rate", "filter_rate"):
+        parser.add_argument(f"--{key}", type=float, default=None)
+    parser.add_argument("--retry_after", type=int, default=None)
+    parser.add_argument("--template", type=str, default=None)
+    args = parser.parse_args()
+
+    config = {}
+    if args.config:
+        with open(args.config, "r") as f:
+            config.update(json.load(f))
+    config.update({k: v for k, v in vars(args).items() if k not in ("host", "port", "config") and v is not None})
+    server = MockServer(args.host, args.port, **config)
+    print(f"Serving mock endpoints at {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
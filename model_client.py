@@ -0,0 +1,164 @@
+import time, asyncio
+import openai
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from rate_limiter import get_limiter, estimate_tokens
+from concurrency_controller import get_controller
+from response_cache import get_response_cache
+from retry import RetryPolicy, DEFAULT_RETRY_POLICY, call_with_retry, acall_with_retry
+from telemetry import get_telemetry, request_model
+
+
+def _cache_key(request: Dict[str, Any], prompt: Union[str, List[Dict[str, str]]]) -> str:
+    # Keyed on the logical model, so a response is reused whichever backend or deployment served it
+    return get_response_cache().make_key(request_model(request), request.get("temperature"), request.get("max_tokens"), prompt)
+
+
+def _request(prompt_field: str, prompt: Union[str, List[Dict[str, str]]], temperature: float, max_tokens: Optional[int], kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    request = {prompt_field: prompt, "temperature": temperature, **kwargs}
+    if max_tokens is not None:
+        request["max_tokens"] = max_tokens
+    return request
+
+
+def _cached(deployment: str, request: Dict[str, Any], prompt) -> Tuple[Optional[str], Optional[Any]]:
+    """Looks a request up in the response cache; returns its key, None without a prompt, and the cached response or None."""
+    if prompt is None:
+        return None, None
+    key = _cache_key(request, prompt)
+    cached = get_response_cache().get(key)
+    if cached is not None:
+        get_telemetry().record(deployment, request, cached=True)
+    return key, cached
+
+
+def _call(create: Callable, request: Dict[str, Any], deployment: str, tokens: int, extract: Callable, policy: RetryPolicy,
+          prompt: Optional[Union[str, List[Dict[str, str]]]] = None) -> Any:
+    # Requests with a prompt go through the response cache
+    key, cached = _cached(deployment, request, prompt)
+    if cached is not None:
+        return cached
+    limiter = get_limiter(deployment)
+    controller = get_controller(deployment)
+    # Filled in by the attempts for the telemetry
+    call = {"attempts": 0, "api_seconds": 0.0, "usage": None}
+
+    def attempt(timeout: float) -> Any:
+        limiter.acquire(tokens)
+        with controller.request():
+            call["attempts"] += 1
+            start = time.monotonic()
+            response = create(request_timeout=timeout, **request)
+            call["api_seconds"] = time.monotonic() - start
+        limiter.settle(tokens, response)
+        call["usage"] = response.get("usage")
+        return extract(response)
+
+    start = time.monotonic()
+    try:
+        result = call_with_retry(attempt, policy, description=f"{deployment} request")
+    except Exception:
+        get_telemetry().record(deployment, request, seconds=time.monotonic() - start, attempts=call["attempts"], failed=True)
+        raise
+    get_telemetry().record(deployment, request, call["usage"], time.monotonic() - start, call["api_seconds"], call["attempts"])
+    if key is not None:
+        get_response_cache().put(key, result)
+    return result
+
+
+async def _acall(acreate: Callable, request: Dict[str, Any], deployment: str, tokens: int, extract: Callable, policy: RetryPolicy,
+                 prompt: Optional[Union[str, List[Dict[str, str]]]] = None) -> Any:
+    key, cached = _cached(deployment, request, prompt)
+    if cached is not None:
+        return cached
+    limiter = get_limiter(deployment)
+    controller = get_controller(deployment)
+    call = {"attempts": 0, "api_seconds": 0.0, "usage": None}
+
+    async def attempt(timeout: float) -> Any:
+        await limiter.aacquire(tokens)
+        async with controller.arequest():
+            call["attempts"] += 1
+            start = time.monotonic()
+            # The client timeout does not cover every stall of the connection, so cancel the attempt as well
+            response = await asyncio.wait_for(acreate(request_timeout=timeout, **request), timeout)
+            call["api_seconds"] = time.monotonic() - start
+        await limiter.asettle(tokens, response)
+        call["usage"] = response.get("usage")
+        return extract(response)
+
+    start = time.monotonic()
+    try:
+        result = await acall_with_retry(attempt, policy, description=f"{deployment} request")
+    except Exception:
+        get_telemetry().record(deployment, request, seconds=time.monotonic() - start, attempts=call["attempts"], failed=True)
+        raise
+    get_telemetry().record(deployment, request, call["usage"], time.monotonic() - start, call["api_seconds"], call["attempts"])
+    if key is not None:
+        get_response_cache().put(key, result)
+    return result
+
+
+def _chat_content(response) -> str:
+    return response["choices"][0]["message"]["content"]
+
+
+def _completion_text(response) -> str:
+    return response["choices"][0]["text"]
+
+
+def _embeddings(response) -> List[List[float]]:
+    return [d["embedding"] for d in sorted(response["data"], key=lambda d: d["index"])]
+
+
+def chat_completion(messages: List[Dict[str, str]], deployment: str, temperature: float = 1, max_tokens: Optional[int] = None, policy: RetryPolicy = DEFAULT_RETRY_POLICY, **kwargs) -> str:
+    """
+    Sends a ChatCompletion request through the response cache, the deployment's rate limiter and concurrency
+    controller, and the shared retry policy.
+
+    Args:
+        messages (List[Dict[str, str]]): The chat messages.
+        deployment (str): The deployment whose budget the request uses, e.g. "openai" or "llm-testing-gpt4".
+        temperature (float, optional): The sampling temperature. Defaults to 1.
+        max_tokens (Optional[int], optional): The max_tokens of the request. Defaults to None.
+        policy (RetryPolicy, optional): The retry policy. Defaults to DEFAULT_RETRY_POLICY.
+        **kwargs: Further arguments of the request, e.g. `model` or `engine`.
+
+    Returns:
+        str: The content of the first choice.
+
+    Raises:
+        ContentFilteredError: If the backend filtered the prompt.
+        RetryError: If the request still fails after the retries allowed by `policy`.
+    """
+    request = _request("messages", messages, temperature, max_tokens, kwargs)
+    return _call(openai.ChatCompletion.create, request, deployment, estimate_tokens(messages, max_tokens), _chat_content, policy, messages)
+
+
+async def achat_completion(messages: List[Dict[str, str]], deployment: str, temperature: float = 1, max_tokens: Optional[int] = None, policy: RetryPolicy = DEFAULT_RETRY_POLICY, **kwargs) -> str:
+    """Asynchronous version of `chat_completion`."""
+    request = _request("messages", messages, temperature, max_tokens, kwargs)
+    return await _acall(openai.ChatCompletion.acreate, request, deployment, estimate_tokens(messages, max_tokens), _chat_content, policy, messages)
+
+
+def completion(prompt: str, deployment: str, temperature: float = 1, max_tokens: Optional[int] = None, policy: RetryPolicy = DEFAULT_RETRY_POLICY, **kwargs) -> str:
+    """Sends a Completion request the same way as `chat_completion` and returns the text of the first choice."""
+    request = _request("prompt", prompt, temperature, max_tokens, kwargs)
+    return _call(openai.Completion.create, request, deployment, estimate_tokens(prompt, max_tokens), _completion_text, policy, prompt)
+
+
+async def acompletion(prompt: str, deployment: str, temperature: float = 1, max_tokens: Optional[int] = None, policy: RetryPolicy = DEFAULT_RETRY_POLICY, **kwargs) -> str:
+    """Asynchronous version of `completion`."""
+    request = _request("prompt", prompt, temperature, max_tokens, kwargs)
+    return await _acall(openai.Completion.acreate, request, deployment, estimate_tokens(prompt, max_tokens), _completion_text, policy, prompt)
+
+
+def embedding(inputs: List[str], deployment: str, policy: RetryPolicy = DEFAULT_RETRY_POLICY, **kwargs) -> List[List[float]]:
+    """
+    Sends one Embedding request for `inputs` through the rate limiter, concurrency controller and retry policy.
+
+    Returns:
+        List[List[float]]: One embedding per input, in the order of `inputs`.
+    """
+    request = {"input": inputs, **kwargs}
+    return _call(openai.Embedding.create, request, deployment, estimate_tokens(inputs, max_tokens=0), _embeddings, policy)
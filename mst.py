@@ -1,8 +1,10 @@
 import jsonlines
-from typing import Dict, List
-import argparse, random
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import argparse, random, itertools, collections
+import multiprocessing as mp
 
-from reflection_checker import reflection_checker
+from prompt_template import load_template
+from pruning import PRUNING_RULES, DEFAULT_PRUNING_RULES, NO_PRUNING, PruningPlanner, parse_rules
 
 STAGE_SUGGESTION = "suggestion"
 STAGE_CRITIQUE = "critique"
@@ -17,20 +19,22 @@ REFLECTION_EXPLAIN_PROMPT_PATH = "prompts/reflection-explain.prompt"
 REFLECTION_REFINE_PROMPT_PATH = "prompts/refine.prompt"
 CONSOLIDATE_PROMPT_PATH = "prompts/consolidate.prompt"
 
+# Number of input lines transformed per chunk when streaming
+CHUNK_SIZE = 1024
+
 PRECEEDING_STAGE = {
     STAGE_SUGGESTION: None,
     STAGE_CRITIQUE: STAGE_SUGGESTION,
     STAGE_REFLECTION: STAGE_CRITIQUE,
     STAGE_REFLECTION_EXPLAIN: STAGE_CRITIQUE,
-    STAGE_REFINE: STAGE_REFLECTION
+    STAGE_REFINE: STAGE_REFLECTION,
+    STAGE_CONSOLIDATE: STAGE_REFINE,
 }
 
-def has_critique(datum: Dict[str, str]):
-    assert "critique" in datum
-    return "none" not in datum["critique"].lower()
-
+# Skips the calls made unnecessary by the earlier outputs of a record; see pruning.py
+PRUNING_PLANNER = PruningPlanner()
 
-def testinput_generation(datum: Dict[str, str], stage: str) -> Dict[str, str]:
+def testinput_generation(datum: Dict[str, str], stage: str, planner: Optional[PruningPlanner] = None) -> Dict[str, str]:
     """
     Generates test input for a machine learning model based on the given input data and stage.
 
@@ -39,9 +43,11 @@ def testinput_generation(datum: Dict[str, str], stage: str) -> Dict[str, str]:
             field, and "suggestion" and "critique" fields depending on the stage parameter.
         stage (str): A string indicating the stage for which to generate a test input. This parameter should be one of
             "suggestion", "critique", or "reflection".
+        planner (PruningPlanner, optional): Decides whether the call is needed at all. Defaults to PRUNING_PLANNER.
 
     Returns:
         Dict[str, str]: A dictionary containing the "test_input" field and any other fields from the "datum" parameter.
+            The "test_input" is empty if the planner pruned the call.
 
     Raises:
         ValueError: If the input data does not contain the required fields, or if the stage parameter is invalid.
@@ -64,80 +70,139 @@ def testinput_generation(datum: Dict[str, str], stage: str) -> Dict[str, str]:
 
         if stage == STAGE_CRITIQUE:
             prompt_path = CRITIQUE_PROMPT_PATH
-            replacement_fields = {"$context$": datum["context"], "$suggestion$": datum["suggestion"]}
+            replacement_fields = {"context": datum["context"], "suggestion": datum["suggestion"]}
         elif stage == STAGE_REFLECTION:
             prompt_path = REFLECTION_PROMPT_PATH
-            replacement_fields = {"$context$": datum["context"], "$suggestion$": datum["suggestion"], "$critique$": datum["critique"]}
+            replacement_fields = {"context": datum["context"], "suggestion": datum["suggestion"], "critique": datum["critique"]}
         elif stage == STAGE_REFLECTION_EXPLAIN:
             prompt_path = REFLECTION_EXPLAIN_PROMPT_PATH
-            replacement_fields = {"$context$": datum["context"], "$suggestion$": datum["suggestion"], "$critique$": datum["critique"]}
+            replacement_fields = {"context": datum["context"], "suggestion": datum["suggestion"], "critique": datum["critique"]}
         elif stage == STAGE_REFINE:
             prompt_path = REFLECTION_REFINE_PROMPT_PATH
-            replacement_fields = {"$context$": datum["context"], "$suggestion$": datum["suggestion"], "$critique$": datum["critique"]}
+            replacement_fields = {"context": datum["context"], "suggestion": datum["suggestion"], "critique": datum["critique"]}
         elif stage == STAGE_CONSOLIDATE:
             prompt_path = CONSOLIDATE_PROMPT_PATH
-            initial_suggestion_first = random.random() < 0.5
+            # The order is random unless the datum already fixes it, e.g. when a run is resumed
+            initial_suggestion_first = datum["initial_suggestion_first"] if "initial_suggestion_first" in datum else random.random() < 0.5
             if initial_suggestion_first:
-                replacement_fields = {"$context$": datum["context"], "$suggestion1$": datum["suggestion"], "$suggestion2$": datum["refine"]}
+                replacement_fields = {"context": datum["context"], "suggestion1": datum["suggestion"], "suggestion2": datum["refine"]}
             else:
-                replacement_fields = {"$context$": datum["context"], "$suggestion1$": datum["refine"], "$suggestion2$": datum["suggestion"]}
+                replacement_fields = {"context": datum["context"], "suggestion1": datum["refine"], "suggestion2": datum["suggestion"]}
             datum["initial_suggestion_first"] = initial_suggestion_first
         else:
             raise ValueError("Invalid stage value")
 
-        try:
-            with open(prompt_path, "r") as f:
-                prompt = f.read()
-        except IOError:
-            raise IOError(f"Could not read {prompt_path}")
-
-        for field, value in replacement_fields.items():
-            prompt = prompt.replace(field, value)
+        # The template is read and compiled once per process and filled in a single pass
+        prompt = load_template(prompt_path).fill(replacement_fields)
 
-        if False: # (stage == STAGE_REFLECTION or stage == STAGE_REFLECTION_EXPLAIN) and not has_critique(datum):
-            test_input = ""
-        elif stage == STAGE_REFINE and not reflection_checker({"test_output": datum["reflection"]}):
-            test_input = ""
-        elif stage == STAGE_CONSOLIDATE and datum["refine"].strip() == "":
+        planner = PRUNING_PLANNER if planner is None else planner
+        rule = planner.skip_rule(stage, datum)
+        if rule is not None:
+            planner.record(stage, rule, prompt)
             test_input = ""
         else:
             test_input = prompt
 
     return {"test_input": test_input, **datum}
 
-def generate_test_inputs_from_jsonl(source_path: str, input_path: str, output_path: str, stage: str, is_merged: bool = False):
-    # Open the source file in read mode.
-    with jsonlines.open(source_path, "r") as source_reader:
-        data1 = list(source_reader)
-        # Open the input file in read mode.
-        with jsonlines.open(input_path, "r") as reader:
-            data2 = list(reader)
-            if STAGE_CONSOLIDATE == stage:
-                data2 = data2[:1000]
-            # Open the output file in write mode.
-            with jsonlines.open(output_path, "w") as writer:
-                # For each line in the input file, process the data and write it to the output file.
-                for idx, datum in enumerate(data2):
-                    # Process the data and write it to the output file.
-                    # this is a merged jsonl file
-                    # if is_merged and PRECEEDING_STAGE[stage] in datum:
-                    #     data2[idx][PRECEEDING_STAGE[stage]] = datum[PRECEEDING_STAGE[stage]]
-                    #     if stage == STAGE_REFLECTION or stage == STAGE_REFLECTION_EXPLAIN:
-                    #         data2[idx]["suggestion"] = datum["suggestion"]
-                    # else: data1[idx][PRECEEDING_STAGE[stage]] = datum["test_output"]
-                    # if is_merged:
-                    #     data2[idx][PRECEEDING_STAGE[stage]] = datum["test_output"]
-                    #     if stage == STAGE_REFLECTION or stage == STAGE_REFLECTION_EXPLAIN:
-                    #         data2[idx]["suggestion"] = datum["suggestion"]
-                    new_datum = {
-                        "context": datum["test_input"] if  (stage == STAGE_CRITIQUE and "test_input" in datum) else datum["context"] if "context" in datum else datum["text"],
-                        "suggestion": datum["test_output"] if stage == STAGE_CRITIQUE else datum["suggestion"],
-                        "critique": "" if stage == STAGE_CRITIQUE else datum["test_output"] if datum["critique"] == "" else datum["critique"],
-                        "reflection": datum["test_output"] if stage == STAGE_REFINE else "",
-                        "refine": datum["test_output"] if stage == STAGE_CONSOLIDATE else "",
-                    }
-                    result = testinput_generation(new_datum, stage)
-                    if result is not None and result["test_input"] != "": writer.write(result)
+def testinput_generation_batch(data: Iterable[Dict[str, str]], stage: str, planner: Optional[PruningPlanner] = None) -> List[Dict[str, str]]:
+    """
+    Batch version of `testinput_generation`, e.g. for a chunk of records handed to a worker process.
+
+    Args:
+        data (Iterable[Dict[str, str]]): The input data dictionaries.
+        stage (str): The stage for which to generate test inputs.
+        planner (PruningPlanner, optional): Decides whether each call is needed at all. Defaults to PRUNING_PLANNER.
+
+    Returns:
+        List[Dict[str, str]]: One result per input, in the same order.
+    """
+    return [testinput_generation(datum, stage, planner) for datum in data]
+
+def build_datum(datum: Dict[str, str], stage: str) -> Dict[str, str]:
+    """Maps one line of the preceding stage's output to the fields `testinput_generation` expects for `stage`."""
+    return {
+        "context": datum["test_input"] if  (stage == STAGE_CRITIQUE and "test_input" in datum) else datum["context"] if "context" in datum else datum["text"],
+        "suggestion": datum["test_output"] if stage == STAGE_CRITIQUE else datum["suggestion"],
+        "critique": "" if stage == STAGE_CRITIQUE else datum["test_output"] if datum["critique"] == "" else datum["critique"],
+        "reflection": datum["test_output"] if stage == STAGE_REFINE else "",
+        "refine": datum["test_output"] if stage == STAGE_CONSOLIDATE else "",
+    }
+
+def transform_chunk(chunk: List[Dict[str, str]], stage: str, planner: Optional[PruningPlanner] = None) -> List[Dict[str, str]]:
+    """Generates the test inputs of a chunk of input lines, dropping the records that need no model call."""
+    results = testinput_generation_batch((build_datum(datum, stage) for datum in chunk), stage, planner)
+    return [result for result in results if result is not None and result["test_input"] != ""]
+
+def _transform_chunk_in_worker(chunk: List[Dict[str, str]], stage: str, rules: List[str]) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+    # The pruning counts of a worker are sent back with its results
+    planner = PruningPlanner(rules)
+    return transform_chunk(chunk, stage, planner), planner.stats
+
+def _seed_worker():
+    # Forked workers would otherwise share the parent's random state, e.g. for the consolidate ordering
+    random.seed()
+
+def _chunks(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def generate_test_inputs(data: Iterable[Dict[str, str]], stage: str, workers: int = 1, chunk_size: int = CHUNK_SIZE,
+                         planner: Optional[PruningPlanner] = None) -> Iterator[Dict[str, str]]:
+    """
+    Lazily generates the test inputs of a stream of input lines, in input order.
+
+    Args:
+        data (Iterable[Dict[str, str]]): The lines of the preceding stage's output.
+        stage (str): The stage for which to generate test inputs.
+        workers (int, optional): The number of processes transforming chunks in parallel; 1 transforms in this process. Defaults to 1.
+        chunk_size (int, optional): The number of lines per chunk handed to a worker. Defaults to CHUNK_SIZE.
+        planner (PruningPlanner, optional): Decides which calls are needed and counts the skipped ones. Defaults to PRUNING_PLANNER.
+
+    Yields:
+        Dict[str, str]: The generated test inputs.
+    """
+    planner = PRUNING_PLANNER if planner is None else planner
+    if workers <= 1:
+        for chunk in _chunks(data, chunk_size):
+            yield from transform_chunk(chunk, stage, planner)
+        return
+    # Only a bounded window of chunks is in flight, so memory does not grow with the input
+    with mp.Pool(workers, initializer=_seed_worker) as pool:
+        pending = collections.deque()
+        for chunk in _chunks(data, chunk_size):
+            pending.append(pool.apply_async(_transform_chunk_in_worker, (chunk, stage, planner.rules)))
+            while len(pending) >= 2 * workers or (pending and pending[0].ready()):
+                results, stats = pending.popleft().get()
+                planner.merge(stats)
+                yield from results
+        while pending:
+            results, stats = pending.popleft().get()
+            planner.merge(stats)
+            yield from results
+
+def generate_test_inputs_from_jsonl(source_path: str, input_path: str, output_path: str, stage: str, is_merged: bool = False, workers: int = 1):
+    """
+    Streams the input file through `generate_test_inputs` into the output file; memory stays bounded by the chunk
+    window regardless of the file size, and the first outputs are written right away.
+
+    `source_path` is kept for compatibility with existing callers; every field needed comes from the input file.
+    """
+    # Open the input file in read mode.
+    with jsonlines.open(input_path, "r") as reader:
+        data = iter(reader)
+        if STAGE_CONSOLIDATE == stage:
+            data = itertools.islice(data, 1000)
+        # Open the output file in write mode.
+        with jsonlines.open(output_path, "w") as writer:
+            # For each line in the input file, process the data and write it to the output file.
+            for result in generate_test_inputs(data, stage, workers=workers):
+                writer.write(result)
+    PRUNING_PLANNER.report()
 
 if __name__ == "__main__":
     # Parse command line arguments.
@@ -146,8 +211,11 @@ if __name__ == "__main__":
     parser.add_argument("--input_path", "-i", type=str, help="Path to the input JSONL file")
     parser.add_argument("--output_path", "-o", type=str, help="Path to the output JSONL file")
     parser.add_argument("--merged_path", "-m", type=str, help="Path to the merged JSONL file")
+    parser.add_argument("--workers", "-w", type=int, default=1, help="Number of processes generating test inputs")
+    parser.add_argument("--prune_rules", nargs="*", default=DEFAULT_PRUNING_RULES, choices=list(PRUNING_RULES) + [NO_PRUNING], help="Rules skipping unnecessary calls; pass none (or no rule) to disable pruning")
     parser.add_argument("--stage", "-s", type=str, required=True, help="Stage for which to generate test inputs", choices=[STAGE_SUGGESTION, STAGE_CRITIQUE, STAGE_REFLECTION, STAGE_REFLECTION_EXPLAIN, STAGE_REFINE, STAGE_CONSOLIDATE])
     args = parser.parse_args()
     print(args)
+    PRUNING_PLANNER = PruningPlanner(parse_rules(args.prune_rules))
     # Generate test inputs.
-    generate_test_inputs_from_jsonl(args.source_path, args.merged_path if args.merged_path else args.input_path, args.output_path, args.stage, is_merged=args.merged_path is not None)
\ No newline at end of file
+    generate_test_inputs_from_jsonl(args.source_path, args.merged_path if args.merged_path else args.input_path, args.output_path, args.stage, is_merged=args.merged_path is not None, workers=args.workers)
\ No newline at end of file
@@ -4,36 +4,97 @@ import jsonlines, tqdm, copy
 from typing import List, Dict, Any, Set
 import multiprocessing as mp
 import numpy as np
+from rate_limiter import estimate_tokens
+from model_client import embedding
+from embedding_cache import cached_embed
+from drift import cosine_distances
 
 
 
-# Define constants for retrying requests
-MAX_RETRIES = 5
-RETRY_DELAY_SECONDS = 2
+# Limits of a single embedding request
+MAX_BATCH_INPUTS = 2048
+MAX_BATCH_TOKENS = 50000
 
-def get_embedding(text, model="text-embedding-ada-002"):
-    import openai
-    # Set up OpenAI API credentials by reading from config/config.json
+_api_key_loaded = False
+
+def load_api_key():
+    """Sets up OpenAI API credentials by reading from config/config.json, once per process."""
+    global _api_key_loaded
+    if _api_key_loaded:
+        return
     with open("config/config.json", "r") as f:
         config = json.load(f)
         openai.api_key = config["openai_api_key"]
-    for retry in range(MAX_RETRIES):
-            try:
-                response = openai.Embedding.create(input = [text], model=model)
-                return response['data'][0]['embedding']
-            except Exception as e:
-                if retry < MAX_RETRIES - 1:
-                    print(f"Error making Chat request: {e}. Retrying in {RETRY_DELAY_SECONDS} seconds...")
-                    time.sleep(RETRY_DELAY_SECONDS)
-                else:
-                    raise e
+        if "openai_api_base" in config:
+            openai.api_base = config["openai_api_base"]
+    _api_key_loaded = True
+
+def split_batches(texts: List[str], max_inputs: int = MAX_BATCH_INPUTS, max_tokens: int = MAX_BATCH_TOKENS) -> List[List[str]]:
+    """
+    Packs texts into as few requests as possible without exceeding the input count or token budget of a request.
+
+    Args:
+        texts (List[str]): The texts to pack.
+        max_inputs (int, optional): The maximum number of inputs per request. Defaults to MAX_BATCH_INPUTS.
+        max_tokens (int, optional): The maximum estimated tokens per request. Defaults to MAX_BATCH_TOKENS.
+
+    Returns:
+        List[List[str]]: The batches, in the order of `texts`.
+    """
+    batches = []
+    current = []
+    current_tokens = 0
+    for text in texts:
+        tokens = estimate_tokens(text, max_tokens=0)
+        if current and (len(current) >= max_inputs or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(text)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def embed_batch(batch: List[str], model: str = "text-embedding-ada-002") -> List[List[float]]:
+    """
+    Embeds one batch of texts with a single request.
+
+    Raises:
+        Exception: If there is an error while making the API request.
+    """
+    return embedding(batch, "openai", model=model)
+
+def get_embeddings(texts: List[str], model: str = "text-embedding-ada-002", show_progress: bool = False) -> np.ndarray:
+    """
+    Embeds many texts with as few requests as possible.
+
+    Texts found in the embedding cache are not requested again. The remaining unique texts are packed into requests
+    by input count and token budget.
+
+    Args:
+        texts (List[str]): The texts to embed.
+        model (str, optional): The embedding model. Defaults to "text-embedding-ada-002".
+        show_progress (bool, optional): Whether to show a progress bar over the requests. Defaults to False.
+
+    Returns:
+        np.ndarray: A float32 matrix with one row per text, in the order of `texts`.
+    """
+    def embed_missing(missing: List[str]) -> np.ndarray:
+        load_api_key()
+        batches = split_batches(missing)
+        vectors = []
+        for batch in (tqdm.tqdm(batches) if show_progress else batches):
+            vectors.extend(embed_batch(batch, model))
+        return np.asarray(vectors, dtype=np.float32)
+
+    return cached_embed(texts, model, embed_missing)
+
+def get_embedding(text, model="text-embedding-ada-002"):
+    return get_embeddings([text], model)[0].tolist()
 
 def get_cosine_distance(initial_suggestion: str, refined_suggestion: str):
-    # Get embeddings for the initial and refined suggestion
-    initial_embed = get_embedding(initial_suggestion)
-    refined_embed = get_embedding(refined_suggestion)
-    
-    # Calculate cosine distance between embeddings using numpy
-    cosine_distance = np.dot(initial_embed, refined_embed)/(np.linalg.norm(initial_embed)*np.linalg.norm(refined_embed))
-    
-    return 1 - cosine_distance
\ No newline at end of file
+    # Get embeddings for the initial and refined suggestion with a single request
+    initial_embed, refined_embed = get_embeddings([initial_suggestion, refined_suggestion])
+
+    return float(cosine_distances(initial_embed[None], refined_embed[None])[0])
@@ -0,0 +1,127 @@
+import os, json, time, queue, threading
+from typing import Any, Dict, Optional
+
+from completion_index import CompletionIndex
+
+# Maximum number of records written in one batch
+SINK_BATCH_SIZE = 512
+# Seconds between flushes (and fsyncs) of a partially filled batch
+SINK_FLUSH_INTERVAL = 1.0
+
+_CLOSE = object()
+
+
+class OutputSink:
+    """
+    A single writer thread that appends JSON records to one JSONL file.
+
+    Workers hand their results to `write`, which only puts them on a queue, so they never wait for the lock or the
+    file. The writer keeps the file open and writes the records in batches, flushing and fsyncing them at least every
+    `flush_interval` seconds, so an interrupted run loses at most that much output.
+
+    Args:
+        path (str): The output JSONL file; records are appended.
+        batch_size (int, optional): The maximum number of records per batch. Defaults to SINK_BATCH_SIZE.
+        flush_interval (float, optional): The maximum age of an unflushed record in seconds. Defaults to SINK_FLUSH_INTERVAL.
+        fsync (bool, optional): Whether every flush is also fsynced to disk. Defaults to True.
+        index (CompletionIndex, optional): The completion index of the file, updated after every flushed batch.
+    """
+
+    def __init__(self, path: str, batch_size: int = SINK_BATCH_SIZE, flush_interval: float = SINK_FLUSH_INTERVAL, fsync: bool = True,
+                 index: Optional[CompletionIndex] = None):
+        self.path = path
+        self.index = index
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.queue = queue.Queue()
+        self.written = 0
+        self.error: Optional[BaseException] = None
+        self._submitted = 0
+        self._behind_since: Optional[float] = None
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+        self._thread = threading.Thread(target=self._run, name=f"OutputSink({os.path.basename(path)})", daemon=True)
+        self._thread.start()
+
+    def write(self, record: Dict[str, Any]):
+        """Queues one record for writing; never blocks on file I/O."""
+        if self.error is not None:
+            raise RuntimeError(f"Error: the writer of {self.path} failed") from self.error
+        with self._lock:
+            self._submitted += 1
+            if self._behind_since is None:
+                self._behind_since = time.monotonic()
+        self.queue.put(record)
+
+    def lag(self) -> Dict[str, float]:
+        """
+        Reports how far the writer is behind the workers.
+
+        Returns:
+            Dict[str, float]: The number of records not yet flushed to the file and the seconds since the writer was
+                last caught up.
+        """
+        with self._lock:
+            pending = self._submitted - self.written
+            age = time.monotonic() - self._behind_since if self._behind_since is not None else 0.0
+        return {"pending": pending, "seconds": age}
+
+    def _flush(self, batch: list):
+        lines = [json.dumps(record, ensure_ascii=False) + "\n" for record in batch]
+        start = self._file.tell()
+        if lines:
+            self._file.write("".join(lines))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        if batch and self.index is not None:
+            # Line offsets let the index read a record back
+            starts = []
+            for line in lines:
+                starts.append(start)
+                start += len(line.encode("utf-8"))
+            # Only records already on disk are marked as completed
+            self.index.add(batch, self._file.tell(), starts)
+        with self._lock:
+            self.written += len(batch)
+            if self.written == self._submitted:
+                self._behind_since = None
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        try:
+            while True:
+                try:
+                    record = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    record = None
+                if record is _CLOSE:
+                    break
+                if record is not None:
+                    batch.append(record)
+                    if len(batch) < self.batch_size and time.monotonic() < deadline:
+                        continue
+                if batch:
+                    self._flush(batch)
+                    batch = []
+                deadline = time.monotonic() + self.flush_interval
+            self._flush(batch)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self._file.close()
+
+    def close(self):
+        """Writes the remaining records and closes the file."""
+        self.queue.put(_CLOSE)
+        self._thread.join()
+        if self.error is not None:
+            raise RuntimeError(f"Error: the writer of {self.path} failed") from self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
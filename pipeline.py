@@ -0,0 +1,190 @@
+"""Streaming orchestrator of the SCR stages.
+
+Runs suggestion -> critique -> reflection -> refine -> consolidate (the PRECEEDING_STAGE chain of mst.py) as one
+streaming DAG: every record moves on to the next stage as soon as its previous response arrives, instead of each stage
+waiting for the whole file of the stage before it. Each stage has its own concurrency limit and writes its own output
+file, in the same format as llm.py, through an OutputSink with a completion index.
+
+A run can be resumed: prompts already in a stage's output are neither sent nor written again; their recorded responses
+are read back through the stage's completion index and passed on to the next stages.
+Typical usage example:
+  python pipeline.py -i ethics/processed/rewritten_test.jsonl -o outputs/chatgpt --stage_concurrency critique=100
+"""
+import os, json, asyncio, argparse
+from typing import Any, Dict, List, Optional
+
+import jsonlines, tqdm
+
+import llm
+from mst import (PRECEEDING_STAGE, STAGE_SUGGESTION, STAGE_CRITIQUE, STAGE_REFLECTION, STAGE_REFINE, STAGE_CONSOLIDATE,
+                 build_datum, testinput_generation)
+from engine import AsyncEngine
+from output_sink import OutputSink
+from completion_index import CompletionIndex
+from retry import RetryError, ContentFilteredError
+from pruning import PRUNING_RULES, DEFAULT_PRUNING_RULES, NO_PRUNING, PruningPlanner, parse_rules
+from telemetry import telemetry_context
+
+STAGES = [STAGE_SUGGESTION, STAGE_CRITIQUE, STAGE_REFLECTION, STAGE_REFINE, STAGE_CONSOLIDATE]
+# Default number of requests in flight per stage
+STAGE_CONCURRENCY = 100
+# Default number of source records in flight across all stages
+MAX_RECORDS_IN_FLIGHT = 1000
+
+
+class StagePipeline:
+    """
+    Streams source records through the SCR stages.
+
+    Args:
+        output_dir (str): The directory receiving one `<stage>.jsonl` output per stage.
+        stages (List[str], optional): The stages to run. The input file holds the source records, or the output of the
+            stage preceding the first one run. Defaults to STAGES.
+        concurrency (Dict[str, int], optional): Requests in flight per stage. Missing stages get STAGE_CONCURRENCY.
+        max_records_in_flight (int, optional): Source records being processed at a time. Defaults to MAX_RECORDS_IN_FLIGHT.
+        pruning_rules (List[str], optional): The rules skipping unnecessary calls. Defaults to DEFAULT_PRUNING_RULES.
+    """
+
+    def __init__(self, output_dir: str, stages: Optional[List[str]] = None, concurrency: Optional[Dict[str, int]] = None,
+                 max_records_in_flight: int = MAX_RECORDS_IN_FLIGHT, pruning_rules: Optional[List[str]] = None):
+        self.output_dir = output_dir
+        self.planner = PruningPlanner(pruning_rules)
+        self.stages = stages or STAGES
+        for stage in self.stages:
+            if stage not in PRECEEDING_STAGE:
+                raise ValueError(f"Error: unknown stage {stage}.")
+        self.concurrency = {stage: (concurrency or {}).get(stage, STAGE_CONCURRENCY) for stage in self.stages}
+        self.max_records_in_flight = max_records_in_flight
+        # The DAG: the stages consuming the output of each stage
+        self.next_stages = {stage: [s for s in self.stages if PRECEEDING_STAGE[s] == stage] for stage in self.stages}
+        self.roots = [stage for stage in self.stages if PRECEEDING_STAGE[stage] not in self.stages]
+        if len({PRECEEDING_STAGE[stage] for stage in self.roots}) > 1:
+            raise ValueError(f"Error: stages {self.roots} do not consume the same input.")
+        self.counts = {stage: {"calls": 0, "resumed": 0, "skipped": 0, "failed": 0} for stage in self.stages}
+
+    def output_path(self, stage: str) -> str:
+        return os.path.join(self.output_dir, f"{stage}.jsonl")
+
+    def _generate(self, stage: str, datum: Dict[str, Any]) -> Dict[str, Any]:
+        if stage == STAGE_SUGGESTION:
+            return {"test_input": datum["text"], **datum}
+        new_datum = build_datum(datum, stage)
+        if stage == STAGE_CONSOLIDATE:
+            # The order of the two suggestions is random; keep the order of an earlier run when resuming
+            for initial_suggestion_first in (True, False):
+                # A throwaway planner, so that the lookup does not count pruned calls twice
+                generated = testinput_generation({**new_datum, "initial_suggestion_first": initial_suggestion_first}, stage, PruningPlanner(self.planner.rules))
+                if generated["test_input"] in self.indexes[stage]:
+                    return generated
+        return testinput_generation(new_datum, stage, self.planner)
+
+    async def _run_stage(self, stage: str, datum: Dict[str, Any]):
+        generated = self._generate(stage, datum)
+        if generated["test_input"] == "":
+            # The planner pruned the call; nothing downstream of it is needed
+            self.counts[stage]["skipped"] += 1
+            return
+        # A prompt answered by an earlier run is not sent again; its recorded response feeds the next stages
+        recorded = self.indexes[stage].get(generated["test_input"])
+        if recorded is not None and "test_output" in recorded:
+            self.counts[stage]["resumed"] += 1
+            output_line = {"model": llm.MODEL, **generated, "test_output": recorded["test_output"]}
+        else:
+            try:
+                async with self.semaphores[stage]:
+                    with telemetry_context(stage, self.input_file):
+                        response = await (llm.achatgpt if llm.MODEL == "chatgpt" else llm.agpt3)(generated["test_input"])
+            except (RetryError, ContentFilteredError) as e:
+                print(f"Skipping {stage} input: {e}")
+                self.counts[stage]["failed"] += 1
+                return
+            output_line = {"model": llm.MODEL, **generated, "test_output": response}
+            self.counts[stage]["calls"] += 1
+            self.sinks[stage].write(output_line)
+        await asyncio.gather(*[self._run_stage(next_stage, output_line) for next_stage in self.next_stages[stage]])
+
+    async def _run_record(self, record: Dict[str, Any], admission: asyncio.Semaphore, progress: tqdm.tqdm):
+        try:
+            await asyncio.gather(*[self._run_stage(stage, record) for stage in self.roots])
+        finally:
+            admission.release()
+            progress.update()
+
+    async def _run(self, reader):
+        self.semaphores = {stage: asyncio.Semaphore(n) for stage, n in self.concurrency.items()}
+        admission = asyncio.Semaphore(self.max_records_in_flight)
+        tasks = set()
+        errors = []
+
+        def done(task):
+            tasks.discard(task)
+            # Only retries and content filtering are handled per record; anything else is fatal and must not be lost
+            if not task.cancelled() and task.exception() is not None:
+                errors.append(task.exception())
+
+        with tqdm.tqdm(desc="records") as progress:
+            # Records are admitted lazily, so memory is bounded by max_records_in_flight
+            for record in reader:
+                await admission.acquire()
+                if errors:
+                    break
+                task = asyncio.ensure_future(self._run_record(record, admission, progress))
+                tasks.add(task)
+                task.add_done_callback(done)
+                progress.set_postfix({stage: sink.lag()["pending"] for stage, sink in self.sinks.items()}, refresh=False)
+            # Records already in flight drain so their outputs are written before the first fatal error is raised
+            await asyncio.gather(*list(tasks), return_exceptions=True)
+        if errors:
+            print(f"Stopping after {len(errors)} record(s) failed with a fatal error")
+            raise errors[0]
+
+    def run(self, input_file: str) -> Dict[str, Dict[str, int]]:
+        """
+        Runs every record of `input_file` (e.g. ethics/processed/rewritten_test.jsonl) through the stages.
+
+        Returns:
+            Dict[str, Dict[str, int]]: Per stage, the new calls, resumed calls, skipped records and failed records.
+        """
+        if not os.path.exists(input_file):
+            raise Exception(f"Error: input file {input_file} does not exist.")
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.input_file = input_file
+        self.indexes = {stage: CompletionIndex(self.output_path(stage), "test_input") for stage in self.stages}
+        self.sinks = {stage: OutputSink(self.output_path(stage), index=self.indexes[stage]) for stage in self.stages}
+        try:
+            with AsyncEngine(sum(self.concurrency.values())) as engine, jsonlines.open(input_file) as reader:
+                engine.run(self._run(reader))
+        finally:
+            for stage in self.stages:
+                self.sinks[stage].close()
+                self.indexes[stage].close()
+        for stage, counts in self.counts.items():
+            print(f"{stage}: {json.dumps(counts)}")
+        self.planner.report()
+        return self.counts
+
+
+def parse_stage_concurrency(values: List[str]) -> Dict[str, int]:
+    concurrency = {}
+    for value in values:
+        stage, _, n = value.partition("=")
+        concurrency[stage] = int(n)
+    return concurrency
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream records through the SCR stages")
+    parser.add_argument("--input_file", "-i", type=str, required=True, help="path to the source JSONL file")
+    parser.add_argument("--output_dir", "-o", type=str, required=True, help="directory of the per-stage output files")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="stages to run")
+    parser.add_argument("--model", "-m", type=str, choices=["chatgpt", "gpt3"], default="chatgpt", help="model to use (default: chatgpt)")
+    parser.add_argument("--concurrency", "-c", type=int, default=STAGE_CONCURRENCY, help=f"requests in flight per stage (default: {STAGE_CONCURRENCY})")
+    parser.add_argument("--stage_concurrency", nargs="*", default=[], help="per-stage overrides, e.g. critique=50")
+    parser.add_argument("--max_records_in_flight", type=int, default=MAX_RECORDS_IN_FLIGHT)
+    parser.add_argument("--prune_rules", nargs="*", default=DEFAULT_PRUNING_RULES, choices=list(PRUNING_RULES) + [NO_PRUNING], help="rules skipping unnecessary calls; pass none (or no rule) to disable pruning")
+    args = parser.parse_args()
+
+    llm.MODEL = args.model
+    concurrency = {stage: args.concurrency for stage in args.stages}
+    concurrency.update(parse_stage_concurrency(args.stage_concurrency))
+    StagePipeline(args.output_dir, args.stages, concurrency, args.max_records_in_flight, parse_rules(args.prune_rules)).run(args.input_file)
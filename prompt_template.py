@@ -0,0 +1,64 @@
+import re
+from typing import Dict, Iterable, List
+
+# Placeholders look like $context$ or $suggestion1$
+PLACEHOLDER_PATTERN = re.compile(r"\$([A-Za-z_][A-Za-z0-9_]*)\$")
+
+
+class PromptTemplate:
+    """
+    A prompt file compiled once into literal text and placeholders.
+
+    `fill` substitutes all placeholders in a single pass, so a `$...$` token inside an inserted value (e.g. a context
+    that happens to contain "$critique$") is never substituted again. Placeholders without a value are kept as they are.
+
+    Args:
+        text (str): The template text.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        parts = PLACEHOLDER_PATTERN.split(text)
+        # split() alternates literal text and placeholder names
+        self.fields: List[str] = parts[1::2]
+        # The instruction text shared by every prompt filled from this template
+        self.prefix = parts[0]
+        literals = [literal.replace("{", "{{").replace("}", "}}") for literal in parts[0::2]]
+        self._format = literals[0] + "".join(f"{{{i}}}{literal}" for i, literal in enumerate(literals[1:]))
+
+    def fill(self, values: Dict[str, str]) -> str:
+        """
+        Fills the template.
+
+        Args:
+            values (Dict[str, str]): The values by placeholder name, e.g. {"context": ..., "suggestion": ...}.
+
+        Returns:
+            str: The filled prompt.
+        """
+        return self._format.format(*[values.get(field, f"${field}$") for field in self.fields])
+
+    def fill_many(self, values: Iterable[Dict[str, str]]) -> List[str]:
+        """Fills the template once for every dictionary of values."""
+        fmt, fields = self._format, self.fields
+        return [fmt.format(*[v.get(field, f"${field}$") for field in fields]) for v in values]
+
+
+_templates: Dict[str, PromptTemplate] = {}
+
+def load_template(path: str) -> PromptTemplate:
+    """
+    Returns the compiled template of a prompt file, reading the file only on first use.
+
+    Raises:
+        IOError: If the prompt file cannot be read.
+    """
+    template = _templates.get(path)
+    if template is None:
+        try:
+            with open(path, "r") as f:
+                template = PromptTemplate(f.read())
+        except IOError:
+            raise IOError(f"Could not read {path}")
+        _templates[path] = template
+    return template
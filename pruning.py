@@ -0,0 +1,108 @@
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from rate_limiter import estimate_tokens
+from reflection_checker import reflection_checker
+
+# Stage names, as in mst.py
+STAGE_REFLECTION = "reflection"
+STAGE_REFLECTION_EXPLAIN = "ref-exp"
+STAGE_REFINE = "refine"
+STAGE_CONSOLIDATE = "consolidate"
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split()).lower()
+
+
+def has_critique(datum: Dict[str, str]) -> bool:
+    """Returns False only for an empty critique or the bare <None> answer the critique prompt asks for."""
+    assert "critique" in datum
+    return _normalize(datum["critique"]).rstrip(".") not in ("", "none", "<none>")
+
+
+# Each rule names the stages it applies to and returns True when the call is not needed
+PRUNING_RULES: Dict[str, Dict] = {
+    # The critique found nothing to criticize, so there is nothing to reflect on or refine
+    "no_critique": {
+        "stages": [STAGE_REFLECTION, STAGE_REFLECTION_EXPLAIN, STAGE_REFINE, STAGE_CONSOLIDATE],
+        "check": lambda datum: not has_critique(datum),
+    },
+    # The model rejected the critique, so the suggestion stays as it is
+    "rejected_reflection": {
+        "stages": [STAGE_REFINE],
+        "check": lambda datum: not reflection_checker({"test_output": datum["reflection"]}),
+    },
+    # Nothing was refined
+    "empty_refine": {
+        "stages": [STAGE_CONSOLIDATE],
+        "check": lambda datum: datum["refine"].strip() == "",
+    },
+    # The refined suggestion repeats the initial one, so comparing them is pointless
+    "identical_refine": {
+        "stages": [STAGE_CONSOLIDATE],
+        "check": lambda datum: _normalize(datum["refine"]) == _normalize(datum["suggestion"]),
+    },
+}
+# The skips mst.py always made; no_critique and identical_refine drop records from the results and are opt-in
+DEFAULT_PRUNING_RULES = ["rejected_reflection", "empty_refine"]
+# Passed to --prune_rules to disable pruning
+NO_PRUNING = "none"
+
+
+def parse_rules(values: List[str]) -> List[str]:
+    """Returns the rules given to --prune_rules, none if NO_PRUNING is among them."""
+    return [] if NO_PRUNING in values else values
+
+
+class PruningPlanner:
+    """
+    Decides per record which downstream calls are needed, given the outputs of the earlier stages, and counts the
+    calls and estimated tokens it saves.
+
+    Args:
+        rules (List[str], optional): The names of the enabled rules in PRUNING_RULES. Defaults to DEFAULT_PRUNING_RULES.
+    """
+
+    def __init__(self, rules: Optional[Iterable[str]] = None):
+        rules = DEFAULT_PRUNING_RULES if rules is None else list(rules)
+        for rule in rules:
+            if rule not in PRUNING_RULES:
+                raise ValueError(f"Error: unknown pruning rule {rule}.")
+        self.rules = rules
+        self.stats: Dict[str, Dict[str, Dict[str, int]]] = {}
+        self._lock = threading.Lock()
+
+    def skip_rule(self, stage: str, datum: Dict[str, str]) -> Optional[str]:
+        """Returns the name of the first enabled rule that makes the call of `stage` unnecessary, or None."""
+        for rule in self.rules:
+            if stage in PRUNING_RULES[rule]["stages"] and PRUNING_RULES[rule]["check"](datum):
+                return rule
+        return None
+
+    def record(self, stage: str, rule: str, prompt: str):
+        """Counts one skipped call and the tokens its prompt would have used."""
+        with self._lock:
+            counts = self.stats.setdefault(stage, {}).setdefault(rule, {"calls": 0, "tokens": 0})
+            counts["calls"] += 1
+            counts["tokens"] += estimate_tokens(prompt)
+
+    def merge(self, stats: Dict[str, Dict[str, Dict[str, int]]]):
+        """Adds the counts of another planner, e.g. one running in a worker process."""
+        with self._lock:
+            for stage, rules in stats.items():
+                for rule, counts in rules.items():
+                    total = self.stats.setdefault(stage, {}).setdefault(rule, {"calls": 0, "tokens": 0})
+                    total["calls"] += counts["calls"]
+                    total["tokens"] += counts["tokens"]
+
+    def report(self):
+        """Prints the skipped calls and tokens per stage and rule."""
+        if not self.stats:
+            print("Pruning: no calls skipped")
+            return
+        for stage, rules in self.stats.items():
+            calls = sum(c["calls"] for c in rules.values())
+            tokens = sum(c["tokens"] for c in rules.values())
+            details = ", ".join(f"{rule}: {c['calls']}" for rule, c in rules.items())
+            print(f"Pruning {stage}: skipped {calls} calls (~{tokens} tokens) [{details}]")
@@ -0,0 +1,221 @@
+import os, json, time, fcntl, asyncio, tempfile
+from typing import Any, Callable, Dict, List, Optional, Union
+
+# Directory holding the shared bucket state, one file per deployment
+RATE_LIMIT_DIR = os.path.join(tempfile.gettempdir(), "scr_rate_limits")
+
+# Requests per minute and tokens per minute for every deployment we call
+DEPLOYMENT_LIMITS = {
+    "llm-testing": {"rpm": 300, "tpm": 120000},
+    "llm-testing-gpt4": {"rpm": 12, "tpm": 10000},
+    "llm-testing-embedding": {"rpm": 300, "tpm": 120000},
+    "openai": {"rpm": 3500, "tpm": 90000},
+}
+
+# Number of completion tokens assumed when a request does not set max_tokens
+DEFAULT_COMPLETION_TOKENS = 256
+# Upper bound of a single sleep, so that a waiting worker re-checks the bucket regularly
+MAX_WAIT_SECONDS = 5
+
+
+def estimate_tokens(prompt: Union[str, List[Dict[str, str]], List[str]], max_tokens: Optional[int] = None) -> int:
+    """
+    Estimates the number of tokens a request will be charged for, the same way Azure does: prompt tokens plus max_tokens.
+
+    Args:
+        prompt (Union[str, List[Dict[str, str]], List[str]]): The prompt text, a list of chat messages or a list of texts.
+        max_tokens (Optional[int], optional): The max_tokens of the request. Defaults to DEFAULT_COMPLETION_TOKENS.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    if isinstance(prompt, str):
+        prompt = [prompt]
+    num_chars = sum(len(p["content"]) if isinstance(p, dict) else len(p) for p in prompt)
+    # Roughly four characters per token for English text
+    return num_chars // 4 + 1 + (DEFAULT_COMPLETION_TOKENS if max_tokens is None else max_tokens)
+
+
+class RateLimiter:
+    """
+    A token-bucket rate limiter whose state is shared by every thread and process on the host.
+
+    The bucket state of each deployment lives in a small JSON file under RATE_LIMIT_DIR and is updated under an
+    exclusive `flock`, so all pool workers, engines and scripts calling the same deployment draw from one budget.
+    Both buckets refill continuously, so the limiter never waits for a whole window to elapse.
+
+    Args:
+        name (str): The deployment name, used as the name of the state file.
+        rpm (int): The allowed requests per minute.
+        tpm (int): The allowed tokens per minute.
+    """
+
+    def __init__(self, name: str, rpm: int, tpm: int):
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        os.makedirs(RATE_LIMIT_DIR, exist_ok=True)
+        self.path = os.path.join(RATE_LIMIT_DIR, f"{name}.json")
+
+    def update_state(self, update: Callable[[Dict[str, Any]], Any]) -> Any:
+        """
+        Applies `update` to the shared state of the deployment under the exclusive lock and writes the state back.
+
+        Besides the bucket, the state holds the fields of other components sharing the deployment's budget, e.g. the
+        window of the concurrency controller, so `update` must modify the dict in place and keep unknown keys.
+
+        Args:
+            update (Callable[[Dict[str, Any]], Any]): Modifies the state dict in place.
+
+        Returns:
+            Any: The return value of `update`.
+        """
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                state = json.loads(content) if content else {"requests": self.rpm, "tokens": self.tpm, "updated": time.time()}
+                result = update(state)
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return result
+
+    def _update(self, tokens: int) -> float:
+        """Refills both buckets and takes one request and `tokens` tokens if available; returns the seconds to wait otherwise."""
+        def take(state: Dict[str, Any]) -> float:
+            now = time.time()
+            elapsed = max(now - state["updated"], 0)
+            requests = min(self.rpm, state["requests"] + elapsed * self.rpm / 60)
+            available = min(self.tpm, state["tokens"] + elapsed * self.tpm / 60)
+            paused_until = state.get("paused_until", 0)
+            if now < paused_until:
+                # The server asked every client of this deployment to back off
+                wait = paused_until - now
+            elif requests >= 1 and available >= tokens:
+                wait = 0.0
+                requests -= 1
+                available -= tokens
+            else:
+                wait = max((1 - requests) * 60 / self.rpm, (tokens - available) * 60 / self.tpm)
+            state.update(requests=requests, tokens=available, updated=now, paused_until=paused_until)
+            return wait
+        return self.update_state(take)
+
+    def acquire(self, tokens: int = 0):
+        """
+        Blocks until one request and `tokens` tokens are available, then takes them.
+
+        Args:
+            tokens (int, optional): The estimated number of tokens of the request. Defaults to 0.
+        """
+        # A request larger than the whole bucket would otherwise wait forever
+        tokens = min(tokens, self.tpm)
+        while True:
+            wait = self._update(tokens)
+            if wait <= 0:
+                return
+            time.sleep(min(wait, MAX_WAIT_SECONDS))
+
+    async def aacquire(self, tokens: int = 0):
+        """Asynchronous version of `acquire`."""
+        tokens = min(tokens, self.tpm)
+        loop = asyncio.get_running_loop()
+        while True:
+            # flock blocks while other processes hold the state file, so it must not run on the event loop
+            wait = await loop.run_in_executor(None, self._update, tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(min(wait, MAX_WAIT_SECONDS))
+
+    def headroom(self) -> float:
+        """Returns the fraction of the request and token budget currently available, or 0 while paused."""
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            try:
+                f.seek(0)
+                content = f.read()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        if not content:
+            return 1.0
+        state = json.loads(content)
+        now = time.time()
+        if now < state.get("paused_until", 0):
+            return 0.0
+        elapsed = max(now - state["updated"], 0)
+        requests = min(self.rpm, state["requests"] + elapsed * self.rpm / 60)
+        available = min(self.tpm, state["tokens"] + elapsed * self.tpm / 60)
+        return max(0.0, min(requests / self.rpm, available / self.tpm))
+
+    def pause(self, seconds: float):
+        """
+        Stops every worker on the host from taking budget of this deployment for `seconds`, e.g. after a 429.
+
+        Args:
+            seconds (float): The number of seconds to pause; an existing longer pause is kept.
+        """
+        def extend(state: Dict[str, Any]):
+            state["paused_until"] = max(state.get("paused_until", 0), time.time() + seconds)
+        self.update_state(extend)
+
+    def settle(self, estimated_tokens: int, response: Any):
+        """
+        Corrects the token bucket once the real usage of a request is known.
+
+        Args:
+            estimated_tokens (int): The number of tokens taken by `acquire`.
+            response (Any): The API response; its `usage.total_tokens` field is used if present.
+        """
+        try:
+            used_tokens = response["usage"]["total_tokens"]
+        except (KeyError, TypeError):
+            return
+        def correct(state: Dict[str, Any]):
+            state["tokens"] = min(self.tpm, state["tokens"] + min(estimated_tokens, self.tpm) - used_tokens)
+        self.update_state(correct)
+
+    async def asettle(self, estimated_tokens: int, response: Any):
+        """Asynchronous version of `settle`, run off the event loop for the same reason as `aacquire`."""
+        await asyncio.get_running_loop().run_in_executor(None, self.settle, estimated_tokens, response)
+
+
+_limiters: Dict[str, RateLimiter] = {}
+# Limits of the deployments configured at run time, e.g. the backends of config/config.json
+_registered_limits: Dict[str, Dict[str, int]] = {}
+
+def register_limits(deployment: str, rpm: int, tpm: int):
+    """
+    Registers the limits of a deployment that is not in DEPLOYMENT_LIMITS.
+
+    Raises:
+        ValueError: If the deployment already has other limits.
+    """
+    limits = {"rpm": rpm, "tpm": tpm}
+    existing = DEPLOYMENT_LIMITS.get(deployment) or _registered_limits.get(deployment)
+    if existing is not None and existing != limits:
+        raise ValueError(f"Error: deployment {deployment} already has the limits {existing}.")
+    _registered_limits[deployment] = limits
+
+
+def has_limits(deployment: str) -> bool:
+    """Returns whether the deployment is in DEPLOYMENT_LIMITS or was registered with `register_limits`."""
+    return deployment in DEPLOYMENT_LIMITS or deployment in _registered_limits
+
+
+def get_limiter(deployment: str) -> RateLimiter:
+    """
+    Returns the shared rate limiter of a deployment configured in DEPLOYMENT_LIMITS or registered with `register_limits`.
+
+    Raises:
+        ValueError: If the deployment is not configured.
+    """
+    if not has_limits(deployment):
+        raise ValueError(f"Error: no rate limit configured for deployment {deployment}.")
+    if deployment not in _limiters:
+        _limiters[deployment] = RateLimiter(deployment, **(DEPLOYMENT_LIMITS.get(deployment) or _registered_limits[deployment]))
+    return _limiters[deployment]
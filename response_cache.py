@@ -0,0 +1,197 @@
+import os, json, time, atexit, hashlib, sqlite3, threading, argparse
+from typing import Any, Dict, List, Optional, Union
+
+# Location of the on-disk cache shared by every model-calling module
+CACHE_PATH = "cache/responses.sqlite"
+# Least recently used responses are evicted once the cache grows beyond this size
+MAX_CACHE_BYTES = 1 << 30
+# Set to False to always call the API
+CACHE_ENABLED = True
+# Hit and miss counters and access times are kept in memory and written at most this often, or once this many
+# lookups are pending, so lookups do not open a write transaction each
+FLUSH_SECONDS = 5
+FLUSH_LOOKUPS = 1000
+
+
+class ResponseCache:
+    """
+    A persistent, content-addressed cache of model responses backed by sqlite.
+
+    Responses are keyed by a hash of the logical model, temperature, max_tokens and the full message list, so re-running
+    a stage only calls the API for prompts it has not seen, whichever backend answered them. The hit and miss counters are stored in the
+    database as well, so they add up across processes and runs; they and the access times used for eviction are
+    buffered in memory and flushed every FLUSH_SECONDS, so a lookup is a plain read.
+
+    Args:
+        path (str, optional): The path to the sqlite database. Defaults to CACHE_PATH.
+        max_bytes (int, optional): The maximum total size of the cached responses. Defaults to MAX_CACHE_BYTES.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, max_bytes: int = MAX_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        # Counters and access times not yet written to the database
+        self._pending_lock = threading.Lock()
+        self._pending_stats = {"hits": 0, "misses": 0}
+        self._pending_accessed: Dict[str, float] = {}
+        self._flushed = time.monotonic()
+        atexit.register(self.flush)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, size INTEGER, accessed REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+            conn.executemany("INSERT OR IGNORE INTO stats VALUES (?, 0)", [("hits",), ("misses",), ("evictions",), ("bytes",)])
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections cannot be shared between threads
+        if getattr(self._local, "conn", None) is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return self._local.conn
+
+    def _record(self, hits: int, misses: int, accessed: List[str]):
+        """Counts lookups in memory and writes them once FLUSH_SECONDS or FLUSH_LOOKUPS is reached."""
+        now = time.time()
+        with self._pending_lock:
+            self._pending_stats["hits"] += hits
+            self._pending_stats["misses"] += misses
+            for key in accessed:
+                self._pending_accessed[key] = now
+            due = (time.monotonic() - self._flushed >= FLUSH_SECONDS
+                   or sum(self._pending_stats.values()) >= FLUSH_LOOKUPS)
+        if due:
+            self.flush()
+
+    def _write_pending(self, conn: sqlite3.Connection):
+        # Runs inside the caller's transaction
+        with self._pending_lock:
+            stats, self._pending_stats = self._pending_stats, {"hits": 0, "misses": 0}
+            accessed, self._pending_accessed = self._pending_accessed, {}
+            self._flushed = time.monotonic()
+        conn.executemany("UPDATE responses SET accessed = ? WHERE key = ?", [(t, key) for key, t in accessed.items()])
+        conn.executemany("UPDATE stats SET value = value + ? WHERE name = ?", [(value, name) for name, value in stats.items() if value])
+
+    def flush(self):
+        """Writes the pending hit and miss counters and access times in one transaction."""
+        conn = self._connection()
+        with conn:
+            self._write_pending(conn)
+
+    @staticmethod
+    def make_key(model: str, temperature: float, max_tokens: Optional[int], messages: Union[str, List[Dict[str, str]]]) -> str:
+        """
+        Computes the cache key of a request.
+
+        Args:
+            model (str): The logical model, e.g. "gpt-3.5-turbo" for both the OpenAI model and the Azure deployment.
+            temperature (float): The sampling temperature.
+            max_tokens (Optional[int]): The max_tokens of the request.
+            messages (Union[str, List[Dict[str, str]]]): The chat messages, or the prompt of a completion request.
+
+        Returns:
+            str: The hex digest identifying the request.
+        """
+        request = {"model": model, "temperature": temperature, "max_tokens": max_tokens, "messages": messages}
+        return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Returns the cached response of `key`, or None on a miss."""
+        row = self._connection().execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self._record(0, 1, [])
+            return None
+        self._record(1, 0, [key])
+        return json.loads(row[0])
+
+    def put(self, key: str, response: Any):
+        """Stores a response and evicts the least recently used ones if the cache is over its size limit."""
+        if response is None:
+            return
+        data = json.dumps(response, ensure_ascii=False)
+        size = len(data.encode("utf-8"))
+        conn = self._connection()
+        with conn:
+            # Recent access times must be written before choosing what to evict
+            self._write_pending(conn)
+            old = conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, data, size, time.time()))
+            conn.execute("UPDATE stats SET value = value + ? WHERE name = 'bytes'", (size - (old[0] if old else 0),))
+            total = conn.execute("SELECT value FROM stats WHERE name = 'bytes'").fetchone()[0]
+            while total > self.max_bytes:
+                rows = conn.execute("SELECT key, size FROM responses ORDER BY accessed LIMIT 100").fetchall()
+                if not rows:
+                    break
+                freed = 0
+                evicted = 0
+                for evict_key, evict_size in rows:
+                    if total - freed <= self.max_bytes:
+                        break
+                    conn.execute("DELETE FROM responses WHERE key = ?", (evict_key,))
+                    freed += evict_size
+                    evicted += 1
+                conn.execute("UPDATE stats SET value = value - ? WHERE name = 'bytes'", (freed,))
+                conn.execute("UPDATE stats SET value = value + ? WHERE name = 'evictions'", (evicted,))
+                total -= freed
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the hit, miss and eviction counters, the cached bytes and the number of entries."""
+        self.flush()
+        conn = self._connection()
+        stats = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+        stats["entries"] = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return stats
+
+    def clear(self):
+        """Removes every cached response and resets the counters."""
+        conn = self._connection()
+        with conn:
+            self._write_pending(conn)
+            conn.execute("DELETE FROM responses")
+            conn.execute("UPDATE stats SET value = 0")
+
+
+class _DisabledCache:
+    """Stand-in used when CACHE_ENABLED is False; every lookup is a miss."""
+
+    make_key = staticmethod(ResponseCache.make_key)
+
+    def get(self, key):
+        return None
+
+    def put(self, key, response):
+        pass
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_response_cache():
+    """Returns the process-wide response cache."""
+    global _cache
+    if not CACHE_ENABLED:
+        return _DisabledCache()
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+    return _cache
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or clear the model response cache.")
+    parser.add_argument("command", type=str, choices=["stats", "clear"])
+    parser.add_argument("--cache_path", type=str, default=CACHE_PATH, help="path to the cache database")
+    args = parser.parse_args()
+    cache = ResponseCache(args.cache_path)
+    if args.command == "stats":
+        stats = cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        print(json.dumps(stats, indent=2))
+        if lookups:
+            print(f"Hit rate: {stats['hits'] / lookups:.3f}")
+    elif args.command == "clear":
+        cache.clear()
+        print(f"Cleared {args.cache_path}")
@@ -0,0 +1,124 @@
+import time, random, asyncio
+from typing import Any, Awaitable, Callable
+
+from concurrency_controller import is_throttled
+
+# Error classes returned by `classify_error`
+RETRYABLE = "retryable"
+FILTERED = "filtered"
+FATAL = "fatal"
+
+# Names of the openai / aiohttp / requests errors that are worth retrying
+RETRYABLE_ERROR_NAMES = {
+    "Timeout", "TimeoutError", "APIConnectionError", "ServiceUnavailableError", "TryAgain", "APIError",
+    "ConnectionError", "ClientConnectionError", "ServerDisconnectedError", "ReadTimeout", "ConnectTimeout",
+}
+
+
+class ContentFilteredError(Exception):
+    """Raised when the backend refuses a prompt because of its content filter; retrying the same backend is pointless."""
+
+
+class RetryError(Exception):
+    """Raised when a request still fails after the last attempt or the deadline of the item."""
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, a timeout per request and an overall deadline per item.
+
+    Args:
+        max_attempts (int, optional): The maximum number of attempts. Defaults to 6.
+        base_delay (float, optional): The backoff cap of the first retry in seconds. Defaults to 1.
+        max_delay (float, optional): The maximum backoff in seconds. Defaults to 60.
+        request_timeout (float, optional): The timeout of a single request in seconds. Defaults to 120.
+        deadline (float, optional): The time budget of all attempts together in seconds. Defaults to 600.
+    """
+
+    def __init__(self, max_attempts: int = 6, base_delay: float = 1.0, max_delay: float = 60.0, request_timeout: float = 120.0, deadline: float = 600.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.request_timeout = request_timeout
+        self.deadline = deadline
+
+    def backoff(self, attempt: int) -> float:
+        """Returns the full-jitter delay before retry number `attempt` (starting at 0)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+def classify_error(error: Exception) -> str:
+    """
+    Classifies an API error as RETRYABLE, FILTERED or FATAL.
+
+    Throttling, timeouts, connection problems and server errors are retryable. Content-filter refusals are filtered.
+    Everything else (invalid requests, authentication, malformed responses) is fatal.
+    """
+    message = str(error).lower()
+    if "filtered due to the prompt" in message or "content_filter" in message or "content management policy" in message:
+        return FILTERED
+    if is_throttled(error):
+        return RETRYABLE
+    if isinstance(error, (TimeoutError, ConnectionError, asyncio.TimeoutError)) or type(error).__name__ in RETRYABLE_ERROR_NAMES:
+        return RETRYABLE
+    status = getattr(error, "http_status", None)
+    if status is not None and status >= 500:
+        return RETRYABLE
+    return FATAL
+
+
+def _next_delay(policy: RetryPolicy, attempt: int, error: Exception, remaining: float, description: str) -> float:
+    kind = classify_error(error)
+    if kind == FILTERED:
+        raise ContentFilteredError(str(error)) from error
+    if kind == FATAL:
+        raise error
+    if attempt == policy.max_attempts - 1:
+        raise RetryError(f"{description} failed after {policy.max_attempts} attempts: {error}") from error
+    if remaining <= 0:
+        raise RetryError(f"{description} exceeded its deadline of {policy.deadline} seconds: {error}") from error
+    delay = min(policy.backoff(attempt), remaining)
+    print(f"Error making {description}: {error}. Retrying in {delay:.1f} seconds...")
+    return delay
+
+
+def call_with_retry(request: Callable[[float], Any], policy: RetryPolicy = DEFAULT_RETRY_POLICY, description: str = "request") -> Any:
+    """
+    Calls `request(timeout)` until it succeeds, following `policy`.
+
+    Args:
+        request (Callable[[float], Any]): Makes one attempt; receives the timeout in seconds it must pass to the API.
+        policy (RetryPolicy, optional): The retry policy. Defaults to DEFAULT_RETRY_POLICY.
+        description (str, optional): A description of the request for log messages. Defaults to "request".
+
+    Returns:
+        Any: The result of the first successful attempt.
+
+    Raises:
+        ContentFilteredError: If the backend filtered the prompt.
+        RetryError: If the attempts or the deadline are exhausted.
+        Exception: The original error if it is fatal.
+    """
+    start = time.monotonic()
+    for attempt in range(policy.max_attempts):
+        remaining = policy.deadline - (time.monotonic() - start)
+        try:
+            return request(max(min(policy.request_timeout, remaining), 1))
+        except Exception as e:
+            remaining = policy.deadline - (time.monotonic() - start)
+            time.sleep(_next_delay(policy, attempt, e, remaining, description))
+
+
+async def acall_with_retry(request: Callable[[float], Awaitable[Any]], policy: RetryPolicy = DEFAULT_RETRY_POLICY, description: str = "request") -> Any:
+    """Asynchronous version of `call_with_retry`."""
+    start = time.monotonic()
+    for attempt in range(policy.max_attempts):
+        remaining = policy.deadline - (time.monotonic() - start)
+        try:
+            return await request(max(min(policy.request_timeout, remaining), 1))
+        except Exception as e:
+            remaining = policy.deadline - (time.monotonic() - start)
+            await asyncio.sleep(_next_delay(policy, attempt, e, remaining, description))
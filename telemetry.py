@@ -0,0 +1,246 @@
+"""Token, latency and cost accounting of the model calls.
+
+model_client.py reports every request here: prompt and completion tokens, latency, attempts, backend and whether it
+was served from the response cache. The totals are kept per stage, model and input file (set by the stage scripts
+with `set_context`) and appended to METRICS_PATH every FLUSH_INTERVAL seconds and at exit, so several processes
+and runs can share the file.
+Typical usage example:
+  python telemetry.py summary
+  python telemetry.py summary --metrics_path metrics/model_calls.jsonl --group_by stage model
+"""
+import os, json, time, fcntl, atexit, argparse, threading, contextlib, contextvars
+from typing import Any, Dict, List, Optional, Tuple
+
+# File receiving the aggregated metrics, one JSON line per group and flush
+METRICS_PATH = "metrics/model_calls.jsonl"
+# Seconds between two writes of the aggregated metrics
+FLUSH_INTERVAL = 30.0
+# Set to False to record nothing
+TELEMETRY_ENABLED = True
+
+# Models served by our Azure deployments
+DEPLOYMENT_MODELS = {
+    "llm-testing": "gpt-3.5-turbo",
+    "llm-testing-gpt4": "gpt-4",
+    "llm-testing-embedding": "text-embedding-ada-002",
+}
+# USD per 1k prompt and completion tokens
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-4": (0.03, 0.06),
+    "text-davinci-003": (0.02, 0.02),
+    "text-embedding-ada-002": (0.0001, 0.0),
+}
+
+COUNTERS = ["requests", "cached", "failed", "attempts", "prompt_tokens", "completion_tokens", "seconds", "api_seconds"]
+
+_default_context = {"stage": None, "input_file": None}
+_context: contextvars.ContextVar = contextvars.ContextVar("telemetry_context", default=None)
+
+
+def set_context(stage: Optional[str] = None, input_file: Optional[str] = None):
+    """Sets the stage and input file the following calls of this process are accounted to."""
+    _default_context.update(stage=stage, input_file=input_file)
+
+
+@contextlib.contextmanager
+def telemetry_context(stage: Optional[str] = None, input_file: Optional[str] = None):
+    """Accounts the calls of the current thread or asyncio task to `stage` and `input_file`, e.g. in pipeline.py."""
+    token = _context.set({"stage": stage, "input_file": input_file})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def current_context() -> Dict[str, Optional[str]]:
+    return _context.get() or _default_context
+
+
+def request_model(request: Dict[str, Any]) -> str:
+    """
+    Returns the logical model of a request: its `model`, or else the model served by its Azure deployment (`engine`)
+    according to DEPLOYMENT_MODELS, so the same model reached through different backends is accounted together.
+    """
+    if request.get("model"):
+        return request["model"]
+    if request.get("engine"):
+        return DEPLOYMENT_MODELS.get(request["engine"], request["engine"])
+    return "unknown"
+
+
+class Telemetry:
+    """
+    Aggregates the metrics of the model calls of this process and appends them to a metrics file.
+
+    Args:
+        path (str, optional): The metrics file. Defaults to METRICS_PATH.
+        flush_interval (float, optional): Seconds between two writes. Defaults to FLUSH_INTERVAL.
+    """
+
+    def __init__(self, path: str = METRICS_PATH, flush_interval: float = FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._groups: Dict[Tuple, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+
+    def record(self, deployment: str, request: Dict[str, Any], usage: Optional[Dict[str, int]] = None, seconds: float = 0.0,
+               api_seconds: float = 0.0, attempts: int = 0, cached: bool = False, failed: bool = False):
+        """
+        Accounts one request.
+
+        Args:
+            deployment (str): The deployment or backend whose budget the request used.
+            request (Dict[str, Any]): The request arguments, used for the model name and api_type.
+            usage (Optional[Dict[str, int]], optional): The `usage` field of the response. Defaults to None.
+            seconds (float, optional): The time from the first attempt to the result, including retries. Defaults to 0.
+            api_seconds (float, optional): The latency of the successful API call. Defaults to 0.
+            attempts (int, optional): The number of API calls made. Defaults to 0.
+            cached (bool, optional): Whether the response came from the response cache. Defaults to False.
+            failed (bool, optional): Whether the request failed for good. Defaults to False.
+        """
+        context = current_context()
+        model = request_model(request)
+        key = (context["stage"], model, context["input_file"])
+        backend = f"{deployment} ({request['api_type']})" if request.get("api_type") else deployment
+        now = time.time()
+        usage = usage or {}
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = {"first": now - seconds, "last": now, "backends": {}, **{c: 0 for c in COUNTERS}}
+            group["last"] = now
+            group["requests"] += 1
+            group["cached"] += int(cached)
+            group["failed"] += int(failed)
+            group["attempts"] += attempts
+            group["prompt_tokens"] += usage.get("prompt_tokens", 0)
+            group["completion_tokens"] += usage.get("completion_tokens", 0)
+            group["seconds"] += seconds
+            group["api_seconds"] += api_seconds
+            group["backends"][backend] = group["backends"].get(backend, 0) + 1
+            due = now - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Appends the metrics gathered since the last flush to the metrics file."""
+        with self._lock:
+            groups, self._groups = self._groups, {}
+            self._last_flush = time.time()
+        if not groups:
+            return
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lines = "".join(json.dumps({"stage": stage, "model": model, "input_file": input_file, "pid": os.getpid(), **group}) + "\n"
+                        for (stage, model, input_file), group in groups.items())
+        with open(self.path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(lines)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class _DisabledTelemetry:
+    def record(self, *args, **kwargs):
+        pass
+
+    def flush(self):
+        pass
+
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+
+def get_telemetry():
+    """Returns the process-wide recorder, flushed at exit; a no-op recorder if TELEMETRY_ENABLED is False."""
+    global _telemetry
+    if not TELEMETRY_ENABLED:
+        return _DisabledTelemetry()
+    with _telemetry_lock:
+        if _telemetry is None:
+            _telemetry = Telemetry(METRICS_PATH, FLUSH_INTERVAL)
+            atexit.register(_telemetry.flush)
+    return _telemetry
+
+
+def _active_seconds(windows: List[Tuple[float, float]]) -> float:
+    """
+    Returns the length of the union of the [first, last] windows of the entries, so idle time between runs is left out
+    and entries of concurrent processes are not counted twice.
+    """
+    active = 0.0
+    end = None
+    for first, last in sorted(windows):
+        if end is None or first > end:
+            active += last - first
+            end = last
+        elif last > end:
+            active += last - end
+            end = last
+    return active
+
+
+def summarize(path: str = METRICS_PATH, group_by: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """
+    Adds up the metrics file per group.
+
+    Args:
+        path (str, optional): The metrics file. Defaults to METRICS_PATH.
+        group_by (List[str], optional): The fields to group by, among "stage", "model" and "input_file". Defaults to all three.
+
+    Returns:
+        List[Dict[str, Any]]: Per group, the summed counters plus tokens/sec over the time the group was
+            active, mean latency, cost and cost per 1k records.
+    """
+    group_by = group_by or ["stage", "model", "input_file"]
+    totals: Dict[Tuple, Dict[str, Any]] = {}
+    with open(path, "r") as f:
+        for line in f:
+            entry = json.loads(line)
+            key = tuple(entry[field] for field in group_by)
+            total = totals.get(key)
+            if total is None:
+                total = totals[key] = {"windows": [], "cost": 0.0, "backends": {}, **{c: 0 for c in COUNTERS}}
+            total["windows"].append((entry["first"], entry["last"]))
+            for counter in COUNTERS:
+                total[counter] += entry[counter]
+            for backend, count in entry["backends"].items():
+                total["backends"][backend] = total["backends"].get(backend, 0) + count
+            prompt_price, completion_price = MODEL_PRICES.get(entry["model"], (0.0, 0.0))
+            total["cost"] += (entry["prompt_tokens"] * prompt_price + entry["completion_tokens"] * completion_price) / 1000
+    summary = []
+    for key, total in totals.items():
+        tokens = total["prompt_tokens"] + total["completion_tokens"]
+        active = _active_seconds(total["windows"])
+        # Every record of a stage makes one request
+        records = total["requests"] - total["failed"]
+        called = total["requests"] - total["cached"]
+        summary.append({
+            **dict(zip(group_by, key)),
+            **{c: total[c] for c in COUNTERS if c not in ("seconds", "api_seconds")},
+            # Every request reaching the API makes one attempt plus its retries
+            "retries": max(total["attempts"] - called, 0),
+            "tokens_per_s": tokens / active if active > 0 else 0.0,
+            "mean_latency_s": total["api_seconds"] / max(called - total["failed"], 1),
+            "cost_usd": total["cost"],
+            "cost_per_1k_records_usd": total["cost"] / records * 1000 if records else None,
+            "backends": total["backends"],
+        })
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the token, latency and cost metrics of the model calls.")
+    parser.add_argument("command", type=str, choices=["summary", "clear"])
+    parser.add_argument("--metrics_path", type=str, default=METRICS_PATH, help="path to the metrics file")
+    parser.add_argument("--group_by", nargs="+", choices=["stage", "model", "input_file"], default=["stage", "model", "input_file"])
+    args = parser.parse_args()
+    if args.command == "summary":
+        for row in summarize(args.metrics_path, args.group_by):
+            print(json.dumps(row))
+    elif args.command == "clear" and os.path.exists(args.metrics_path):
+        os.remove(args.metrics_path)